@@ -1,5 +1,5 @@
 #!/usr/bin/python3
-# -*- encoding: utf-8 -*- 
+# -*- encoding: utf-8 -*-
 
 import os
 import sys
@@ -10,30 +10,58 @@ from os.path import join, basename, exists
 
 from extractor import KPP
 from bundle import Bundle
+import profiling
+
+RESOURCE_TYPES = dict(brush='brushes', preset='paintoppresets', pattern='patterns', gradient='gradients')
 
 def parse_cmdline():
-    parser = argparse.ArgumentParser(description="Add resource (preset, brush tip or pattern) to the bundle.")
+    parser = argparse.ArgumentParser(description="Add resources (presets, brush tips, patterns or gradients) to the bundle.",
+                                     epilog="Example: add-to-bundle.py test.bundle brush tip1.gbr tip2.gih preset mypreset.kpp")
+    parser.add_argument('--preview', metavar='FILE.PNG', help="Replace bundle preview with this file")
     parser.add_argument('bundle', metavar='FILE.BUNDLE', help="Path to bundle file to operate on")
-    #subparsers = parser.add_subparsers(help="type of resource to be added")
-    parser.add_argument('type', metavar='TYPE', help="Type of resource to be added: preset, brush or pattern.")
-    parser.add_argument('path', metavar='FILENAME', nargs=argparse.REMAINDER, help="File to be added to the bundle")
+    profiling.add_cmdline_options(parser)
+    parser.add_argument('resources', metavar='TYPE FILENAME', nargs='*',
+                        help="Type of resources to be added: preset, brush, pattern or gradient, followed by files of that type. Several such groups may be specified.")
+
+    # options may follow or separate groups of resources
+    args = parser.parse_intermixed_args()
+    for item in args.resources:
+        if item.startswith('-'):
+            parser.error("unrecognized option: {}".format(item))
+        if item not in RESOURCE_TYPES and not exists(item):
+            parser.error("no such file: {}".format(item))
+    return args
 
-    return parser.parse_args()
+def group_resources(items):
+    """
+    Split list like [type, file, file, type, file...] into (mtype, files) pairs.
+    """
+    result = []
+    for item in items:
+        if item in RESOURCE_TYPES:
+            result.append((RESOURCE_TYPES[item], []))
+        elif not result:
+            return None
+        else:
+            result[-1][1].append(item)
+    return result
 
 if __name__ == '__main__':
 
     args = parse_cmdline()
+    profiling.configure_from_args(args)
     #print(args)
-    bundle = Bundle.open(args.bundle)
+    groups = group_resources(args.resources)
+    if groups is None:
+        print("Unknown resource type specified. Valid resource types are: brush, preset, pattern, gradient.")
+        sys.exit(1)
+
+    bundle = Bundle.open(args.bundle, lazy=True)
     shutil.copy(args.bundle, args.bundle+'.bak')
 
-    if args.type == 'brush':
-        bundle.add_brushes(args.bundle, args.path)
-    elif args.type == 'preset':
-        bundle.add_presets(args.bundle, args.path)
-    elif args.type == 'pattern':
-        bundle.add_patterns(args.bundle, args.path)
-    else:
-        print("Unknown resource type specified. Valid resource types are: brush, preset, pattern.")
-        sys.exit(1)
+    with bundle.edit(args.bundle) as tx:
+        for mtype, paths in groups:
+            tx.add(mtype, paths)
+        if args.preview:
+            tx.set_preview(args.preview)
 
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+"""
+Deterministic generator of synthetic Krita resources: presets (*.kpp),
+brush tips (*.gbr, *.gih), patterns (*.pat) and bundles made of them.
+Same parameters and seed always produce the same files.
+"""
+
+import os
+import sys
+import random
+import struct
+import zlib
+import argparse
+from os.path import join, dirname, abspath, isdir
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from bundle import Bundle, Meta
+
+def png_chunk(ctype, data):
+    return struct.pack('>I', len(data)) + ctype + data + struct.pack('>I', zlib.crc32(data, zlib.crc32(ctype)))
+
+def make_png(rnd, size, text=None):
+    """
+    Return PNG file (RGBA, noise) with optional dictionary of iTXt chunks.
+    """
+    header = struct.pack('>IIBBBBB', size, size, 8, 6, 0, 0, 0)
+    rows = b''.join(b'\0' + rnd.randbytes(size * 4) for _ in range(size))
+    chunks = [png_chunk(b'IHDR', header)]
+    for keyword, value in (text or dict()).items():
+        data = keyword.encode('latin-1') + b'\0\1\0\0\0' + zlib.compress(value.encode('utf-8'))
+        chunks.append(png_chunk(b'iTXt', data))
+    chunks.append(png_chunk(b'IDAT', zlib.compress(rows)))
+    chunks.append(png_chunk(b'IEND', b''))
+    return b'\x89PNG\r\n\x1a\n' + b''.join(chunks)
+
+def brush_name(index, ext='gbr'):
+    return "tip_{}.{}".format(index, ext)
+
+def pattern_name(index):
+    return "pattern_{}.pat".format(index)
+
+def make_preset_xml(rnd, name, brush, pattern, params):
+    lines = ['<Preset paintopid="paintbrush" name="{}">'.format(name)]
+    lines.append('<param type="string" name="requiredBrushFile"><![CDATA[{}]]></param>'.format(brush))
+    if pattern is not None:
+        lines.append('<param type="string" name="Texture/Pattern/PatternFileName"><![CDATA[{}]]></param>'.format(pattern))
+    for i in range(params):
+        lines.append('<param type="string" name="Option{}/Value"><![CDATA[{}]]></param>'.format(i, rnd.random()))
+    lines.append('</Preset>')
+    return "\n".join(lines)
+
+def make_gbr(rnd, name, size):
+    name = name.encode('utf-8') + b'\0'
+    header_size = 28 + len(name)
+    header = struct.pack('>7I', header_size, 2, size, size, 1, 0x47494d50, 25)
+    return header + name + rnd.randbytes(size * size)
+
+def make_gih(rnd, name, size, cells):
+    text = "{}\n{} ncells:{} cellwidth:{} cellheight:{} step:25 dim:1 rank0:{} sel0:random\n".format(name, cells, cells, size, size, cells)
+    return text.encode('utf-8') + b''.join(make_gbr(rnd, name, size) for _ in range(cells))
+
+def make_pat(rnd, name, size):
+    name = name.encode('utf-8') + b'\0'
+    header_size = 24 + len(name)
+    header = struct.pack('>6I', header_size, 1, size, size, 3, 0x47504154)
+    return header + name + rnd.randbytes(size * size * 3)
+
+class Generator(object):
+    """
+    Writes resources into directory structure used by create-krita-bundle.py:
+    brushes/, patterns/, paintoppresets/ and preview.png.
+    Presets refer to random brush tips and patterns; missing_ratio of them
+    refer to brush tips which are not generated.
+    """
+
+    def __init__(self, directory, seed=1, presets=1000, brushes=500, patterns=50,
+                 icon_size=200, brush_size=64, pattern_size=128, params=300, gih_ratio=0.1, missing_ratio=0.0):
+        self.directory = directory
+        self.seed = seed
+        self.presets = presets
+        self.brushes = brushes
+        self.patterns = patterns
+        self.icon_size = icon_size
+        self.brush_size = brush_size
+        self.pattern_size = pattern_size
+        self.params = params
+        self.gih_ratio = gih_ratio
+        self.missing_ratio = missing_ratio
+
+    def _write(self, subdir, name, data):
+        directory = join(self.directory, subdir)
+        if not isdir(directory):
+            os.makedirs(directory)
+        path = join(directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def brush_names(self):
+        rnd = random.Random(self.seed)
+        return [brush_name(i, 'gih' if rnd.random() < self.gih_ratio else 'gbr') for i in range(self.brushes)]
+
+    def write_brushes(self):
+        rnd = random.Random(self.seed + 1)
+        result = []
+        for name in self.brush_names():
+            if name.endswith('.gih'):
+                data = make_gih(rnd, name, self.brush_size, 4)
+            else:
+                data = make_gbr(rnd, name, self.brush_size)
+            result.append(self._write('brushes', name, data))
+        return result
+
+    def write_patterns(self):
+        rnd = random.Random(self.seed + 2)
+        return [self._write('patterns', pattern_name(i), make_pat(rnd, pattern_name(i), self.pattern_size))
+                for i in range(self.patterns)]
+
+    def write_presets(self):
+        rnd = random.Random(self.seed + 3)
+        brushes = self.brush_names()
+        result = []
+        for i in range(self.presets):
+            if rnd.random() < self.missing_ratio or not brushes:
+                brush = brush_name(self.brushes + i)
+            else:
+                brush = rnd.choice(brushes)
+            pattern = pattern_name(rnd.randrange(self.patterns)) if self.patterns and rnd.random() < 0.5 else None
+            name = "preset_{}".format(i)
+            xml = make_preset_xml(rnd, name, brush, pattern, self.params)
+            result.append(self._write('paintoppresets', name + ".kpp", make_png(rnd, self.icon_size, dict(preset=xml))))
+        return result
+
+    def write_preview(self):
+        return self._write('.', 'preview.png', make_png(random.Random(self.seed + 4), 64))
+
+    def write_all(self):
+        self.write_brushes()
+        self.write_patterns()
+        self.write_presets()
+        self.write_preview()
+
+    def write_bundle(self, zipname):
+        """
+        Create bundle from generated resources (write_all() must be called first).
+        """
+        meta = Meta()
+        meta.author = "Benchmark"
+        meta.date = "2015/06/01"
+        bundle = Bundle()
+        bundle.prepare(join(self.directory, 'brushes'), "*.gbr;*.gih",
+                       join(self.directory, 'paintoppresets'), "*.kpp",
+                       join(self.directory, 'patterns'), "*.pat")
+        bundle.create(zipname, meta, join(self.directory, 'preview.png'))
+        return zipname
+
+def add_cmdline_options(parser):
+    parser.add_argument('--seed', type=int, default=1, help="Random seed")
+    parser.add_argument('--presets', type=int, default=1000, help="Number of presets")
+    parser.add_argument('--brushes', type=int, default=500, help="Number of brush tips")
+    parser.add_argument('--patterns', type=int, default=50, help="Number of patterns")
+    parser.add_argument('--icon-size', type=int, default=200, help="Size of preset icons, in pixels")
+    parser.add_argument('--brush-size', type=int, default=64, help="Size of brush tips, in pixels")
+    parser.add_argument('--pattern-size', type=int, default=128, help="Size of patterns, in pixels")
+    parser.add_argument('--params', type=int, default=300, help="Number of parameters in each preset")
+    parser.add_argument('--missing', type=float, default=0.0, metavar='RATIO', help="Part of presets referring to brush tips that are not generated")
+
+def from_cmdline(args, directory):
+    return Generator(directory, seed=args.seed, presets=args.presets, brushes=args.brushes, patterns=args.patterns,
+                     icon_size=args.icon_size, brush_size=args.brush_size, pattern_size=args.pattern_size,
+                     params=args.params, missing_ratio=args.missing)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate synthetic Krita resources")
+    parser.add_argument('directory', metavar='DIRECTORY', help="Where to write resources")
+    parser.add_argument('--bundle', metavar='FILE.BUNDLE', help="Also create bundle file from generated resources")
+    add_cmdline_options(parser)
+    args = parser.parse_args()
+    generator = from_cmdline(args, args.directory)
+    generator.write_all()
+    if args.bundle:
+        generator.write_bundle(args.bundle)
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+"""
+Compare the header-only PNG chunk scanner with Pillow decoding
+on a set of synthetic presets.
+"""
+
+import sys
+import time
+import random
+import argparse
+import tempfile
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from extractor import read_png_text, pillow_png_text
+from benchmarks.generator import make_preset_xml, brush_name, pattern_name
+
+def write_presets(directory, count, size, params, seed=1):
+    from PIL import Image
+    from PIL.PngImagePlugin import PngInfo
+
+    rnd = random.Random(seed)
+    result = []
+    for i in range(count):
+        image = Image.frombytes('RGBA', (size, size), rnd.randbytes(size * size * 4))
+        info = PngInfo()
+        xml = make_preset_xml(rnd, "preset_{}".format(i), brush_name(rnd.randrange(100)), pattern_name(rnd.randrange(20)), params)
+        info.add_itxt('preset', xml, zip=True)
+        path = join(directory, "preset_{}.kpp".format(i))
+        image.save(path, 'PNG', pnginfo=info)
+        result.append(path)
+    return result
+
+def measure(label, function, sources):
+    start = time.perf_counter()
+    for source in sources:
+        if function(source, 'preset') is None:
+            raise Exception("{}: no preset found".format(label))
+    elapsed = time.perf_counter() - start
+    print("{:<28} {:8.3f} s  {:10.1f} presets/s".format(label, elapsed, len(sources) / elapsed))
+    return elapsed
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description="Benchmark preset text extraction from *.kpp files")
+    parser.add_argument('-n', '--count', type=int, default=3000, help="Number of presets to generate")
+    parser.add_argument('-s', '--size', type=int, default=200, help="Preset icon size in pixels")
+    parser.add_argument('-p', '--params', type=int, default=300, help="Number of parameters in each preset")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_cmdline()
+    with tempfile.TemporaryDirectory() as directory:
+        print("Generating {} presets...".format(args.count))
+        paths = write_presets(directory, args.count, args.size, args.params)
+        blobs = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                blobs.append(f.read())
+
+        for path, blob in zip(paths[:10], blobs):
+            assert read_png_text(path) == pillow_png_text(blob)
+
+        pillow_files = measure("Pillow, files", pillow_png_text, paths)
+        scanner_files = measure("chunk scanner, files", read_png_text, paths)
+        pillow_blobs = measure("Pillow, in-memory", pillow_png_text, blobs)
+        scanner_blobs = measure("chunk scanner, in-memory", read_png_text, blobs)
+        print("Speedup: {:.1f}x on files, {:.1f}x in memory".format(pillow_files / scanner_files, pillow_blobs / scanner_blobs))
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+
+"""
+Run benchmarks of main bundle operations on synthetic resources and
+print results as JSON. Each operation runs in a fresh process, so that
+its peak RSS can be measured.
+
+    python -m benchmarks.runner --presets 5000 -o results.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import argparse
+import platform
+import subprocess
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from os.path import join, dirname, abspath
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from benchmarks import generator
+
+REPO_DIR = dirname(dirname(abspath(__file__)))
+
+def _prepare(workspace):
+    from bundle import Bundle
+    bundle = Bundle()
+    bundle.prepare(join(workspace, 'brushes'), "*.gbr;*.gih",
+                   join(workspace, 'paintoppresets'), "*.kpp",
+                   join(workspace, 'patterns'), "*.pat")
+    return bundle
+
+def op_get_links(workspace):
+    from extractor import KPP
+    presets = _prepare(workspace).presets
+    for path in presets:
+        KPP(path).get_links()
+    return len(presets)
+
+def op_bundle_open(workspace):
+    from bundle import Bundle
+    bundle = Bundle.open(join(workspace, 'test.bundle'))
+    return len(bundle.presets) + len(bundle.brushes) + len(bundle.patterns)
+
+def op_bundle_open_lazy(workspace):
+    from bundle import Bundle
+    with Bundle.open(join(workspace, 'test.bundle'), lazy=True) as bundle:
+        return len(bundle.presets) + len(bundle.brushes) + len(bundle.patterns)
+
+def op_check(workspace):
+    bundle = _prepare(workspace)
+    bundle.check()
+    return len(bundle.presets)
+
+def op_check_parallel(workspace):
+    bundle = _prepare(workspace)
+    bundle.check(jobs=0)
+    return len(bundle.presets)
+
+def op_check_cached(workspace):
+    import cache
+    cache.configure(path=join(workspace, 'cache.sqlite'))
+    bundle = _prepare(workspace)
+    bundle.check()
+    return len(bundle.presets)
+
+def op_create(workspace):
+    from bundle import Meta
+    bundle = _prepare(workspace)
+    bundle.create(join(workspace, 'created.bundle'), Meta(), join(workspace, 'preview.png'))
+    return len(bundle.presets) + len(bundle.brushes) + len(bundle.patterns)
+
+def op_create_incremental(workspace):
+    import cache
+    from bundle import Meta
+    cache.configure(path=join(workspace, 'cache.sqlite'))
+    bundle = _prepare(workspace)
+    bundle.create(join(workspace, 'test.bundle'), Meta(), join(workspace, 'preview.png'), incremental=True)
+    return len(bundle.presets) + len(bundle.brushes) + len(bundle.patterns)
+
+def op_add_resources(workspace):
+    from bundle import Bundle
+    zipname = join(workspace, 'added.bundle')
+    shutil.copy(join(workspace, 'test.bundle'), zipname)
+    bundle = Bundle.open(zipname, lazy=True)
+    brushes = _prepare(workspace).brushes[:10]
+    bundle.add_brushes(zipname, brushes)
+    return len(brushes)
+
+def op_warm_cache(workspace):
+    """
+    Fill preset and digest caches, as a previous build would do.
+    """
+    op_check_cached(workspace)
+    return op_create_incremental(workspace)
+
+# name => (function, needs warm preset cache)
+OPERATIONS = [
+    ('get_links', op_get_links, False),
+    ('bundle_open', op_bundle_open, False),
+    ('bundle_open_lazy', op_bundle_open_lazy, False),
+    ('check', op_check, False),
+    ('check_parallel', op_check_parallel, False),
+    ('check_cached', op_check_cached, True),
+    ('create', op_create, False),
+    ('create_incremental', op_create_incremental, True),
+    ('add_resources', op_add_resources, False),
+]
+
+HELPERS = [
+    ('warm_cache', op_warm_cache, False),
+]
+
+def _measure(name, workspace):
+    function = dict((op[0], op[1]) for op in OPERATIONS + HELPERS)[name]
+    # keep output of the operation itself away from JSON results
+    devnull = open(os.devnull, 'w')
+    stdout, sys.stdout = sys.stdout, devnull
+    try:
+        started = time.perf_counter()
+        files = function(workspace)
+        elapsed = time.perf_counter() - started
+        import cache
+        cache.get_cache().close()
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        maxrss //= 1024
+    return dict(wall_time=elapsed, peak_rss_kb=maxrss, files=files, files_per_sec=files / elapsed if elapsed else None)
+
+def run_isolated(name, workspace):
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(1, mp_context=context) as pool:
+        return pool.submit(_measure, name, workspace).result()
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description="Benchmark bundle operations on synthetic resources")
+    generator.add_cmdline_options(parser)
+    parser.add_argument('--ops', metavar='NAME,...', help="Operations to run, comma-separated; available: " + ", ".join(op[0] for op in OPERATIONS))
+    parser.add_argument('--repeat', type=int, default=1, help="Run each operation this many times and report the best wall time")
+    parser.add_argument('--workdir', metavar='DIRECTORY', help="Where to generate resources; temporary directory by default")
+    parser.add_argument('-o', '--output', metavar='FILE.JSON', help="Write results to file instead of stdout")
+    return parser.parse_args()
+
+def main():
+    args = parse_cmdline()
+    names = [op[0] for op in OPERATIONS]
+    if args.ops:
+        names = args.ops.split(',')
+        unknown = [name for name in names if name not in dict((op[0], op) for op in OPERATIONS)]
+        if unknown:
+            print("Unknown operations: " + ", ".join(unknown), file=sys.stderr)
+            sys.exit(1)
+
+    tmpdir = None
+    workspace = args.workdir
+    if workspace is None:
+        tmpdir = workspace = tempfile.mkdtemp(prefix='krita-bundler-bench-')
+    try:
+        started = time.perf_counter()
+        gen = generator.from_cmdline(args, workspace)
+        gen.write_all()
+        gen.write_bundle(join(workspace, 'test.bundle'))
+        generation_time = time.perf_counter() - started
+
+        results = dict()
+        warm = False
+        for name in names:
+            needs_cache = [op[2] for op in OPERATIONS if op[0] == name][0]
+            if needs_cache and not warm:
+                run_isolated('warm_cache', workspace)
+                warm = True
+            runs = [run_isolated(name, workspace) for _ in range(args.repeat)]
+            results[name] = min(runs, key=lambda r: r['wall_time'])
+            print("{}: {:.3f} s".format(name, results[name]['wall_time']), file=sys.stderr)
+
+        report = dict(
+            revision = git_revision(),
+            python = platform.python_version(),
+            platform = platform.platform(),
+            parameters = dict((k, v) for k, v in vars(args).items() if k not in ('output', 'workdir', 'ops')),
+            generation_time = generation_time,
+            results = results,
+        )
+        text = json.dumps(report, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(text + "\n")
+        else:
+            print(text)
+    finally:
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import sys
+import time
+import argparse
+import traceback
+import multiprocessing
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import redirect_stdout
+from glob import glob
+from os.path import join, dirname, abspath, isdir
+
+from extractor import KPP, prefetch_info
+from bundle import Bundle
+from bundleconfig import Config, BundleSettings
+import cache
+import profiling
+
+BuildResult = namedtuple('BuildResult', ['config', 'zipname', 'status', 'seconds', 'files', 'log'])
+
+def find_configs(paths):
+    """
+    Return list of config files given by paths, each listed once.
+    """
+    result = []
+    seen = set()
+    for path in paths:
+        if isdir(path):
+            configs = sorted(glob(join(path, '*.bundleconfig')))
+        else:
+            configs = [path]
+        for config in configs:
+            if abspath(config) in seen:
+                print("Warning: {} is given more than once".format(config))
+                continue
+            seen.add(abspath(config))
+            result.append(config)
+    return result
+
+def scan_sources(settings_list):
+    """
+    Walk each (directory, mask) used by configs once.
+    Return dictionary mapping (directory, mask) to list of files.
+    """
+    scanner = Bundle()
+    result = dict()
+    for settings in settings_list:
+        for mtype, directory, mask in settings.sources():
+            if directory and (directory, mask) not in result:
+                result[(directory, mask)] = scanner.get_files(directory, mask)
+    return result
+
+def parse_presets(settings_list, scanned, jobs):
+    """
+    Parse presets used by several configs once, in parallel, so that
+    builds find them in the cache.
+    """
+    paths = OrderedDict()
+    for settings in settings_list:
+        for mtype, directory, mask in settings.sources():
+            if mtype == 'paintoppresets' and directory:
+                for path in scanned[(directory, mask)]:
+                    paths[abspath(path)] = None
+    kpps = [KPP(path) for path in paths]
+    # messages are printed by the builds themselves
+    for kpp in kpps:
+        kpp.log = lambda message: None
+    prefetch_info(kpps, jobs)
+    for kpp in kpps:
+        kpp.get_info()
+    cache.get_cache().flush()
+    return len(kpps)
+
+def _init_worker(cache_enabled):
+    cache.configure(enabled=cache_enabled)
+
+def build_one(config, settings, scanned, incremental=False):
+    """
+    Build one bundle, with resource lists taken from scanned. Output is
+    captured and returned as part of BuildResult, so that output of builds
+    running in parallel is not mixed. Exceptions are reported, not raised.
+    """
+    started = time.perf_counter()
+    log = io.StringIO()
+    status = 'failed'
+    files = 0
+    try:
+        with redirect_stdout(log):
+            bundle = Bundle()
+            bundle.brushdir = settings.brushdir
+            bundle.patdir = settings.patdir
+            bundle.gradientdir = settings.gradientdir
+            for mtype, directory, mask in settings.sources():
+                if directory:
+                    for path in scanned[(directory, mask)]:
+                        bundle.add_resource_path(mtype, path)
+            ok = bundle.check(jobs=1, **settings.check_options())
+            if not ok:
+                print("Bundle contains references to resources outside the bundle. You probably need to put required resources to the bundle itself.")
+            stats = bundle.create(settings.zipname, settings.meta, settings.preview, jobs=1, incremental=incremental)
+            print(stats.report())
+            files = sum(len(names) for _, names in bundle.get_resource_lists())
+            status = 'ok' if ok else 'warnings'
+        cache.get_cache().flush()
+    except Exception:
+        log.write(traceback.format_exc())
+    return BuildResult(config, settings.zipname, status, time.perf_counter() - started, files, log.getvalue())
+
+def build_all(configs, jobs=1, incremental=False, cache_enabled=True):
+    """
+    Build bundles from config files in a pool of `jobs` processes (0 means
+    the number of CPUs). Directories are scanned and presets are parsed
+    once for all configs. Yields BuildResult for each config as builds
+    finish; a config which fails does not stop others.
+    """
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+
+    settings_list = []
+    zipnames = dict()
+    for config in configs:
+        started = time.perf_counter()
+        try:
+            # paths in config are relative to its directory
+            settings = BundleSettings.read(Config(config), jobs=1, basedir=dirname(config))
+            if settings.zipname is None:
+                raise ValueError("'Bundle file name' is not specified")
+            if abspath(settings.zipname) in zipnames:
+                raise ValueError("{} is built by {} as well".format(settings.zipname, zipnames[abspath(settings.zipname)]))
+        except Exception as e:
+            yield BuildResult(config, None, 'failed', time.perf_counter() - started, 0, "Error: {}\n".format(e))
+            continue
+        zipnames[abspath(settings.zipname)] = config
+        settings_list.append((config, settings))
+
+    with profiling.span('scan directories'):
+        scanned = scan_sources([settings for _, settings in settings_list])
+    if cache_enabled:
+        # without the cache builds could not use the results
+        with profiling.span('parse shared presets'):
+            parse_presets([settings for _, settings in settings_list], scanned, jobs)
+
+    with profiling.span('build'):
+        # fresh processes: the parent's cache connection must not be shared
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(max(1, jobs), mp_context=context, initializer=_init_worker, initargs=(cache_enabled,)) as pool:
+            futures = dict()
+            for config, settings in settings_list:
+                keys = set((directory, mask) for _, directory, mask in settings.sources() if directory)
+                sources = dict((key, scanned[key]) for key in keys)
+                futures[pool.submit(build_one, config, settings, sources, incremental)] = (config, settings)
+            for future in as_completed(futures):
+                config, settings = futures[future]
+                try:
+                    yield future.result()
+                except Exception as e:
+                    # i.e. worker process was killed
+                    yield BuildResult(config, settings.zipname, 'failed', 0.0, 0, "Error: {}\n".format(e))
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description="Build several bundles from their config files in parallel")
+    parser.add_argument('configs', metavar='PATH', nargs='+', help="Bundle config file, or directory with *.bundleconfig files")
+    parser.add_argument('-j', '--jobs', type=int, default=0, metavar='N', help="Number of bundles built in parallel; 0 means number of CPUs (default)")
+    parser.add_argument('-i', '--incremental', action='store_true', help="Copy resources that did not change from existing bundle files instead of writing them anew")
+    parser.add_argument('-q', '--quiet', action='store_true', help="Do not print output of successful builds")
+    cache.add_cmdline_options(parser)
+    profiling.add_cmdline_options(parser)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+
+    args = parse_cmdline()
+    cache.configure(enabled=not args.no_cache)
+    profiling.configure_from_args(args)
+
+    configs = find_configs(args.configs)
+    results = OrderedDict((config, None) for config in configs)
+    for result in build_all(configs, args.jobs, args.incremental, not args.no_cache):
+        results[result.config] = result
+        print("=== {}: {} in {:.2f} s".format(result.config, result.status, result.seconds))
+        if result.log and not (args.quiet and result.status == 'ok'):
+            print(result.log.rstrip("\n"))
+
+    print("\nSummary:")
+    failed = 0
+    for config, result in results.items():
+        if result.status == 'failed':
+            failed += 1
+        print("{:<10} {:8.2f} s {:6} files  {} -> {}".format(result.status, result.seconds, result.files, config, result.zipname or "-"))
+    print("{} bundles built, {} failed.".format(len(results) - failed, failed))
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,247 @@
+#!/usr/bin/python3
+# -*- encoding: utf-8 -*-
+
+import sys
+import json
+import argparse
+from collections import namedtuple, OrderedDict
+from zipfile import BadZipFile
+
+from lxml import etree
+
+from extractor import KPP
+from bundle import Manifest, MappedZip, MIMETYPE, META_NAMESPACE, DC_NAMESPACE
+
+# crc and size come from the central directory; they are None if the member is missing
+Entry = namedtuple('Entry', ['path', 'mtype', 'md5', 'crc', 'size'])
+
+PREFIXES = {META_NAMESPACE: 'meta', DC_NAMESPACE: 'dc'}
+
+def read_bundle(zipname):
+    """
+    Return (OrderedDict of full path => Entry, meta.xml data or None).
+    Only the central directory, the manifest and meta.xml are read.
+    """
+    with MappedZip(zipname) as zf:
+        names = zf.NameToInfo
+        manifest = Manifest.parse(zf.read("META-INF/manifest.xml"))
+        meta = bytes(zf.read("meta.xml")) if "meta.xml" in names else None
+    entries = OrderedDict()
+    for path, mtype, md5sum in manifest.entries():
+        if mtype == MIMETYPE:
+            continue
+        zinfo = names.get(path)
+        entries[path] = Entry(path, mtype, md5sum.lower() if md5sum else None,
+                              zinfo.CRC if zinfo is not None else None,
+                              zinfo.file_size if zinfo is not None else None)
+    return entries, meta
+
+def same_content(old, new):
+    """
+    Compare by md5 sums from manifests; if one of them is not known,
+    by CRC and size from central directories.
+    """
+    if old.md5 is not None and new.md5 is not None:
+        return old.md5 == new.md5
+    return old.crc is not None and (old.crc, old.size) == (new.crc, new.size)
+
+def meta_fields(data):
+    """
+    Return OrderedDict of fields of meta.xml: "dc:author", "meta:creation-date"
+    and so on, and names of user-defined fields ("email", "license"), mapped
+    to their values.
+    """
+    result = OrderedDict()
+    if data is None:
+        return result
+    try:
+        root = etree.fromstring(data)
+    except etree.XMLSyntaxError as e:
+        print("Warning: can not parse meta.xml: {}".format(e), file=sys.stderr)
+        return result
+    for element in root.iterchildren():
+        if not isinstance(element.tag, str):
+            # comments and processing instructions
+            continue
+        qname = etree.QName(element)
+        if qname.localname == 'meta-userdefined':
+            result[element.get("{"+META_NAMESPACE+"}name")] = element.get("{"+META_NAMESPACE+"}value")
+        else:
+            prefix = PREFIXES.get(qname.namespace, qname.namespace)
+            result["{}:{}".format(prefix, qname.localname)] = element.text
+    return result
+
+def diff_bundles(old_entries, new_entries, types=None):
+    """
+    Return dictionary with lists of added, removed and changed full paths,
+    renamed (old path, new path) pairs: resources removed from one place
+    and added to another with the same content, missing (path, where)
+    pairs: resources listed in manifests but missing from the archive of
+    old or new bundle or both, and unchanged count.
+    """
+    def selected(entries):
+        return OrderedDict((path, entry) for path, entry in entries.items() if not types or entry.mtype in types)
+    old_entries = selected(old_entries)
+    new_entries = selected(new_entries)
+
+    missing = []
+    for path, entry in old_entries.items():
+        if entry.crc is None:
+            in_new = new_entries.get(path)
+            missing.append((path, 'both' if in_new is not None and in_new.crc is None else 'old'))
+    for path, entry in new_entries.items():
+        if entry.crc is None and not (path in old_entries and old_entries[path].crc is None):
+            missing.append((path, 'new'))
+    missing_paths = set(path for path, _ in missing)
+
+    common = [path for path in new_entries if path in old_entries and path not in missing_paths]
+    changed = [path for path in common if not same_content(old_entries[path], new_entries[path])]
+    # entries missing from archives are reported only as missing
+    removed = [entry for path, entry in old_entries.items() if path not in new_entries and path not in missing_paths]
+    added = [entry for path, entry in new_entries.items() if path not in old_entries and path not in missing_paths]
+
+    # removed resources by content, to find renamed ones
+    by_md5 = dict()
+    by_crc = dict()
+    for entry in removed:
+        if entry.md5 is not None:
+            by_md5.setdefault((entry.mtype, entry.md5), []).append(entry)
+        if entry.crc is not None:
+            by_crc.setdefault((entry.mtype, entry.crc, entry.size), []).append(entry)
+    renamed = []
+    matched = set()
+    for entry in added:
+        candidates = by_md5.get((entry.mtype, entry.md5), []) if entry.md5 is not None else []
+        candidates = candidates + by_crc.get((entry.mtype, entry.crc, entry.size), [])
+        for old in candidates:
+            if old.path not in matched and same_content(old, entry):
+                matched.add(old.path)
+                renamed.append((old.path, entry.path))
+                break
+    renamed_to = set(new for _, new in renamed)
+
+    return dict(
+        added = [entry.path for entry in added if entry.path not in renamed_to],
+        removed = [entry.path for entry in removed if entry.path not in matched],
+        changed = changed,
+        renamed = renamed,
+        missing = missing,
+        unchanged = len(common) - len(changed),
+    )
+
+def diff_meta(old_data, new_data):
+    """
+    Return list of (field, old value, new value) of changed meta.xml fields;
+    values of added or removed fields are None.
+    """
+    old = meta_fields(old_data)
+    new = meta_fields(new_data)
+    result = []
+    for field in list(old) + [f for f in new if f not in old]:
+        if old.get(field) != new.get(field):
+            result.append((field, old.get(field), new.get(field)))
+    return result
+
+def preset_params(zf, path):
+    """
+    Return OrderedDict of preset attributes ("@name") and parameters, or
+    None if the preset can not be read.
+    """
+    try:
+        data = zf.read(path)
+    except KeyError:
+        print("Warning: {} is missing from {}".format(path, zf.filename), file=sys.stderr)
+        return None
+    kpp = KPP(path, data, log=lambda message: print("Warning: " + message, file=sys.stderr))
+    preset = kpp.check()
+    if preset is None:
+        return None
+    result = OrderedDict(("@" + name, value) for name, value in preset.attrib.items())
+    for param in preset.iter('param'):
+        result[param.get('name')] = param.text
+    return result
+
+def diff_presets(old_zipname, new_zipname, paths):
+    """
+    Return OrderedDict mapping full paths of presets to lists of
+    (parameter, old value, new value) of changed parameters.
+    """
+    result = OrderedDict()
+    with MappedZip(old_zipname) as old_zf, MappedZip(new_zipname) as new_zf:
+        for path in paths:
+            old = preset_params(old_zf, path)
+            new = preset_params(new_zf, path)
+            if old is None or new is None:
+                continue
+            changes = []
+            for name in list(old) + [n for n in new if n not in old]:
+                if old.get(name) != new.get(name):
+                    changes.append((name, old.get(name), new.get(name)))
+            result[path] = changes
+    return result
+
+def shorten(value, limit=60):
+    if value is None:
+        return "(none)"
+    value = repr(value)
+    if len(value) > limit:
+        value = value[:limit-3] + "..."
+    return value
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description="Compare two bundle files by their manifests, without extracting them")
+    parser.add_argument('old', metavar='OLD.BUNDLE', help="Old version of the bundle")
+    parser.add_argument('new', metavar='NEW.BUNDLE', help="New version of the bundle")
+    parser.add_argument('-t', '--type', action='append', dest='types', metavar='TYPE',
+                        help="Compare only resources of this type (brushes, patterns, gradients, paintoppresets); may be specified several times")
+    parser.add_argument('-d', '--deep', action='store_true', help="Show changed parameters of changed presets")
+    parser.add_argument('--json', action='store_true', help="Print differences as JSON")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+
+    args = parse_cmdline()
+
+    try:
+        old_entries, old_meta = read_bundle(args.old)
+        new_entries, new_meta = read_bundle(args.new)
+    except (BadZipFile, KeyError, OSError, etree.XMLSyntaxError) as e:
+        print("Error: can not read bundle: {}".format(e), file=sys.stderr)
+        sys.exit(2)
+
+    result = diff_bundles(old_entries, new_entries, args.types)
+    meta = diff_meta(old_meta, new_meta)
+    presets = OrderedDict()
+    if args.deep:
+        changed = [path for path in result['changed'] if new_entries[path].mtype == 'paintoppresets']
+        presets = diff_presets(args.old, args.new, changed)
+
+    if args.json:
+        report = dict(result)
+        report['missing'] = [dict(path=path, bundle=where) for path, where in result['missing']]
+        report['meta'] = [dict(field=field, old=old, new=new) for field, old, new in meta]
+        if args.deep:
+            report['presets'] = OrderedDict((path, [dict(param=name, old=old, new=new) for name, old, new in changes])
+                                            for path, changes in presets.items())
+        print(json.dumps(report, indent=2))
+    else:
+        for field, old, new in meta:
+            print("meta {}: {} -> {}".format(field, shorten(old), shorten(new)))
+        for path in result['removed']:
+            print("- {}".format(path))
+        for path in result['added']:
+            print("+ {}".format(path))
+        for old, new in result['renamed']:
+            print("R {} -> {}".format(old, new))
+        for path, where in result['missing']:
+            print("! {} (missing from {} bundle{})".format(path, where, "s" if where == 'both' else ""))
+        for path in result['changed']:
+            print("M {}".format(path))
+            for name, old, new in presets.get(path, []):
+                print("    {}: {} -> {}".format(name, shorten(old), shorten(new)))
+        print("{} added, {} removed, {} changed, {} renamed, {} missing, {} unchanged.".format(
+                len(result['added']), len(result['removed']), len(result['changed']), len(result['renamed']),
+                len(result['missing']), result['unchanged']))
+
+    if meta or result['added'] or result['removed'] or result['changed'] or result['renamed'] or result['missing']:
+        sys.exit(1)
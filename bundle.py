@@ -1,18 +1,29 @@
 # encoding: utf-8
 import os
+import io
 import sys
 from os.path import join, basename, dirname, isdir, isfile, expanduser
 import shutil
 import hashlib
+import struct
+import mmap
+import time
+import zlib
+import threading
 from fnmatch import fnmatch
 from glob import glob
-from zipfile import ZipFile, ZIP_STORED
+from zipfile import ZipFile, ZipInfo, BadZipFile, ZIP_STORED
 import tempfile
+from collections import OrderedDict, namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 #from xml.sax.saxutils import escape as xmlescape
 from lxml import etree
 from lxml.builder import ElementMaker
 
-from extractor import KPP
+from extractor import KPP, prefetch_info
+from cache import get_cache
+from preview import make_preview, PREVIEW_PRESETS
+import profiling
 
 VERSION="0.0.1"
 
@@ -61,66 +72,303 @@ class Meta(object):
               )
         return meta
 
+    @staticmethod
+    def parse(data):
+        """
+        Read fields from meta.xml. Fields missing from it keep default values.
+        """
+        meta = Meta()
+        root = etree.fromstring(bytes(data))
+        def text(namespace, tag, default):
+            element = root.find("{"+namespace+"}"+tag)
+            if element is None or element.text is None:
+                return default
+            return element.text
+        meta.author = text(DC_NAMESPACE, "author", meta.author)
+        meta.description = text(DC_NAMESPACE, "description", meta.description)
+        meta.initial_creator = text(META_NAMESPACE, "initial-creator", meta.author)
+        meta.creator = text(DC_NAMESPACE, "creator", meta.author)
+        meta.date = text(META_NAMESPACE, "creation-date", meta.date)
+        for element in root.iterfind("{"+META_NAMESPACE+"}meta-userdefined"):
+            name = element.get("{"+META_NAMESPACE+"}name")
+            if name in ("email", "license", "website"):
+                setattr(meta, name, element.get("{"+META_NAMESPACE+"}value", ""))
+        return meta
+
     def tostring(self):
         return etree.tostring(self.toxml(), xml_declaration=True, pretty_print=True, encoding="UTF-8")
 
-def md5(fname):
+# Size of chunks in which resource files are read
+CHUNK_SIZE = 1024*1024
+
+# Size of fixed part of zip local file header
+LOCAL_HEADER_SIZE = 30
+
+def md5_stream(stream):
     m = hashlib.md5()
-    f = open(fname, 'r')
-    s = f.read()
-    f.close()
-    m.update(s)
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        profiling.count('bytes read', len(chunk))
+        m.update(chunk)
     return m.hexdigest()
 
+def md5(fname):
+    with open(fname, 'rb') as f:
+        return md5_stream(f)
+
+_umask_lock = threading.Lock()
+
+def _get_umask():
+    # umask can only be read by setting it; archives may be replaced by parallel threads
+    with _umask_lock:
+        umask = os.umask(0)
+        os.umask(umask)
+    return umask
+
+def _open_zip(zipname, mode='r'):
+    profiling.count('zip opens')
+    return ZipFile(zipname, mode, ZIP_STORED)
+
+# Pages of mapped files are faulted in by aligned blocks of up to this size
+# (fault-around on Linux), so released ranges are extended to it
+MAP_FAULT_WINDOW = max(64*1024, mmap.PAGESIZE)
+
+class MappedZip(object):
+    """
+    Zip archive opened for reading, with the file mapped into memory.
+    Data of stored (not compressed) members is returned as memoryview slices
+    of the mapping, without copying, and without CRC check; compressed members
+    are read by zipfile as usual. The most used parts of ZipFile interface are
+    provided, so this can be passed where ZipFile opened for reading is expected.
+
+    Memory views returned stay valid after close(): the mapping is released
+    when the last of them is garbage collected.
+    """
+
+    def __init__(self, zipname):
+        self.zipfile = _open_zip(zipname)
+        self.filename = zipname
+        self._map = None
+        self._view = None
+        self._lock = threading.Lock()
+        # local headers are read from file, not from the mapping, so that
+        # pages of members which are never accessed are not touched
+        self._file = open(zipname, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)
+        except (OSError, ValueError):
+            # empty file, or the file system does not support mapping
+            pass
+
+    @property
+    def NameToInfo(self):
+        return self.zipfile.NameToInfo
+
+    @property
+    def comment(self):
+        return self.zipfile.comment
+
+    def infolist(self):
+        return self.zipfile.infolist()
+
+    def namelist(self):
+        return self.zipfile.namelist()
+
+    def getinfo(self, name):
+        return self.zipfile.getinfo(name)
+
+    def open(self, name, mode='r'):
+        return self.zipfile.open(name, mode)
+
+    def raw_range(self, zinfo):
+        """
+        Return (start, end) offsets of member's data as it is stored in the
+        archive (compressed, if the member is compressed), or None if the
+        archive is not mapped.
+        """
+        if self._view is None:
+            return None
+        start = zinfo.header_offset
+        with self._lock:
+            self._file.seek(start)
+            header = self._file.read(LOCAL_HEADER_SIZE)
+        if len(header) != LOCAL_HEADER_SIZE or header[:4] != b'PK\x03\x04':
+            raise BadZipFile("Bad local file header for {} in {}".format(zinfo.filename, self.filename))
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        start += LOCAL_HEADER_SIZE + name_length + extra_length
+        end = start + zinfo.compress_size
+        if end > len(self._view):
+            raise BadZipFile("Truncated member {} in {}".format(zinfo.filename, self.filename))
+        return start, end
+
+    def feed_range(self, start, end, consume):
+        """
+        Pass given part of the archive to consume() (i.e. stream.write or
+        md5.update) in chunks. Pages of the mapping are released afterwards:
+        they stay in the page cache, but are not counted in resident size of
+        this process.
+        """
+        while start < end:
+            # in chunks, so that resident size stays bounded for large members
+            stop = min(end, start + CHUNK_SIZE)
+            consume(self._view[start:stop])
+            if hasattr(mmap, 'MADV_DONTNEED'):
+                # the kernel maps pages around the faulting one as well
+                window_start = start - start % MAP_FAULT_WINDOW
+                self._map.madvise(mmap.MADV_DONTNEED, window_start, stop - window_start)
+            start = stop
+
+    def read(self, name):
+        """
+        Return memoryview of stored member, or bytes of compressed one.
+        """
+        zinfo = self.zipfile.getinfo(name)
+        if zinfo.compress_type == ZIP_STORED and not zinfo.flag_bits & 0x1:
+            data_range = self.raw_range(zinfo)
+            if data_range is not None:
+                start, end = data_range
+                profiling.count('bytes mapped', end - start)
+                return self._view[start:end]
+        data = self.zipfile.read(name)
+        profiling.count('bytes read', len(data))
+        return data
+
+    def md5(self, name, check_crc=False):
+        """
+        md5 sum of member's data. CRC of stored members is checked only if
+        check_crc is set (zipfile checks it for compressed ones); BadZipFile
+        is raised on mismatch. May be called from several threads at once.
+        """
+        zinfo = self.zipfile.getinfo(name)
+        if zinfo.compress_type == ZIP_STORED and not zinfo.flag_bits & 0x1 and self._view is not None:
+            start, end = self.raw_range(zinfo)
+            m = hashlib.md5()
+            if check_crc:
+                crc = [0]
+                def consume(chunk):
+                    m.update(chunk)
+                    crc[0] = zlib.crc32(chunk, crc[0])
+                self.feed_range(start, end, consume)
+                if crc[0] != zinfo.CRC:
+                    raise BadZipFile("Bad CRC-32 for file {!r}".format(name))
+            else:
+                self.feed_range(start, end, m.update)
+            profiling.count('bytes mapped', end - start)
+            return m.hexdigest()
+        with self.zipfile.open(name) as f:
+            return md5_stream(f)
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            try:
+                self._map.close()
+            except BufferError:
+                # some member views are still alive; the mapping goes away with them
+                pass
+            self._view = None
+            self._map = None
+        self._file.close()
+        self.zipfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
 class Manifest(object):
+    """
+    Contents of META-INF/manifest.xml. The XML is parsed once into an index
+    of entries by full path (media type and md5 sum of each) and lists of
+    full paths by media type; it is written back entry by entry.
+    """
+
     def __init__(self):
-        pass
-    
+        self.zipfile = None
+        self.basedir = None
+        self.version = "1.2"
+        # full path => (media type, md5 sum or None), in order of entries
+        self._entries = OrderedDict()
+        # media type => OrderedDict of full paths (used as ordered set)
+        self._by_type = dict()
+
     @staticmethod
     def new(zipfile=None, basedir=None):
         m = Manifest()
-        m._manifest = etree.Element(MANIFEST+"manifest", nsmap=NSMAP)
-        m._manifest.attrib[MANIFEST+"version"] = "1.2"
         m.manifest_entry(MIMETYPE, "/", add_md5=False)
         m.zipfile = zipfile
         m.basedir = basedir
         return m
 
     @staticmethod
+    @profiling.timed('parse manifest')
     def parse(data):
         m = Manifest()
-        m._manifest = etree.fromstring(data)
+        root = etree.fromstring(bytes(data))
+        m.version = root.get(MANIFEST+"version", m.version)
+        full_path, media_type, md5sum = MANIFEST+"full-path", MANIFEST+"media-type", MANIFEST+"md5sum"
+        for entry in root.iterchildren(MANIFEST+"file-entry"):
+            get = entry.get
+            m._add_entry(get(full_path), get(media_type), get(md5sum))
         return m
 
+    def _add_entry(self, path, mtype, md5sum):
+        old = self._entries.get(path)
+        if old is not None and old[0] != mtype:
+            del self._by_type[old[0]][path]
+        self._entries[path] = (mtype, md5sum)
+        paths = self._by_type.get(mtype)
+        if paths is None:
+            paths = self._by_type[mtype] = OrderedDict()
+        paths[path] = None
+
     def get_resources(self, mtype):
-        result = []
-        for entry in self._manifest.findall(MANIFEST+"file-entry"):
-            if entry.attrib[MANIFEST+"media-type"] == mtype:
-                result.append(entry.attrib[MANIFEST+"full-path"])
-        return result
+        return list(self._by_type.get(mtype, ()))
+
+    def entries(self):
+        """
+        Yield (full path, media type, md5 sum or None) of all entries.
+        """
+        for path, (mtype, md5sum) in self._entries.items():
+            yield path, mtype, md5sum
+
+    def get_md5(self, path):
+        entry = self._entries.get(path)
+        if entry is None:
+            return None
+        return entry[1]
+
+    def __contains__(self, path):
+        return path in self._entries
 
+    def __len__(self):
+        return len(self._entries)
+
+    @profiling.timed('md5')
     def md5(self, new_file_name, file_name_in_zip=None):
         if self.basedir is not None:
             new_file_name = join(self.basedir, new_file_name)
-        if self.zipfile is not None and file_name_in_zip is not None and file_name_in_zip in self.zipfile.namelist():
+        if self.zipfile is not None and file_name_in_zip is not None and file_name_in_zip in self.zipfile.NameToInfo:
             #print("calc md5 from zip: " + file_name_in_zip)
-            data = self.zipfile.read(file_name_in_zip)
-            m = hashlib.md5()
-            m.update(data)
-            return m.hexdigest()
+            if isinstance(self.zipfile, MappedZip):
+                return self.zipfile.md5(file_name_in_zip)
+            with self.zipfile.open(file_name_in_zip) as f:
+                return md5_stream(f)
         else:
             #print("calc md5 from " + new_file_name)
             return md5(new_file_name)
 
-    def manifest_entry(self, mtype, fname, add_md5=True):
+    def manifest_entry(self, mtype, fname, add_md5=True, md5sum=None):
         try:
             data_fname = join(mtype, basename(fname))
-            entry = etree.SubElement(self._manifest, MANIFEST+"file-entry")
-            entry.attrib[MANIFEST+"media-type"] = mtype
-            entry.attrib[MANIFEST+"full-path"] = data_fname
-            if add_md5:
-                entry.attrib[MANIFEST+"md5sum"] = self.md5(fname, data_fname)
-            return entry
+            if md5sum is None and add_md5:
+                md5sum = self.md5(fname, data_fname)
+            self._add_entry(data_fname, mtype, md5sum)
+            return data_fname
         except Exception as e:
             print("Error: can't encode manifest entry for media type {0}, file {1}: {2}".format(mtype, fname, e))
 
@@ -129,49 +377,637 @@ class Manifest(object):
 
     def remove_resource(self, mtype, resource):
         data_fname = join(mtype, basename(resource))
-        NS = {'m': MANIFEST_NAMESPACE}
-        #xpath = "m:file-entry[@m:media-type='{mtype}',@m:full-path='{path}']".format(path=data_fname, mtype=mtype)
-        xpath = "m:file-entry[@m:media-type='{mtype}']".format(path=data_fname, mtype=mtype)
-        for item in self._manifest.findall(xpath, namespaces=NS):
-            print(item.attrib[MANIFEST+'full-path'])
-            if item.attrib[MANIFEST+'full-path'] == data_fname:
-                print(etree.tostring(item))
+        entry = self._entries.get(data_fname)
+        if entry is not None and entry[0] == mtype:
+            del self._entries[data_fname]
+            del self._by_type[mtype][data_fname]
+
+    def _iter_attributes(self):
+        media_type, full_path, md5 = MANIFEST+"media-type", MANIFEST+"full-path", MANIFEST+"md5sum"
+        for path, (mtype, md5sum) in self._entries.items():
+            attrib = {media_type: mtype, full_path: path}
+            if md5sum is not None:
+                attrib[md5] = md5sum
+            yield attrib
 
     def to_xml(self):
-        return self._manifest
-    
+        root = etree.Element(MANIFEST+"manifest", nsmap=NSMAP)
+        root.attrib[MANIFEST+"version"] = self.version
+        for attrib in self._iter_attributes():
+            etree.SubElement(root, MANIFEST+"file-entry", attrib)
+        return root
+
+    def write(self, stream):
+        """
+        Write manifest XML to binary stream, entry by entry, without
+        building XML tree in memory.
+        """
+        with etree.xmlfile(stream, encoding="UTF-8") as xf:
+            xf.write_declaration()
+            write, element = xf.write, xf.element
+            with element(MANIFEST+"manifest", {MANIFEST+"version": self.version}, nsmap=NSMAP):
+                for attrib in self._iter_attributes():
+                    write("\n  ")
+                    with element(MANIFEST+"file-entry", attrib):
+                        pass
+                write("\n")
+
     def to_string(self):
-        return etree.tostring(self._manifest, xml_declaration=True, pretty_print=True, encoding="UTF-8")
+        stream = io.BytesIO()
+        self.write(stream)
+        return stream.getvalue()
+
+
+class BuildStats(object):
+    """
+    Time spent and bytes processed by stages of bundle writing.
+    Time of stages done by several threads is summed over threads.
+    """
+
+    STAGES = ['read', 'hash', 'write']
+
+    def __init__(self):
+        self.files = dict((stage, 0) for stage in self.STAGES)
+        self.bytes = dict((stage, 0) for stage in self.STAGES)
+        self.seconds = dict((stage, 0.0) for stage in self.STAGES)
+        self.threads = dict((stage, 1) for stage in self.STAGES)
+        self.waiting = 0.0
+        self.reused = 0
+        self.reused_bytes = 0
+
+    def add(self, stage, seconds, nbytes, files=1):
+        self.files[stage] += files
+        self.bytes[stage] += nbytes
+        self.seconds[stage] += seconds
+
+    def report(self):
+        lines = []
+        for stage in self.STAGES:
+            # effective wall time of the stage, if its threads were kept busy
+            seconds = self.seconds[stage] / self.threads[stage]
+            if seconds > 0:
+                rate = "{:.1f} files/s, {:.1f} MB/s".format(self.files[stage] / seconds, self.bytes[stage] / seconds / 1e6)
+            else:
+                rate = "n/a"
+            lines.append("{:<6} {} files, {:.1f} MB, {:.2f} s x {} thread(s): {}".format(
+                stage + ":", self.files[stage], self.bytes[stage] / 1e6, seconds, self.threads[stage], rate))
+        if self.reused:
+            lines.append("{} files, {:.1f} MB copied unchanged from previous bundle".format(self.reused, self.reused_bytes / 1e6))
+        if self.waiting:
+            lines.append("writer waited for input for {:.2f} s".format(self.waiting))
+        return "\n".join(lines)
+
+def _prefetch_file(path, arcname, max_size, cache):
+    """
+    Read and hash file in worker thread. Files larger than max_size are
+    not read, they are streamed by the writer instead.
+    """
+    # stat before reading, so that changes made while reading invalidate the key
+    digest_key = cache.digest_key(path)
+    zinfo = ZipInfo.from_file(path, arcname)
+    zinfo.compress_type = ZIP_STORED
+    if zinfo.file_size > max_size:
+        return zinfo, None, None, digest_key, 0.0, 0.0
+    started = time.perf_counter()
+    with open(path, 'rb') as f:
+        data = f.read()
+    read = time.perf_counter()
+    profiling.count('bytes read', len(data))
+    md5sum = hashlib.md5(data).hexdigest()
+    hashed = time.perf_counter()
+    return zinfo, data, md5sum, digest_key, read - started, hashed - read
+
+# Default limit for resource data read ahead of the writer, in bytes
+DEFAULT_PREFETCH_BUDGET = 64*1024*1024
+
+class BundleWriter(object):
+    """
+    Writes new bundle file in one pass. Each resource file is read once,
+    in chunks; its md5 sum is calculated while it is being written (zipfile
+    calculates CRC on the way as well). The manifest is written last, when
+    all md5 sums are known.
+    """
+
+    def __init__(self, zipname, manifest=None):
+        self.zipname = zipname
+        self.zipfile = _open_zip(zipname, 'w')
+        if manifest is None:
+            manifest = Manifest.new()
+        self.manifest = manifest
+        self.stats = BuildStats()
+        self._previous = None
+        self._unchanged = None
+        self.zipfile.writestr("mimetype", MIMETYPE)
+
+    def writestr(self, arcname, data):
+        self.zipfile.writestr(arcname, data)
+
+    def write(self, path, arcname):
+        """
+        Copy file into the archive and return its md5 sum.
+        """
+        zinfo = ZipInfo.from_file(path, arcname)
+        zinfo.compress_type = ZIP_STORED
+        return self._write(path, zinfo)
+
+    def _write(self, path, zinfo):
+        stats = self.stats
+        timings = dict(read=0.0, hash=0.0, write=0.0)
+        m = hashlib.md5()
+        with open(path, 'rb') as src, self.zipfile.open(zinfo, 'w') as dst:
+            while True:
+                t0 = time.perf_counter()
+                chunk = src.read(CHUNK_SIZE)
+                t1 = time.perf_counter()
+                if not chunk:
+                    break
+                m.update(chunk)
+                t2 = time.perf_counter()
+                dst.write(chunk)
+                t3 = time.perf_counter()
+                timings['read'] += t1 - t0
+                timings['hash'] += t2 - t1
+                timings['write'] += t3 - t2
+        for stage, seconds in timings.items():
+            stats.add(stage, seconds, zinfo.file_size)
+        profiling.count('bytes read', zinfo.file_size)
+        profiling.count('bytes written', zinfo.file_size)
+        return m.hexdigest()
+
+    def copy_raw(self, source, zinfo, arcname=None):
+        """
+        Copy member of another archive (ZipFile or MappedZip) as is, under
+        the same name unless arcname is given: compressed bytes are not
+        decompressed, CRC is not recalculated.
+        """
+        data_range = None
+        if isinstance(source, MappedZip):
+            data_range = source.raw_range(zinfo)
+            if data_range is None:
+                source = source.zipfile
+        if data_range is None:
+            fp = source.fp
+            fp.seek(zinfo.header_offset)
+            header = fp.read(LOCAL_HEADER_SIZE)
+            if len(header) != LOCAL_HEADER_SIZE or header[:4] != b'PK\x03\x04':
+                raise BadZipFile("Bad local file header for {} in {}".format(zinfo.filename, source.filename))
+            name_length, extra_length = struct.unpack('<HH', header[26:30])
+            fp.seek(name_length + extra_length, os.SEEK_CUR)
+
+        new = ZipInfo(arcname or zinfo.filename, zinfo.date_time)
+        new.compress_type = zinfo.compress_type
+        new.create_system = zinfo.create_system
+        new.external_attr = zinfo.external_attr
+        new.comment = zinfo.comment
+        new.CRC = zinfo.CRC
+        new.file_size = zinfo.file_size
+        new.compress_size = zinfo.compress_size
+        # sizes are known in advance, so there is no data descriptor after the data;
+        # extra fields (zip64 sizes among them) are regenerated by zipfile
+        new.flag_bits = zinfo.flag_bits & ~0x08
+
+        # zipfile has no public API for writing precompressed data
+        zf = self.zipfile
+        zf._writecheck(new)
+        zf._didModify = True
+        new.header_offset = zf.fp.tell()
+        zf.fp.write(new.FileHeader())
+        remaining = zinfo.compress_size
+        if data_range is not None:
+            source.feed_range(data_range[0], data_range[1], zf.fp.write)
+            remaining = 0
+        while remaining > 0:
+            chunk = fp.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                raise BadZipFile("Truncated member {} in {}".format(zinfo.filename, source.filename))
+            zf.fp.write(chunk)
+            remaining -= len(chunk)
+        profiling.count('bytes copied raw', zinfo.compress_size)
+        zf.start_dir = zf.fp.tell()
+        zf.filelist.append(new)
+        zf.NameToInfo[new.filename] = new
+
+    def set_previous(self, zipfile, unchanged=None):
+        """
+        Set previous version of the bundle (ZipFile or MappedZip).
+        Resource files which are known to be unchanged since they were put
+        into it are then copied from it as is, without reading them.
+        unchanged is an optional set of paths of files which the caller
+        knows to be unchanged (i.e. from watching them); other files are
+        looked up in the cache.
+        """
+        try:
+            manifest = Manifest.parse(zipfile.read("META-INF/manifest.xml"))
+        except KeyError:
+            return
+        self._previous = (zipfile, manifest)
+        self._unchanged = unchanged
 
+    def find_reusable(self, mtype, path):
+        """
+        Return (zipinfo, md5) of resource in the previous version of the
+        bundle, if the file has the same md5 sum as recorded in its manifest,
+        or None. The md5 sum of the file is taken from the cache, which is
+        keyed by file size, mtime and inode, so the file is not read.
+        """
+        if self._previous is None:
+            return None
+        zin, manifest = self._previous
+        arcname = join(mtype, basename(path))
+        zinfo = zin.NameToInfo.get(arcname)
+        old_md5 = manifest.get_md5(arcname)
+        if zinfo is None or old_md5 is None:
+            return None
+        if self._unchanged is not None and path in self._unchanged:
+            return zinfo, old_md5
+        cache = get_cache()
+        if cache.get(cache.digest_key(path)) != old_md5:
+            return None
+        return zinfo, old_md5
+
+    def reuse(self, mtype, reusable):
+        zinfo, md5sum = reusable
+        self.copy_raw(self._previous[0], zinfo)
+        self.manifest.manifest_entry(mtype, zinfo.filename, md5sum=md5sum)
+        self.stats.reused += 1
+        self.stats.reused_bytes += zinfo.file_size
+
+    def add_file(self, mtype, path):
+        """
+        Copy resource file into the archive and add it to the manifest.
+        """
+        arcname = join(mtype, basename(path))
+        reusable = self.find_reusable(mtype, path)
+        if reusable is not None:
+            self.reuse(mtype, reusable)
+            return arcname
+        cache = get_cache()
+        digest_key = cache.digest_key(path)
+        md5sum = self.write(path, arcname)
+        cache.put(digest_key, md5sum)
+        self.manifest.manifest_entry(mtype, arcname, md5sum=md5sum)
+        return arcname
+
+    @profiling.timed('write resources')
+    def add_files(self, files, jobs=1, prefetch_budget=DEFAULT_PREFETCH_BUDGET):
+        """
+        Add resource files, given as list of (mtype, path), in this order.
+        With jobs > 1 files are read and hashed by a pool of threads ahead of
+        the writer; at most 2*jobs files, each up to prefetch_budget/(2*jobs)
+        bytes, are kept in memory. Larger files are streamed by the writer.
+        """
+        if jobs == 0:
+            jobs = os.cpu_count() or 1
+        if jobs <= 1:
+            for mtype, path in files:
+                self.add_file(mtype, path)
+            return
+
+        depth = 2 * jobs
+        max_size = prefetch_budget // depth
+        cache = get_cache()
+        stats = self.stats
+        stats.threads['read'] = stats.threads['hash'] = jobs
+        queue = deque()
+        files = iter(files)
+        with ThreadPoolExecutor(jobs) as pool:
+            def fill():
+                while len(queue) < depth:
+                    try:
+                        mtype, path = next(files)
+                    except StopIteration:
+                        return
+                    reusable = self.find_reusable(mtype, path)
+                    if reusable is not None:
+                        queue.append((mtype, path, reusable))
+                    else:
+                        arcname = join(mtype, basename(path))
+                        queue.append((mtype, path, pool.submit(_prefetch_file, path, arcname, max_size, cache)))
+
+            fill()
+            while queue:
+                mtype, path, future = queue.popleft()
+                if isinstance(future, tuple):
+                    self.reuse(mtype, future)
+                    fill()
+                    continue
+                started = time.perf_counter()
+                zinfo, data, md5sum, digest_key, read_time, hash_time = future.result()
+                stats.waiting += time.perf_counter() - started
+                fill()
+                if data is None:
+                    md5sum = self._write(path, zinfo)
+                else:
+                    stats.add('read', read_time, len(data))
+                    stats.add('hash', hash_time, len(data))
+                    started = time.perf_counter()
+                    self.zipfile.writestr(zinfo, data)
+                    stats.add('write', time.perf_counter() - started, len(data))
+                    profiling.count('bytes written', len(data))
+                    del data
+                cache.put(digest_key, md5sum)
+                self.manifest.manifest_entry(mtype, zinfo.filename, md5sum=md5sum)
+
+    def close(self):
+        with profiling.span('write manifest'):
+            if self.manifest is not None:
+                with self.zipfile.open("META-INF/manifest.xml", 'w') as stream:
+                    self.manifest.write(stream)
+            self.zipfile.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.zipfile.close()
+
+ResolvedResource = namedtuple('ResolvedResource', ['source', 'path', 'is_bundle'])
+
+class ResourceResolver(object):
+    """
+    Index of resource files available in a list of sources (directories and
+    bundle files). Sources are scanned once: top level of each directory and
+    central directory of each bundle. Earlier sources take precedence.
+    Bundles are kept open until close() is called.
+    """
+
+    @profiling.timed('index sources')
+    def __init__(self, sources):
+        self.sources = list(sources)
+        self._index = dict()
+        self._zipfiles = dict()
+        for src in self.sources:
+            if isfile(src) and src.endswith(".bundle"):
+                self._scan_bundle(src)
+            elif isdir(src):
+                self._scan_directory(src)
+            else:
+                print("Error: {} is not a directory and is not a bundle file".format(src))
+
+    def _scan_directory(self, directory):
+        for name in os.listdir(directory):
+            path = join(directory, name)
+            if isfile(path):
+                # resources in plain directories are not sorted by type
+                self._index.setdefault((None, name), ResolvedResource(directory, path, False))
+
+    def _scan_bundle(self, bundle):
+        zf = _open_zip(bundle)
+        self._zipfiles[bundle] = zf
+        for item in zf.infolist():
+            if item.is_dir() or '/' not in item.filename:
+                continue
+            mtype = item.filename.split('/', 1)[0]
+            name = basename(item.filename)
+            self._index.setdefault((mtype, name), ResolvedResource(bundle, item.filename, True))
+
+    def find(self, mtype, name):
+        """
+        Return ResolvedResource for resource of given type, or None.
+        """
+        name = basename(name)
+        found = [r for r in (self._index.get((mtype, name)), self._index.get((None, name))) if r is not None]
+        if not found:
+            return None
+        # respect order of sources if resource is found both in a directory and a bundle
+        return min(found, key=lambda r: self.sources.index(r.source))
+
+    def extract(self, mtype, name, target_path):
+        """
+        Copy resource to target_path. Returns False if there is no such resource.
+        """
+        resource = self.find(mtype, name)
+        if resource is None:
+            return False
+        if resource.is_bundle:
+            print("Extracting {} from bundle {}".format(resource.path, resource.source))
+            with self._zipfiles[resource.source].open(resource.path) as src, open(target_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        else:
+            shutil.copy(resource.path, target_path)
+        return True
+
+    def close(self):
+        for zf in self._zipfiles.values():
+            zf.close()
+        self._zipfiles = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# Default limit for member data kept in memory by lazily opened bundles,
+# in bytes. Enough when every preset is parsed only once.
+DEFAULT_MEMORY_BUDGET = 16*1024*1024
+
+class BundleMembers(object):
+    """
+    On-demand access to members of bundle file, which is mapped into memory
+    (see MappedZip). Stored members are returned as memory views of the
+    mapping and are not counted against the budget. Bytes of compressed
+    members are kept in memory, but if memory_budget (in bytes) is specified,
+    least recently used ones are dropped to stay within it.
+    """
+
+    def __init__(self, zipname, memory_budget=None):
+        self.zipname = zipname
+        self.memory_budget = memory_budget
+        self._zipfile = None
+        self._names = None
+        self._cache = OrderedDict()
+        self._cached_size = 0
+
+    @property
+    def zipfile(self):
+        if self._zipfile is None:
+            self._zipfile = MappedZip(self.zipname)
+            self._names = set(self._zipfile.namelist())
+        return self._zipfile
+
+    def __contains__(self, name):
+        self.zipfile
+        return name in self._names
+
+    def read(self, name):
+        data = self._cache.get(name)
+        if data is not None:
+            self._cache.move_to_end(name)
+            return data
+        data = self.zipfile.read(name)
+        if isinstance(data, memoryview):
+            # the page cache keeps it for us
+            return data
+        budget = self.memory_budget
+        if budget is None or len(data) <= budget:
+            self._cache[name] = data
+            self._cached_size += len(data)
+            while budget is not None and self._cached_size > budget:
+                _, dropped = self._cache.popitem(last=False)
+                self._cached_size -= len(dropped)
+        return data
+
+    def close(self):
+        """
+        Close the archive. It will be reopened on next access; this is
+        used after the bundle file is rewritten.
+        """
+        if self._zipfile is not None:
+            self._zipfile.close()
+        self._zipfile = None
+        self._names = None
+        self._cache.clear()
+        self._cached_size = 0
+
+class LazyKPP(KPP):
+    """
+    Preset stored in bundle file. Its data is read on first access.
+    """
+
+    def __init__(self, members, filename, md5=None):
+        self._members = members
+        KPP.__init__(self, filename, None, md5)
+
+    @property
+    def data(self):
+        if self._data is not None:
+            return self._data
+        return self._members.read(self.filename)
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+
+# Members of a bundle which are not listed in its manifest
+SERVICE_MEMBERS = ("mimetype", "meta.xml", "preview.png", "META-INF/manifest.xml")
+
+# member is None for problems of the bundle as a whole
+VerifyProblem = namedtuple('VerifyProblem', ['member', 'kind', 'message'])
+
+class VerifyResult(object):
+    """
+    Problems found by Bundle.verify() in one bundle file.
+    """
+
+    def __init__(self, zipname):
+        self.zipname = zipname
+        self.problems = []
+        self.members = 0
+        self.bytes = 0
+
+    @property
+    def ok(self):
+        return not self.problems
+
+    def add(self, member, kind, message):
+        self.problems.append(VerifyProblem(member, kind, message))
+
+    def to_dict(self):
+        return dict(bundle=self.zipname, ok=self.ok, members=self.members, bytes=self.bytes,
+                    problems=[problem._asdict() for problem in self.problems])
+
+def _verify_member(zf, path, mtype, md5sum, check_presets):
+    """
+    Return list of (kind, message) of problems with one member of the bundle.
+    """
+    problems = []
+    try:
+        actual = zf.md5(path, check_crc=True)
+    except (BadZipFile, zlib.error, OSError, EOFError) as e:
+        return [('corrupt', "can not read: {}".format(e))]
+    if md5sum is None:
+        problems.append(('no md5', "manifest does not contain md5 sum"))
+    elif actual != md5sum.lower():
+        problems.append(('md5 mismatch', "md5 sum is {}, manifest says {}".format(actual, md5sum)))
+    if check_presets and mtype == 'paintoppresets':
+        messages = []
+        if KPP(path, zf.read(path), log=messages.append).check() is None:
+            problems.append(('bad preset', " ".join(messages)))
+    return problems
+
+# resource types => how they are called in messages
+RESOURCE_KINDS = dict(brushes='brush', patterns='pattern', gradients='gradient')
 
 class Bundle(object):
     def __init__(self):
         self.brushes = []
         self.presets = []
         self.patterns = []
+        self.gradients = []
         self.presets_data = None
+        # where resources added by check() are put
+        self.brushdir = None
+        self.patdir = None
+        self.gradientdir = None
         self.meta = None
         self.meta_string = None
         self.preview_data = None
+        self._members = None
+        self._index = None
+
+    @property
+    def meta_string(self):
+        if self._meta_string is None and self._members is not None and "meta.xml" in self._members:
+            self._meta_string = bytes(self._members.zipfile.read("meta.xml"))
+        return self._meta_string
+
+    @meta_string.setter
+    def meta_string(self, value):
+        self._meta_string = value
+
+    @property
+    def preview_data(self):
+        if self._preview_data is None and self._members is not None and "preview.png" in self._members:
+            self._preview_data = bytes(self._members.zipfile.read("preview.png"))
+        return self._preview_data
+
+    @preview_data.setter
+    def preview_data(self, value):
+        self._preview_data = value
+
+    def close(self):
+        if self._members is not None:
+            self._members.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     @staticmethod
     def get_presets(zipname):
-        zf = ZipFile(zipname, 'r')
+        zf = MappedZip(zipname)
         m = zf.read('META-INF/manifest.xml')
         manifest = Manifest.parse(m)
 
         result = []
         for preset in manifest.get_resources('paintoppresets'):
             data = zf.read(preset)
-            kpp = KPP(preset, data)
+            kpp = KPP(preset, data, manifest.get_md5(preset))
             result.append(kpp)
             
         zf.close()
         return result
 
     @staticmethod
-    def open(zipname):
-        zf = ZipFile(zipname, 'r')
+    @profiling.timed('open bundle')
+    def open(zipname, lazy=False, memory_budget=None):
+        """
+        Read bundle file. In lazy mode only the zip directory and the manifest
+        are read; preset data, meta.xml and preview.png are read on first
+        access, and the archive is kept open until close() is called.
+        """
+        if lazy:
+            members = BundleMembers(zipname, memory_budget)
+            zf = members.zipfile
+        else:
+            zf = MappedZip(zipname)
+        names = zf.NameToInfo
         m = zf.read('META-INF/manifest.xml')
         manifest = Manifest.parse(m)
 
@@ -181,31 +1017,127 @@ class Bundle(object):
         result = Bundle()
         result.presets_data = []
         for preset in manifest.get_resources('paintoppresets'):
-            if preset in zf.namelist():
+            if preset in names:
                 result.presets.append(preset)
-                data = zf.read(preset)
-                kpp = KPP(preset, data)
+                if lazy:
+                    kpp = LazyKPP(members, preset, manifest.get_md5(preset))
+                else:
+                    data = zf.read(preset)
+                    kpp = KPP(preset, data, manifest.get_md5(preset))
                 result.presets_data.append(kpp)
             else:
                 warn(preset)
 
-        result.meta_string = zf.read("meta.xml")
-        result.preview_data = zf.read("preview.png")
+        if lazy:
+            result._members = members
+        else:
+            result.meta_string = bytes(zf.read("meta.xml"))
+            result.preview_data = bytes(zf.read("preview.png"))
 
         for brush in manifest.get_resources('brushes'):
-            if brush in zf.namelist():
+            if brush in names:
                 result.brushes.append(brush)
             else:
                 warn(brush)
         for pattern in manifest.get_resources('patterns'):
-            if pattern in zf.namelist():
+            if pattern in names:
                 result.patterns.append(pattern)
             else:
                 warn(pattern)
+        for gradient in manifest.get_resources('gradients'):
+            if gradient in names:
+                result.gradients.append(gradient)
+            else:
+                warn(gradient)
             
-        zf.close()
+        if not lazy:
+            zf.close()
+        return result
+
+    @staticmethod
+    @profiling.timed('verify')
+    def verify(zipname, jobs=1, fail_fast=False, check_presets=True):
+        """
+        Check integrity of bundle file: mimetype, manifest and meta.xml,
+        that all members listed in the manifest are present and match their
+        md5 sums, that there are no members not listed in the manifest, and,
+        if check_presets is set, that presets contain readable preset XML.
+        Members are hashed in `jobs` threads (0 means the number of CPUs),
+        reading them in chunks. With fail_fast, stop at the first problem.
+        Returns VerifyResult.
+        """
+        result = VerifyResult(zipname)
+        try:
+            zf = MappedZip(zipname)
+        except (BadZipFile, OSError) as e:
+            result.add(None, 'bad archive', "can not open: {}".format(e))
+            return result
+        with zf:
+            Bundle._verify_archive(zf, result, jobs, fail_fast, check_presets)
         return result
 
+    @staticmethod
+    def _verify_archive(zf, result, jobs, fail_fast, check_presets):
+        names = zf.NameToInfo
+
+        infos = zf.infolist()
+        if "mimetype" not in names:
+            result.add("mimetype", 'missing', "bundle does not contain mimetype")
+        elif bytes(zf.read("mimetype")) != MIMETYPE.encode('ascii'):
+            result.add("mimetype", 'bad mimetype', "mimetype is not {}".format(MIMETYPE))
+        elif infos[0].filename != "mimetype" or infos[0].compress_type != ZIP_STORED:
+            result.add("mimetype", 'bad mimetype', "mimetype must be the first member, stored without compression")
+        if fail_fast and not result.ok:
+            return
+
+        for name in ("meta.xml", "preview.png", "META-INF/manifest.xml"):
+            if name not in names:
+                result.add(name, 'missing', "bundle does not contain {}".format(name))
+        if "meta.xml" in names:
+            try:
+                etree.fromstring(bytes(zf.read("meta.xml")))
+            except (etree.XMLSyntaxError, BadZipFile, zlib.error) as e:
+                result.add("meta.xml", 'bad meta', "can not parse meta.xml: {}".format(e))
+        if fail_fast and not result.ok or "META-INF/manifest.xml" not in names:
+            return
+        try:
+            manifest = Manifest.parse(zf.read("META-INF/manifest.xml"))
+        except (etree.XMLSyntaxError, BadZipFile, zlib.error) as e:
+            result.add("META-INF/manifest.xml", 'bad manifest', "can not parse manifest: {}".format(e))
+            return
+
+        todo = []
+        for path, mtype, md5sum in manifest.entries():
+            if mtype == MIMETYPE:
+                continue
+            if path in names:
+                todo.append((path, mtype, md5sum))
+            else:
+                result.add(path, 'missing', "member listed in manifest is not found")
+                if fail_fast:
+                    return
+        for name in names:
+            if name not in manifest and name not in SERVICE_MEMBERS and not name.endswith('/'):
+                result.add(name, 'orphan', "member is not listed in manifest")
+                if fail_fast:
+                    return
+
+        if jobs == 0:
+            jobs = os.cpu_count() or 1
+        with profiling.span('hash members'), ThreadPoolExecutor(max(1, jobs)) as pool:
+            futures = [pool.submit(_verify_member, zf, path, mtype, md5sum, check_presets)
+                       for path, mtype, md5sum in todo]
+            for (path, _, _), future in zip(todo, futures):
+                for kind, message in future.result():
+                    result.add(path, kind, message)
+                result.members += 1
+                result.bytes += names[path].file_size
+                if fail_fast and not result.ok:
+                    for other in futures:
+                        other.cancel()
+                    break
+        profiling.count('members verified', result.members)
+
     def fnmatch(self, name, mask):
         masks = mask.split(";")
         for m in masks:
@@ -213,6 +1145,7 @@ class Bundle(object):
                 return True
         return False
 
+    @profiling.timed('walk directories')
     def get_files(self, dir, masks):
         result = []
         for (d, _, files) in os.walk(dir):
@@ -228,78 +1161,118 @@ class Bundle(object):
     def read_brushes(self, brushdir, mask):
         if not brushdir:
             return
-        self.brushes.extend(self.get_files(brushdir, mask))
+        for path in self.get_files(brushdir, mask):
+            self.add_resource_path('brushes', path)
 
     def read_presets(self, presetsdir, mask):
         if not presetsdir:
             return
-        self.presets.extend(self.get_files(presetsdir, mask))
+        for path in self.get_files(presetsdir, mask):
+            self.add_resource_path('paintoppresets', path)
 
     def read_patterns(self, patdir, mask):
         if not patdir:
             return
-        self.brushes.extend(self.get_files(patdir, mask))
+        for path in self.get_files(patdir, mask):
+            self.add_resource_path('patterns', path)
+
+    def read_gradients(self, gradientdir, mask):
+        if not gradientdir:
+            return
+        for path in self.get_files(gradientdir, mask):
+            self.add_resource_path('gradients', path)
+
+    def get_index(self, mtype):
+        """
+        Return dictionary mapping basenames of resources of given type
+        to their paths. If there are several resources with the same
+        basename, the first one wins.
+        """
+        if self._index is None:
+            self._index = dict()
+            for rtype, names in self.get_resource_lists():
+                index = self._index[rtype] = dict()
+                for name in names:
+                    index.setdefault(basename(name), name)
+        return self._index[mtype]
+
+    def reindex(self):
+        """
+        Must be called after resource lists are changed directly.
+        """
+        self._index = None
+
+    def add_resource_path(self, mtype, path):
+        self.get_resource_list(mtype).append(path)
+        if self._index is not None:
+            self._index[mtype].setdefault(basename(path), path)
+
+    def find_resource(self, mtype, name):
+        """
+        Return path of resource of given type with the same basename as name,
+        or None if there is no such resource.
+        """
+        return self.get_index(mtype).get(basename(name))
 
     def find_brush(self, name):
-        #print("Checking for {}".format(name))
-        for brush in self.brushes:
-            #print("Checking {}".format(brush))
-            if basename(brush) == basename(name):
-                #print("Found")
-                return True
-        return False
+        return self.find_resource('brushes', name) is not None
 
-    def unpack_from_bundle(self, bundle, target_directory, resource):
-        zf = ZipFile(bundle, 'r')
-        #print(zf.namelist())
-        path = join(target_directory, resource)
-        if path not in zf.namelist():
-            return False
-        print("Extracting {} from bundle {}".format(resource, bundle))
-        zf.extract(path)
-        zf.close()
-        return True
+    def get_resource_dir(self, mtype):
+        """
+        Directory where resources of given type added by check() are put.
+        """
+        directory = dict(brushes=self.brushdir, patterns=self.patdir, gradients=self.gradientdir).get(mtype)
+        return directory or mtype
 
+    @profiling.timed('auto add')
     def auto_add(self, mtype, target_directory, sources, resource):
+        """
+        Copy resource from one of sources (list of directories and bundle
+        files, or ResourceResolver built from it) to target_directory and
+        add it to the bundle.
+        """
+        if not isinstance(sources, ResourceResolver):
+            sources = ResourceResolver(sources)
+        if sources.find(mtype, resource) is None:
+            return False
+
         if not isdir(target_directory):
             os.makedirs(target_directory)
+        target_path = join(target_directory, basename(resource))
+        sources.extract(mtype, resource, target_path)
+        self.add_resource_path(mtype, target_path)
+        return True
 
-        target_path = join(target_directory, resource)
-
-        found = False
-        for src in sources:
-            if isfile(src) and src.endswith(".bundle"):
-                found = self.unpack_from_bundle(src, target_directory, resource)
-            elif isdir(src):
-                path = join(src, basename(resource))
-                if not isfile(path):
-                    continue
-                shutil.copy(path, target_path)
-                found = True
-            else:
-                print("Error: {} is not a directory and is not a bundle file")
-                continue
-            if found:
-                if mtype == 'brushes':
-                    self.brushes.append(target_path)
-                break
-        return found
-
-    def check(self, skip_bad=False, skip_unused_brushes=False, resourcedir=None):
+    @profiling.timed('check')
+    def check(self, skip_bad=False, skip_unused_brushes=False, resourcedir=None, jobs=1, kpps=None):
+        """
+        Check that presets refer to brushes, patterns and gradients present
+        in the bundle. Missing resources are added from resourcedir, if it
+        is given (see auto_add()), to directories returned by
+        get_resource_dir().
+        kpps is an optional dictionary mapping preset paths to KPP objects
+        to be reused (they keep parsed preset info); KPP objects created for
+        presets not in it are added to it.
+        """
         result = True
         presets = []
         used_brushes = set()
+        if kpps is None:
+            kpps = dict()
         for fname in self.presets:
+            if fname not in kpps:
+                kpps[fname] = KPP(fname)
+        kpps = [kpps[fname] for fname in self.presets]
+        prefetch_info(kpps, jobs)
+        resolver = None
+        if resourcedir is not None:
+            resolver = ResourceResolver(resourcedir)
+        for fname, kpp in zip(self.presets, kpps):
             add = True
-            #print("Checking {}".format(fname))
-            kpp = KPP(fname)
-            links = kpp.get_links()
-            requiredBrushFile = links.get('requiredBrushFile', None)
-            #print("Required brush file: {}".format(requiredBrushFile))
-            if requiredBrushFile:
-                ok = self.find_brush(requiredBrushFile)
-                if not ok:
-                    warning = "Warning: required brush file {} not found for preset {}".format(requiredBrushFile, fname)
+            for mtype, name in kpp.get_references():
+                kind = RESOURCE_KINDS.get(mtype, mtype)
+                if self.find_resource(mtype, name) is None:
+                    warning = "Warning: required {} file {} not found for preset {}".format(kind, name, fname)
                     if resourcedir is None:
                         print(warning)
                         if skip_bad:
@@ -307,21 +1280,25 @@ class Bundle(object):
 
                         result = False
                     else:
-                        added = self.auto_add('brushes', self.brushdir, resourcedir, requiredBrushFile)
+                        added = self.auto_add(mtype, self.get_resource_dir(mtype), resolver, name)
                         if added:
-                            print("Adding missing brush file {} for preset {}".format(requiredBrushFile, fname))
+                            print("Adding missing {} file {} for preset {}".format(kind, name, fname))
                         else:
                             print(warning)
                         result = result and added
-                        if skip_bad:
-                            add = added
-                used_brushes.add(requiredBrushFile)
+                        if skip_bad and not added:
+                            add = False
+                if mtype == 'brushes':
+                    used_brushes.add(basename(name))
             if add:
                 presets.append(fname)
             else:
-                print("Warning: skip preset {} since it has references to missing brush files.".format(fname))
+                print("Warning: skip preset {} since it has references to missing resource files.".format(fname))
 
         self.presets[:] = presets
+        self.reindex()
+        if resolver is not None:
+            resolver.close()
 
         if skip_unused_brushes:
             brushes = []
@@ -334,6 +1311,7 @@ class Bundle(object):
                 else:
                     brushes.append(brush)
             self.brushes[:] = brushes
+            self.reindex()
 
         return result
 
@@ -344,21 +1322,35 @@ class Bundle(object):
             manifest.add_resource('brushes', fname)
         for fname in self.patterns:
             manifest.add_resource('patterns', fname)
+        for fname in self.gradients:
+            manifest.add_resource('gradients', fname)
         for fname in self.presets:
             manifest.add_resource('paintoppresets', fname)
 
         return manifest.to_string()
 
-    def prepare(self, brushdir, brushmask, presetsdir, presetmask, patdir, patmask):
+    def prepare(self, brushdir, brushmask, presetsdir, presetmask, patdir, patmask, gradientdir=None, gradientmask=None):
         self.brushdir = brushdir
         self.read_brushes(brushdir, brushmask)
         self.read_presets(presetsdir, presetmask)
         self.patdir = patdir
         self.read_patterns(patdir, patmask)
+        self.gradientdir = gradientdir
+        self.read_gradients(gradientdir, gradientmask)
 
-    def create(self, zipname, meta, preview):
-        manifest = self.format_manifest()
-
+    @profiling.timed('create')
+    def create(self, zipname, meta, preview, jobs=1, incremental=False, unchanged=None):
+        """
+        Write bundle file. With jobs > 1 resource files are read and hashed
+        in parallel threads ahead of the writer. If incremental is set and
+        the bundle file already exists, unchanged resources are copied from
+        it without reading source files; unchanged is an optional set of
+        paths known to be the same as in the existing file (see
+        BundleWriter.set_previous()). preview is a path of preview file; if
+        it is None and the bundle has no preview data, or the file does not
+        exist, preview is made from icons of presets (see preview.py).
+        Returns BuildStats.
+        """
         if isinstance(meta, Meta):
             meta_string = meta.tostring()
         elif meta is None:
@@ -366,110 +1358,203 @@ class Bundle(object):
         else:
             raise Exception("Unexpected: unknow meta data type passed")
 
-        zf = ZipFile(zipname, 'w', ZIP_STORED)
-        zf.writestr("mimetype", MIMETYPE)
-        zf.writestr("META-INF/manifest.xml", manifest)
-        zf.writestr("meta.xml", meta_string)
+        if preview is not None and not isfile(preview):
+            print("Preview file {} not found, making preview from preset icons".format(preview))
+            preview = None
+        preview_data = None
+        if preview is None:
+            preview_data = self.preview_data
+            if preview_data is None:
+                preview_data = self.render_preview(jobs)
+
+        if incremental and isfile(zipname):
+            def write(tmpname):
+                with MappedZip(zipname) as previous:
+                    return self._write_bundle(tmpname, meta_string, preview, jobs, previous, unchanged, preview_data)
+            return Bundle.replace_zip(zipname, write)
+        else:
+            return self._write_bundle(zipname, meta_string, preview, jobs, preview_data=preview_data)
+
+    def render_preview(self, jobs=1):
+        """
+        Return PNG data of preview made from icons of the first presets
+        of the bundle.
+        """
+        kpps = dict()
+        if self.presets_data is not None:
+            kpps = dict((kpp.filename, kpp) for kpp in self.presets_data)
+        names = self.presets[:PREVIEW_PRESETS]
+        return make_preview([kpps.get(name) or KPP(name) for name in names], jobs=jobs)
+
+    def _write_bundle(self, zipname, meta_string, preview, jobs, previous=None, unchanged=None, preview_data=None):
+        writer = BundleWriter(zipname)
+        if previous is not None:
+            writer.set_previous(previous, unchanged)
+        writer.writestr("meta.xml", meta_string)
 
         if preview is not None:
-            zf.write(preview, "preview.png")
+            writer.write(preview, "preview.png")
         else:
-            zf.writestr(self.preview_data, "preview.png")
+            writer.writestr("preview.png", preview_data)
 
-        for fname in self.brushes:
-            zf.write(fname, fname)
-        for fname in self.patterns:
-            zf.write(fname, fname)
-        for fname in self.presets:
-            zf.write(fname, fname)
+        files = [(mtype, fname) for mtype, names in self.get_resource_lists() for fname in names]
+        writer.add_files(files, jobs)
 
-        zf.close()
+        writer.close()
+        return writer.stats
 
     @staticmethod
-    def update_zip(zipname, filename, new_data):
+    @profiling.timed('replace zip')
+    def replace_zip(zipname, write):
         """
-        replace one file within zip archive
+        Write new version of zip archive to temporary file by calling
+        write(tmpname), then atomically replace the archive with it.
+        The archive may not exist yet. Returns the result of write().
         """
-
-        # generate a temp file
-        tmpfd, tmpname = tempfile.mkstemp(dir=dirname(zipname))
+        tmpfd, tmpname = tempfile.mkstemp(dir=dirname(zipname) or ".")
         os.close(tmpfd)
+        try:
+            result = write(tmpname)
+            if isfile(zipname):
+                shutil.copymode(zipname, tmpname)
+            else:
+                # mkstemp creates files readable by owner only
+                os.chmod(tmpname, 0o666 & ~_get_umask())
+        except BaseException:
+            os.remove(tmpname)
+            raise
+        os.replace(tmpname, zipname)
+        return result
 
-        # create a temp copy of the archive without filename            
-        with ZipFile(zipname, 'r') as zin:
-            with ZipFile(tmpname, 'w') as zout:
-                zout.comment = zin.comment # preserve the comment
-                for item in zin.infolist():
-                    if item.filename != filename:
-                        zout.writestr(item, zin.read(item.filename))
-
-        # replace with the temp archive
-        os.remove(zipname)
-        os.rename(tmpname, zipname)
-
-        # now add filename with its new data
-        with ZipFile(zipname, 'a', ZIP_STORED) as zf:
-            zf.writestr(filename, new_data)
-
-    def add_resources(self, zipname, mtype, paths):
-        if not paths:
-            return
+    @staticmethod
+    def update_zip(zipname, filename, new_data):
+        """
+        replace one file within zip archive
+        """
 
-        with ZipFile(zipname, 'r') as zf:
-            # recalculate manifest from old zip file
-            manifest = Manifest.new(zf)
+        def write(tmpname):
+            with MappedZip(zipname) as zin:
+                with BundleWriter(tmpname) as writer:
+                    # the manifest is copied or replaced as any other file
+                    writer.manifest = None
+                    writer.zipfile.comment = zin.comment # preserve the comment
+                    for item in zin.infolist():
+                        if item.filename not in (filename, "mimetype"):
+                            writer.copy_raw(zin, item)
+                    writer.writestr(filename, new_data)
 
-            for fname in self.brushes:
-                manifest.add_resource('brushes', fname)
-            for fname in self.patterns:
-                manifest.add_resource('patterns', fname)
-            for fname in self.presets:
-                manifest.add_resource('paintoppresets', fname)
+        Bundle.replace_zip(zipname, write)
 
-            # add new resources to manifest
-            for fname in paths:
-                manifest.add_resource(mtype, fname)
+    def edit(self, zipname):
+        """
+        Start a batch of changes to bundle file zipname, which is the file
+        this bundle was read from. Use as
 
-            manifest = manifest.to_string()
+            with bundle.edit(zipname) as tx:
+                tx.add('brushes', paths)
+                ...
 
-        Bundle.update_zip(zipname, "META-INF/manifest.xml", manifest)
+        All changes are written in one pass when the block ends.
+        """
+        return BundleTransaction(self, zipname)
 
+    @profiling.timed('rewrite')
+    def rewrite(self, zipname, added=(), removed=(), replaced=None):
+        """
+        Rewrite bundle file in one pass: unchanged members are copied raw,
+        added is a list of (mtype, path) of files to be put into the bundle,
+        removed is a list of (mtype, name, keep_member) of resources to be
+        dropped from the manifest (and from the archive, unless keep_member
+        is set), replaced maps names of other members (meta.xml, preview.png)
+        to their new data. The manifest is regenerated from resource lists of
+        this object; md5 sums of existing resources are taken from the old
+        manifest. Entries of other types (palettes, workspaces and so on) are
+        copied from the old manifest for members which are kept.
+        """
+        for mtype, path in added:
+            self.get_resource_list(mtype)
+        if replaced is None:
+            replaced = dict()
+        # the archive is going to be replaced
+        self.close()
+
+        added_paths = set(join(mtype, basename(path)) for mtype, path in added)
+        removed_paths = set(join(mtype, basename(name)) for mtype, name, _ in removed)
+        dropped_paths = set(join(mtype, basename(name)) for mtype, name, keep in removed if not keep)
+
+        def write(tmpname):
+            with MappedZip(zipname) as zin:
+                try:
+                    old_manifest = Manifest.parse(zin.read("META-INF/manifest.xml"))
+                except KeyError:
+                    old_manifest = None
+
+                manifest = Manifest.new(zin)
+                for mtype, names in self.get_resource_lists():
+                    for fname in names:
+                        full_path = join(mtype, basename(fname))
+                        if full_path in added_paths or full_path in removed_paths:
+                            continue
+                        md5sum = old_manifest.get_md5(full_path) if old_manifest is not None else None
+                        manifest.manifest_entry(mtype, fname, md5sum=md5sum)
+                if old_manifest is not None:
+                    for path, mtype, md5sum in old_manifest.entries():
+                        if mtype == MIMETYPE or path in manifest or path not in zin.NameToInfo:
+                            continue
+                        if path in added_paths or path in removed_paths or path in replaced:
+                            continue
+                        manifest._add_entry(path, mtype, md5sum or zin.md5(path))
+
+                with BundleWriter(tmpname, manifest) as writer:
+                    writer.zipfile.comment = zin.comment
+                    for item in zin.infolist():
+                        if item.filename in ("mimetype", "META-INF/manifest.xml"):
+                            continue
+                        if item.filename in added_paths or item.filename in dropped_paths or item.filename in replaced:
+                            continue
+                        writer.copy_raw(zin, item)
+                    for arcname, data in replaced.items():
+                        writer.writestr(arcname, data)
+                    for mtype, path in added:
+                        writer.add_file(mtype, path)
+
+        Bundle.replace_zip(zipname, write)
+
+        for mtype, path in added:
+            names = self.get_resource_list(mtype)
+            names[:] = [name for name in names if join(mtype, basename(name)) != join(mtype, basename(path))]
+            names.append(path)
+        for mtype, name, _ in removed:
+            names = self.get_resource_list(mtype)
+            names[:] = [n for n in names if join(mtype, basename(n)) != join(mtype, basename(name))]
+        self.reindex()
+        if "meta.xml" in replaced:
+            self.meta_string = replaced["meta.xml"]
+        if "preview.png" in replaced:
+            self.preview_data = replaced["preview.png"]
+
+    def get_resource_list(self, mtype):
         if mtype == 'brushes':
-            self.brushes.extend(paths)
+            return self.brushes
         elif mtype == 'paintoppresets':
-            self.presets.extend(paths)
+            return self.presets
         elif mtype == 'patterns':
-            self.patterns.extend(paths)
+            return self.patterns
+        elif mtype == 'gradients':
+            return self.gradients
         else:
             raise Exception("Unsupported resource type: " + mtype)
 
-        with ZipFile(zipname, 'a', ZIP_STORED) as zf:
-            for path in paths:
-                target_path = join(mtype, basename(path))
-                zf.write(path, target_path)
-
-    def remove_resources_from_manifest(self, zipname, mtype, paths):
-        if not paths:
-            return
-
-        with ZipFile(zipname, 'r') as zf:
-            # recalculate manifest from old zip file
-            manifest = Manifest.new(zf)
-
-            for fname in self.brushes:
-                manifest.add_resource('brushes', fname)
-            for fname in self.patterns:
-                manifest.add_resource('patterns', fname)
-            for fname in self.presets:
-                manifest.add_resource('paintoppresets', fname)
-
-            # remove items
-            for fname in paths:
-                manifest.remove_resource(mtype, fname)
+    def get_resource_lists(self):
+        return [('brushes', self.brushes), ('patterns', self.patterns), ('gradients', self.gradients), ('paintoppresets', self.presets)]
 
-            manifest = manifest.to_string()
+    def add_resources(self, zipname, mtype, paths):
+        with self.edit(zipname) as tx:
+            tx.add(mtype, paths)
 
-        Bundle.update_zip(zipname, "META-INF/manifest.xml", manifest)
+    def remove_resources_from_manifest(self, zipname, mtype, paths):
+        with self.edit(zipname) as tx:
+            tx.remove(mtype, paths, keep_members=True)
 
     def add_brushes(self, zipname, brushes):
         self.add_resources(zipname, 'brushes', brushes)
@@ -483,3 +1568,123 @@ class Bundle(object):
     def add_patterns(self, zipname, patterns):
         self.add_resources(zipname, 'patterns', patterns)
 
+    def add_gradients(self, zipname, gradients):
+        self.add_resources(zipname, 'gradients', gradients)
+
+class BundleTransaction(object):
+    """
+    Batch of changes to bundle file, created by Bundle.edit().
+    Changes are collected and then written by commit() in one pass over
+    the archive, with one manifest regeneration. Used as context manager,
+    commits automatically unless the block raised an exception.
+    """
+
+    def __init__(self, bundle, zipname):
+        self.bundle = bundle
+        self.zipname = zipname
+        # full path in the bundle => operation; later operations on the same resource win
+        self._changes = OrderedDict()
+        self._replaced = dict()
+
+    def add(self, mtype, paths):
+        self.bundle.get_resource_list(mtype)
+        for path in paths:
+            self._changes[join(mtype, basename(path))] = ('add', mtype, path, False)
+
+    def remove(self, mtype, names, keep_members=False):
+        """
+        Remove resources from the manifest. Their files are removed from the
+        archive as well, unless keep_members is set.
+        """
+        for name in names:
+            self._changes[join(mtype, basename(name))] = ('remove', mtype, name, keep_members)
+
+    def add_brushes(self, paths):
+        self.add('brushes', paths)
+
+    def add_presets(self, paths):
+        self.add('paintoppresets', paths)
+
+    def add_patterns(self, paths):
+        self.add('patterns', paths)
+
+    def add_gradients(self, paths):
+        self.add('gradients', paths)
+
+    def set_meta(self, meta):
+        """
+        Replace meta.xml; meta is either a Meta object or XML string.
+        """
+        if isinstance(meta, Meta):
+            meta = meta.tostring()
+        self._replaced["meta.xml"] = meta
+
+    def set_preview(self, path):
+        with open(path, 'rb') as f:
+            self._replaced["preview.png"] = f.read()
+
+    def is_empty(self):
+        return not self._changes and not self._replaced
+
+    def commit(self):
+        if self.is_empty():
+            return
+        added = []
+        removed = []
+        for op, mtype, path, keep in self._changes.values():
+            if op == 'add':
+                added.append((mtype, path))
+            else:
+                removed.append((mtype, path, keep))
+        self.bundle.rewrite(self.zipname, added, removed, self._replaced)
+        self._changes = OrderedDict()
+        self._replaced = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+
+def _verify_worker(zipname, fail_fast, check_presets):
+    return Bundle.verify(zipname, 1, fail_fast, check_presets)
+
+def verify_bundles(zipnames, jobs=1, fail_fast=False, check_presets=True):
+    """
+    Verify several bundle files (see Bundle.verify()) and yield VerifyResult
+    of each, in the same order. With jobs > 1 (0 means the number of CPUs)
+    and more than one bundle, bundles are verified in worker processes, one
+    bundle per process at a time; a single bundle is hashed in threads
+    instead. With fail_fast, stop after the first bundle with problems.
+    """
+    zipnames = list(zipnames)
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    if jobs <= 1 or len(zipnames) < 2:
+        for zipname in zipnames:
+            result = Bundle.verify(zipname, jobs, fail_fast, check_presets)
+            yield result
+            if fail_fast and not result.ok:
+                return
+        return
+
+    with profiling.span('verify in workers'), ProcessPoolExecutor(min(jobs, len(zipnames))) as pool:
+        # keep a bounded window of bundles in flight, so that fail_fast
+        # does not have to wait for the whole directory
+        pending = deque()
+        names = iter(zipnames)
+        for zipname in names:
+            pending.append(pool.submit(_verify_worker, zipname, fail_fast, check_presets))
+            if len(pending) >= 2*jobs:
+                break
+        while pending:
+            result = pending.popleft().result()
+            yield result
+            if fail_fast and not result.ok:
+                for future in pending:
+                    future.cancel()
+                return
+            for zipname in names:
+                pending.append(pool.submit(_verify_worker, zipname, fail_fast, check_presets))
+                break
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Reading of *.bundleconfig files (see README), used by create-krita-bundle.py
+and build-bundles.py.
+"""
+
+from os.path import join, expanduser
+from glob import glob
+
+try:
+    import ConfigParser as configparser
+except ImportError:
+    try:
+        import configparser
+    except ImportError:
+        raise ImportError("Neither ConfigParser nor configparser module not found")
+
+from bundle import Meta
+
+class Config(configparser.ConfigParser):
+    SECTION = "Bundle"
+
+    def __init__(self, filename=None):
+        configparser.ConfigParser.__init__(self)
+        self._filename = filename
+        if filename is not None:
+            self.read(filename)
+
+    def ask(self, option, default=None, config_option=None):
+        if self._filename is None:
+            t = " [{}]: ".format(default) if default is not None else ": "
+            r = input(option + t)
+            if not r:
+                return default
+            else:
+                return r
+        else:
+            if config_option is not None:
+                option = config_option
+            if self.has_option(self.SECTION, option):
+                return self.get(self.SECTION, option)
+            else:
+                return default
+
+class BundleSettings(object):
+    """
+    Everything needed to build one bundle.
+    """
+
+    @staticmethod
+    def read(config, jobs=None, basedir=None):
+        """
+        Read settings from Config (options missing from config file are
+        asked interactively if config has no file). Relative paths are
+        resolved against basedir, if it is given, or the current directory.
+        jobs overrides number of jobs from the config.
+        """
+        def path(value):
+            if value is None or basedir is None:
+                return value
+            return join(basedir, expanduser(value))
+
+        s = BundleSettings()
+        meta = s.meta = Meta()
+        author = meta.author = config.ask("Author")
+        meta.description = config.ask("Description")
+        meta.initial_creator = config.ask("Initial creator", author)
+        meta.creator = config.ask("Creator", author)
+        meta.date = config.ask("Date")
+        meta.email = config.ask("Email")
+        meta.website = config.ask("Website")
+        meta.license = config.ask("License")
+
+        s.zipname = path(config.ask("Bundle file name"))
+        s.brushdir = path(config.ask("Brushes directory", "brushes"))
+        s.brushmask = config.ask("Brush files mask", "*.gbr;*.gih;*.png")
+        s.patdir = path(config.ask("Patterns directory", "patterns"))
+        s.patmask = config.ask("Pattern files mask", "*.pat")
+        s.gradientdir = path(config.ask("Gradients directory", "gradients"))
+        s.gradientmask = config.ask("Gradient files mask", "*.ggr;*.svg")
+        s.presetsdir = path(config.ask("Presets directory", "paintoppresets"))
+        s.presetmask = config.ask("Preset files mask", "*.kpp")
+        s.skip_bad = config.ask("Skip presets with broken references", default=False, config_option="Skip bad presets")
+        s.skip_unused_brushes = config.ask("Skip unused brushes", default=False)
+        autopopulate = config.ask("Automatically add resources from directory", default=None, config_option="Auto add resources")
+        if autopopulate is not None:
+            autopopulate = autopopulate.split(";")
+            autopopulate = map(expanduser, autopopulate)
+            autopopulate = map(path, autopopulate)
+            autopopulate = sum(map(glob, autopopulate), [])
+        s.autopopulate = autopopulate
+        s.preview = path(config.ask("Preview", "preview.png"))
+        s.jobs = jobs
+        if s.jobs is None:
+            # not asked interactively: -j is there for that
+            s.jobs = config.get(config.SECTION, "Jobs") if config.has_option(config.SECTION, "Jobs") else 1
+        s.jobs = BundleSettings.parse_jobs(s.jobs)
+        return s
+
+    @staticmethod
+    def parse_jobs(value):
+        """
+        Return number of jobs given as string or integer. Raises ValueError
+        with readable message if it is not a non-negative integer.
+        """
+        try:
+            jobs = int(value)
+        except (TypeError, ValueError):
+            jobs = -1
+        if jobs < 0:
+            raise ValueError("invalid number of jobs: {!r}; it must be 0 (number of CPUs) or more".format(value))
+        return jobs
+
+    def sources(self):
+        """
+        List of (mtype, directory, mask) of resources to be put into the bundle.
+        """
+        return [('brushes', self.brushdir, self.brushmask),
+                ('paintoppresets', self.presetsdir, self.presetmask),
+                ('patterns', self.patdir, self.patmask),
+                ('gradients', self.gradientdir, self.gradientmask)]
+
+    def check_options(self):
+        """
+        Keyword arguments for Bundle.check().
+        """
+        return dict(skip_bad=self.skip_bad, resourcedir=self.autopopulate, skip_unused_brushes=self.skip_unused_brushes)
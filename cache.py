@@ -0,0 +1,212 @@
+# encoding: utf-8
+"""
+Persistent cache of data extracted from presets.
+
+Parsing *.kpp files (PNG chunks and preset XML) is the most expensive part of
+most operations, so extracted data is stored in SQLite database under
+~/.cache/krita-bundler. Loose files are identified by their path, size,
+modification time and inode; bundle members are identified by md5 sum from
+bundle's manifest. md5 sums of resource files written into bundles are
+stored as well, to detect unchanged files without reading them, and so are
+thumbnails of presets used for generated bundle previews.
+"""
+
+import os
+import json
+import time
+import atexit
+import sqlite3
+from os.path import join, abspath, expanduser, isdir
+
+SCHEMA_VERSION = 3
+DEFAULT_MAX_ENTRIES = 200000
+
+def default_cache_dir():
+    base = os.environ.get('XDG_CACHE_HOME') or expanduser(join('~', '.cache'))
+    return join(base, 'krita-bundler')
+
+class NullCache(object):
+    """
+    Cache which does not store anything. Used when cache is disabled.
+    """
+
+    enabled = False
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    def file_key(self, path):
+        return None
+
+    def md5_key(self, md5sum):
+        return None
+
+    def digest_key(self, path):
+        return None
+
+    def thumbnail_key(self, md5sum, size):
+        return None
+
+    def get(self, key):
+        if key is not None:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def stats(self):
+        return "{} hits, {} misses".format(self.hits, self.misses)
+
+class PresetCache(NullCache):
+    """
+    SQLite-backed cache. Values are JSON-serializable objects.
+    Least recently used entries are evicted when there are more
+    than max_entries of them.
+    """
+
+    enabled = True
+
+    def __init__(self, path=None, max_entries=DEFAULT_MAX_ENTRIES):
+        NullCache.__init__(self)
+        if path is None:
+            directory = default_cache_dir()
+            if not isdir(directory):
+                os.makedirs(directory)
+            path = join(directory, 'presets.sqlite')
+        self.path = path
+        self.max_entries = max_entries
+        self._pending = dict()
+        self._used = set()
+        self._db = sqlite3.connect(path, timeout=30)
+        self._init_schema()
+
+    def _init_schema(self):
+        db = self._db
+        db.execute("CREATE TABLE IF NOT EXISTS info (name TEXT PRIMARY KEY, value TEXT)")
+        row = db.execute("SELECT value FROM info WHERE name = 'schema'").fetchone()
+        if row is None or row[0] != str(SCHEMA_VERSION):
+            db.execute("DROP TABLE IF EXISTS presets")
+            db.execute("INSERT OR REPLACE INTO info (name, value) VALUES ('schema', ?)", (str(SCHEMA_VERSION),))
+        db.execute("CREATE TABLE IF NOT EXISTS presets (key TEXT PRIMARY KEY, value TEXT, used INTEGER)")
+        db.execute("CREATE INDEX IF NOT EXISTS presets_used ON presets (used)")
+        db.commit()
+
+    def file_key(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return "file:{}:{}:{}:{}".format(abspath(path), st.st_size, st.st_mtime_ns, st.st_ino)
+
+    def md5_key(self, md5sum):
+        if not md5sum:
+            return None
+        return "md5:" + md5sum
+
+    def digest_key(self, path):
+        """
+        Key for md5 sum of the file itself (not of preset data).
+        """
+        key = self.file_key(path)
+        if key is None:
+            return None
+        return "digest:" + key[len("file:"):]
+
+    def thumbnail_key(self, md5sum, size):
+        """
+        Key for preview thumbnail of given size of file with given md5 sum.
+        """
+        if not md5sum:
+            return None
+        return "thumbnail:{}:{}".format(size, md5sum)
+
+    def get(self, key):
+        if key is None:
+            return None
+        if key in self._pending:
+            self.hits += 1
+            return self._pending[key]
+        row = self._db.execute("SELECT value FROM presets WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._used.add(key)
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        if key is None:
+            return
+        self._pending[key] = value
+        if len(self._pending) >= 1000:
+            self.flush()
+
+    def flush(self):
+        now = int(time.time())
+        db = self._db
+        db.executemany("INSERT OR REPLACE INTO presets (key, value, used) VALUES (?, ?, ?)",
+                       [(key, json.dumps(value), now) for key, value in self._pending.items()])
+        db.executemany("UPDATE presets SET used = ? WHERE key = ?",
+                       [(now, key) for key in self._used])
+        db.commit()
+        self._pending = dict()
+        self._used = set()
+
+    def evict(self):
+        db = self._db
+        count = db.execute("SELECT count(*) FROM presets").fetchone()[0]
+        if count <= self.max_entries:
+            return
+        # drop a bit more than necessary, so that we do not evict on each run
+        excess = count - self.max_entries * 9 // 10
+        db.execute("DELETE FROM presets WHERE key IN (SELECT key FROM presets ORDER BY used LIMIT ?)", (excess,))
+        db.commit()
+
+    def close(self):
+        if self._db is None:
+            return
+        self.flush()
+        self.evict()
+        self._db.close()
+        self._db = None
+
+_cache = None
+
+def configure(enabled=True, path=None, max_entries=DEFAULT_MAX_ENTRIES):
+    """
+    Set up the process-wide cache returned by get_cache().
+    """
+    global _cache
+    if _cache is not None:
+        _cache.close()
+    _cache = None
+    if enabled:
+        try:
+            _cache = PresetCache(path, max_entries)
+        except (OSError, sqlite3.Error) as e:
+            print("Warning: can not open preset cache: {}".format(e))
+    if _cache is None:
+        _cache = NullCache()
+    return _cache
+
+def get_cache():
+    if _cache is None:
+        configure(enabled=False)
+    return _cache
+
+@atexit.register
+def _close_cache():
+    if _cache is not None:
+        _cache.close()
+
+def add_cmdline_options(parser):
+    parser.add_argument('--no-cache', action='store_true', help="Do not use persistent cache of preset data")
+
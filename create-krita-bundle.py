@@ -1,91 +1,56 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*- 
 
-import os
 import sys
-from os.path import join, basename, isdir, isfile, expanduser
-import shutil
-import hashlib
-from fnmatch import fnmatch
-from glob import glob
-from zipfile import ZipFile, ZIP_STORED
-#from xml.sax.saxutils import escape as xmlescape
-from lxml import etree
-from lxml.builder import ElementMaker
-
-try:
-    import ConfigParser as configparser
-except ImportError:
-    try:
-        import configparser
-    except ImportError:
-        raise ImportError("Neither ConfigParser nor configparser module not found")
-
-from bundle import Meta, Bundle
-
-class Config(configparser.ConfigParser):
-    SECTION = "Bundle"
-
-    def __init__(self, filename=None):
-        configparser.ConfigParser.__init__(self)
-        self._filename = filename
-        if filename is not None:
-            self.read(filename)
-
-    def ask(self, option, default=None, config_option=None):
-        if self._filename is None:
-            t = " [{}]: ".format(default) if default is not None else ": "
-            r = input(option + t)
-            if not r:
-                return default
-            else:
-                return r
-        else:
-            if config_option is not None:
-                option = config_option
-            if self.has_option(self.SECTION, option):
-                return self.get(self.SECTION, option)
-            else:
-                return default
+import argparse
+
+from bundle import Bundle
+from bundleconfig import Config, BundleSettings
+import cache
+import profiling
+import watcher
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description="Create Krita resource bundle file. Parameters are read from config file or asked interactively.")
+    parser.add_argument('config', metavar='FILE.BUNDLECONFIG', nargs='?', help="Bundle config file")
+    parser.add_argument('-i', '--incremental', action='store_true', help="Copy resources that did not change from existing bundle file instead of writing them anew")
+    parser.add_argument('-j', '--jobs', type=int, metavar='N', help="Number of parallel processes used to check presets and threads used to read resource files; 0 means number of CPUs")
+    parser.add_argument('-w', '--watch', action='store_true', help="Keep running and rebuild the bundle incrementally when resource files change")
+    parser.add_argument('--debounce', type=float, default=watcher.DEFAULT_DEBOUNCE, metavar='SECONDS', help="With --watch, wait until there are no changes for this long before rebuilding")
+    parser.add_argument('--poll', type=float, nargs='?', const=watcher.DEFAULT_POLL_INTERVAL, metavar='SECONDS', help="With --watch, poll directories every SECONDS instead of using inotify")
+    cache.add_cmdline_options(parser)
+    profiling.add_cmdline_options(parser)
+    return parser.parse_args()
 
 if __name__ == "__main__":
 
-    if len(sys.argv) == 2:
-        cfgfile = sys.argv[1]
-    else:
-        cfgfile = None
-    config = Config(cfgfile)
-
-    meta = Meta()
-    author = meta.author = config.ask("Author")
-    meta.description = config.ask("Description")
-    meta.initial_creator = config.ask("Initial creator", author)
-    meta.creator = config.ask("Creator", author)
-    meta.date = config.ask("Date")
-    meta.email = config.ask("Email")
-    meta.website = config.ask("Website")
-    meta.license = config.ask("License")
-
-    zipname = config.ask("Bundle file name")
-    brushdir = config.ask("Brushes directory", "brushes")
-    brushmask = config.ask("Brush files mask", "*.gbr;*.gih;*.png")
-    patdir = config.ask("Patterns directory", "patterns")
-    patmask = config.ask("Pattern files mask", "*.pat")
-    presetsdir = config.ask("Presets directory", "paintoppresets")
-    presetmask = config.ask("Preset files mask", "*.kpp")
-    skip_bad = config.ask("Skip presets with broken references", default=False, config_option="Skip bad presets")
-    skip_unused_brushes = config.ask("Skip unused brushes", default=False)
-    autopopulate = config.ask("Automatically add resources from directory", default=None, config_option="Auto add resources")
-    if autopopulate is not None:
-        autopopulate = autopopulate.split(";")
-        autopopulate = map(expanduser, autopopulate)
-        autopopulate = sum(map(glob, autopopulate), [])
-    preview = config.ask("Preview", "preview.png")
+    args = parse_cmdline()
+    preset_cache = cache.configure(enabled=not args.no_cache)
+    profiling.configure_from_args(args)
+    config = Config(args.config)
+    try:
+        settings = BundleSettings.read(config, args.jobs)
+    except ValueError as e:
+        print("Error: {}: {}".format(args.config or "settings", e))
+        sys.exit(1)
+
+    if args.watch:
+        build = watcher.WatchedBuild(settings.zipname, settings.meta, settings.preview, settings.sources(),
+                                     settings.check_options(), settings.jobs)
+        def on_build(ok, stats):
+            if not ok:
+                print("Bundle contains references to resources outside the bundle. You probably need to put required resources to the bundle itself.")
+            print(stats.report())
+        build.watch(args.debounce, args.poll, on_build)
+        sys.exit(0)
 
     bundle = Bundle()
-    bundle.prepare(brushdir, brushmask, presetsdir, presetmask, patdir, patmask)
-    ok = bundle.check(skip_bad=skip_bad, resourcedir=autopopulate, skip_unused_brushes=skip_unused_brushes)
+    bundle.prepare(settings.brushdir, settings.brushmask, settings.presetsdir, settings.presetmask, settings.patdir, settings.patmask,
+                   settings.gradientdir, settings.gradientmask)
+    ok = bundle.check(jobs=settings.jobs, **settings.check_options())
+    if preset_cache.enabled:
+        print("Preset cache: {}".format(preset_cache.stats()))
     if not ok:
         print("Bundle contains references to resources outside the bundle. You probably need to put required resources to the bundle itself.")
-    bundle.create(zipname, meta, preview)
-
+    stats = bundle.create(settings.zipname, settings.meta, settings.preview, jobs=settings.jobs, incremental=args.incremental)
+    print(stats.report())
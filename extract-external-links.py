@@ -1,11 +1,12 @@
 #!/usr/bin/python3
 # -*- encoding: utf-8 -*- 
 
-import sys
+import argparse
 from zipfile import ZipFile
 
 from extractor import KPP
-from bundle import Bundle
+from bundle import Bundle, DEFAULT_MEMORY_BUDGET
+import cache
 
 def process(filename, rtypes=None):
     if not rtypes:
@@ -13,7 +14,7 @@ def process(filename, rtypes=None):
 
     def process_kpp(kpp, bundle=None):
         links = kpp.get_links()
-        for name, value in links.iteritems():
+        for name, value in links.items():
             if bundle is not None:
                 if name not in rtypes:
                     continue
@@ -27,7 +28,7 @@ def process(filename, rtypes=None):
             print("{}: {}".format(name, value))
 
     if filename.endswith(".bundle"):
-        bundle = Bundle.open(filename)
+        bundle = Bundle.open(filename, lazy=True, memory_budget=DEFAULT_MEMORY_BUDGET)
         presets = bundle.presets_data
     else:
         bundle = None
@@ -36,8 +37,19 @@ def process(filename, rtypes=None):
     for preset in presets:
         process_kpp(preset, bundle)
 
+    if bundle is not None:
+        bundle.close()
 
-for fname in sys.argv[1:]:
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description="Print references to external resource files from presets or bundles")
+    parser.add_argument('files', metavar='FILE', nargs='+', help="*.kpp or *.bundle file")
+    cache.add_cmdline_options(parser)
+    return parser.parse_args()
+
+args = parse_cmdline()
+cache.configure(enabled=not args.no_cache)
+for fname in args.files:
     print("Processing: {}".format(fname))
     process(fname)
 
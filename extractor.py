@@ -1,90 +1,559 @@
 
 from lxml import etree
 import io
+import struct
+import zlib
+import hashlib
+import os
+from os.path import basename
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
 
-try:
+from cache import get_cache
+import profiling
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+TEXT_CHUNKS = (b'tEXt', b'zTXt', b'iTXt')
+# PNG keywords are limited to 79 bytes plus the terminating zero
+MAX_KEYWORD_LENGTH = 80
+
+class PngError(Exception):
+    pass
+
+class NotPngError(PngError):
+    pass
+
+def _decode_text_chunk(ctype, data, keyword_length):
+    body = data[keyword_length+1:]
+    if ctype == b'tEXt':
+        return body.decode('latin-1')
+    elif ctype == b'zTXt':
+        if body[:1] != b'\0':
+            raise PngError("unsupported zTXt compression method")
+        return zlib.decompress(body[1:]).decode('latin-1')
+    else:
+        compressed, method = body[0:1], body[1:2]
+        # skip language tag and translated keyword
+        lang_end = body.index(b'\0', 2)
+        text = body[body.index(b'\0', lang_end+1)+1:]
+        if compressed == b'\1':
+            if method != b'\0':
+                raise PngError("unsupported iTXt compression method")
+            text = zlib.decompress(text)
+        return text.decode('utf-8')
+
+def read_png_text(source, keyword='preset'):
+    """
+    Return text stored under keyword in tEXt/zTXt/iTXt chunk of PNG file.
+
+    source may be a file name, a bytes-like object or a seekable binary stream.
+    Chunks are walked by their headers only: image data is skipped with seek(),
+    and only the matching text chunk is read and inflated. Bytes-like objects
+    (i.e. memory views of mapped bundles) are not copied, except for the
+    matching chunk.
+    Returns None if there is no such text chunk. Raises PngError if source is
+    not a well-formed PNG file.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return _read_png_text_buffer(memoryview(source), keyword)
+    if not hasattr(source, 'read'):
+        with open(source, 'rb') as stream:
+            return read_png_text(stream, keyword)
+
+    stream = source
+    if stream.read(8) != PNG_SIGNATURE:
+        raise NotPngError("not a PNG file")
+    wanted = keyword.encode('latin-1')
+    while True:
+        header = stream.read(8)
+        if len(header) < 8:
+            # truncated file, but we did not find the text anyway
+            return None
+        length, ctype = struct.unpack('>I4s', header)
+        if ctype == b'IEND':
+            return None
+        if ctype not in TEXT_CHUNKS:
+            stream.seek(length + 4, io.SEEK_CUR)
+            continue
+
+        head = stream.read(min(length, MAX_KEYWORD_LENGTH))
+        keyword_length = head.find(b'\0')
+        if keyword_length < 0 or head[:keyword_length] != wanted:
+            stream.seek(length - len(head) + 4, io.SEEK_CUR)
+            continue
+
+        data = head + stream.read(length - len(head))
+        crc = stream.read(4)
+        if len(data) < length or len(crc) < 4:
+            raise PngError("truncated {} chunk".format(ctype.decode('ascii')))
+        if zlib.crc32(data, zlib.crc32(ctype)) != struct.unpack('>I', crc)[0]:
+            raise PngError("CRC mismatch in {} chunk".format(ctype.decode('ascii')))
+        try:
+            return _decode_text_chunk(ctype, data, keyword_length)
+        except (ValueError, zlib.error) as e:
+            raise PngError("broken {} chunk: {}".format(ctype.decode('ascii'), e))
+
+def _encode_text_chunk(ctype, old_data, keyword_length, text):
+    keyword = old_data[:keyword_length+1]
+    if ctype in (b'tEXt', b'zTXt'):
+        try:
+            raw = text.encode('latin-1')
+        except UnicodeEncodeError:
+            # these chunks can not hold such text, use compressed iTXt instead
+            return b'iTXt', keyword + b'\1\0\0\0' + zlib.compress(text.encode('utf-8'))
+        if ctype == b'tEXt':
+            return ctype, keyword + raw
+        return ctype, keyword + b'\0' + zlib.compress(raw)
+    body = old_data[keyword_length+1:]
+    compressed = body[0:1]
+    # keep compression flag, language tag and translated keyword
+    lang_end = body.index(b'\0', 2)
+    header = body[:body.index(b'\0', lang_end+1)+1]
+    raw = text.encode('utf-8')
+    if compressed == b'\1':
+        raw = zlib.compress(raw)
+    return ctype, keyword + header + raw
+
+def replace_png_text(data, keyword, text):
+    """
+    Return copy of PNG file data, with text stored under keyword replaced
+    by new text. The chunk keeps its type and compression, other chunks are
+    copied as is. Raises PngError if there is no such text chunk.
+    """
+    data = bytes(data)
+    if data[:8] != PNG_SIGNATURE:
+        raise NotPngError("not a PNG file")
+    wanted = keyword.encode('latin-1') + b'\0'
+    pos = 8
+    while pos + 8 <= len(data):
+        length, ctype = struct.unpack('>I4s', data[pos:pos+8])
+        end = pos + 12 + length
+        if ctype == b'IEND':
+            break
+        if ctype in TEXT_CHUNKS and data[pos+8:pos+8+len(wanted)] == wanted:
+            chunk = data[pos+8:pos+8+length]
+            try:
+                new_type, new_data = _encode_text_chunk(ctype, chunk, len(wanted)-1, text)
+            except ValueError as e:
+                raise PngError("broken {} chunk: {}".format(ctype.decode('ascii'), e))
+            crc = zlib.crc32(new_data, zlib.crc32(new_type))
+            new_chunk = struct.pack('>I4s', len(new_data), new_type) + new_data + struct.pack('>I', crc)
+            return data[:pos] + new_chunk + data[end:]
+        pos = end
+    raise PngError("no {} text chunk".format(keyword))
+
+def _read_png_text_buffer(view, keyword):
+    if view[:8] != PNG_SIGNATURE:
+        raise NotPngError("not a PNG file")
+    wanted = keyword.encode('latin-1') + b'\0'
+    size = len(view)
+    pos = 8
+    while True:
+        if pos + 8 > size:
+            # truncated file, but we did not find the text anyway
+            return None
+        length, ctype = struct.unpack_from('>I4s', view, pos)
+        if ctype == b'IEND':
+            return None
+        start = pos + 8
+        pos = start + length + 4
+        if ctype not in TEXT_CHUNKS or view[start:start+len(wanted)] != wanted:
+            continue
+
+        if pos > size:
+            raise PngError("truncated {} chunk".format(ctype.decode('ascii')))
+        data = view[start:start+length]
+        if zlib.crc32(data, zlib.crc32(ctype)) != struct.unpack_from('>I', view, pos-4)[0]:
+            raise PngError("CRC mismatch in {} chunk".format(ctype.decode('ascii')))
+        try:
+            return _decode_text_chunk(ctype, data.tobytes(), len(wanted)-1)
+        except (ValueError, zlib.error) as e:
+            raise PngError("broken {} chunk: {}".format(ctype.decode('ascii'), e))
+
+BROKEN_PRESET_INFO = dict(name=None, links=dict(), references=[])
+
+# preset parameters which refer to other resources, by keys of get_links()
+LINK_PARAMS = OrderedDict([
+    ('PatternFileName', 'Texture/Pattern/PatternFileName'),
+    ('requiredBrushFile', 'requiredBrushFile'),
+])
+
+# last component of names of preset parameters which refer to other
+# resources by file name => type of resources they refer to
+REFERENCE_PARAMS = dict(requiredBrushFile='brushes', PatternFileName='patterns',
+                        GradientFileName='gradients', Gradient='gradients')
+
+# gradient parameters may contain the gradient itself rather than its file name
+GRADIENT_EXTENSIONS = ('.ggr', '.svg', '.kgr')
+
+# parameter with XML definition of the brush, which may refer to brush files
+BRUSH_DEFINITION_PARAM = 'brush_definition'
+
+# references from parameters of a disabled option ("Texture/Pattern/Enabled"
+# is false for "Texture/Pattern/PatternFileName") are not used by Krita
+ENABLED_PARAM = 'Enabled'
+
+def param_reference_type(name, value):
+    """
+    Return type of resources preset parameter with given name and value
+    refers to by file name, or None.
+    """
+    mtype = REFERENCE_PARAMS.get(name.rsplit('/', 1)[-1])
+    if mtype == 'gradients' and not (value or '').lower().endswith(GRADIENT_EXTENSIONS):
+        return None
+    return mtype
+
+def brush_definition_files(text):
+    """
+    Return list of names of brush files referred by embedded brush
+    definition (filename attributes of its Brush elements).
+    """
     try:
-        from PIL import PngImagePlugin
-        PngImagePlugin.MAX_TEXT_CHUNK = 1000000000
-    except ImportError:
-        pass
-    import Image
-    pil_available = True
-except ImportError:
+        definition = etree.fromstring(text)
+    except (etree.XMLSyntaxError, ValueError):
+        return []
+    return [brush.get('filename') for brush in definition.iter('Brush') if brush.get('filename')]
+
+_pillow = None
+
+def load_pillow():
+    """
+    Return PIL.Image module, or False if neither PIL nor Pillow is installed.
+    The module is imported on first call.
+    """
+    global _pillow
+    if _pillow is None:
+        try:
+            from PIL import Image, PngImagePlugin
+            PngImagePlugin.MAX_TEXT_CHUNK = 1000000000
+            _pillow = Image
+        except ImportError:
+            _pillow = False
+    return _pillow
+
+def pillow_png_text(source, keyword='preset'):
+    """
+    Same as read_png_text(), but decodes the image with PIL/Pillow.
+    Returns None if Pillow is not available or there is no such text.
+    """
+    Image = load_pillow()
+    if not Image:
+        return None
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    image = Image.open(source)
     try:
-        from PIL import PngImagePlugin
-        PngImagePlugin.MAX_TEXT_CHUNK = 1000000000
-        from PIL import Image
-        pil_available = True
-    except ImportError:
-        print("Warning: Neither PIL nor Pillow is available. Checking of bundle structure is not possible.")
-        pil_available = False
-
-if pil_available:
-
-    class KPP(object):
-        def __init__(self, filename, data=None):
-            self.filename = filename
-            self.data = data
-
-        def get_preset_text(self):
+        if image.format != 'PNG':
+            raise NotPngError("not a PNG file")
+        return image.text.get(keyword)
+    finally:
+        image.close()
+
+class KPP(object):
+    def __init__(self, filename, data=None, md5=None, log=print):
+        self.filename = filename
+        self.data = data
+        self.md5 = md5
+        self.log = log
+        self._info = None
+        self._messages = []
+
+    @profiling.timed('read png')
+    def get_preset_text(self):
+        source = self.data if self.data is not None else self.filename
+        try:
+            text = read_png_text(source, 'preset')
+        except NotPngError:
+            self.log("Error: {} is not a PNG file".format(self.filename))
+            return None
+        except PngError as e:
+            if not load_pillow():
+                self.log("Error: {}: can not read image: {}".format(self.filename, e))
+                return None
+            # let Pillow try to make sense of a file we could not parse
             try:
-                if self.data is not None:
-                    stream = io.BytesIO(self.data)
-                    self.image = Image.open(stream)
-                else:
-                    self.image = Image.open(self.filename)
+                text = pillow_png_text(source, 'preset')
             except Exception as e:
-                print("Error: {}: can not read image: {}".format(self.filename, e))
+                self.log("Error: {}: can not read image: {}".format(self.filename, e))
                 return None
+        except (IOError, OSError) as e:
+            self.log("Error: {}: can not read image: {}".format(self.filename, e))
+            return None
 
-            if self.image.format != 'PNG':
-                print("Error: {} is not a PNG file".format(self.filename))
-                return None
-            if self.image.text is None:
-                print("Error: {} does not contain text data".format(self.filename))
-                return None
-            if 'preset' not in self.image.text:
-                print("Error: {} does not contain Krita preset".format(self.filename))
-                return None
+        if text is None:
+            self.log("Error: {} does not contain Krita preset".format(self.filename))
+            return None
 
-            return self.image.text['preset']
+        return text
 
-        def check(self):
-            text = self.get_preset_text()
-            if text is None:
-                return None
+    def check(self):
+        text = self.get_preset_text()
+        if text is None:
+            return None
 
-            try:
+        try:
+            with profiling.span('parse xml'):
                 preset = etree.fromstring(text)
-                return preset
-            except etree.XMLSyntaxError as e:
-                print("{} has invalid XML in preset info:\n{}".format(self.filename, e))
-                return None
+            return preset
+        except etree.XMLSyntaxError as e:
+            self.log("{} has invalid XML in preset info:\n{}".format(self.filename, e))
+            return None
+
+    def cache_key(self):
+        cache = get_cache()
+        if not cache.enabled:
+            return None
+        if self.data is None:
+            return cache.file_key(self.filename)
+        if self.md5 is None:
+            self.md5 = hashlib.md5(self.data).hexdigest()
+        return cache.md5_key(self.md5)
+
+    def parse_info(self):
+        """
+        Parse the preset and return dictionary with preset name, links to
+        other resources (see get_links()) and references to other resources
+        (see get_references()), or None if the preset is broken. The preset
+        XML is read in one pass: only parameters are looked at, and their
+        contents are dropped once they are seen, so the whole tree is never
+        kept in memory.
+        Does not use cache.
+        """
+        text = self.get_preset_text()
+        if text is None:
+            return None
+
+        params = dict((param, key) for key, param in LINK_PARAMS.items())
+        links = dict()
+        # (type, file name, option the parameter belongs to)
+        found = []
+        # option => whether it is enabled
+        enabled = dict()
+
+        try:
+            with profiling.span('parse xml'):
+                parser = etree.iterparse(io.BytesIO(text.encode('utf-8')), events=('end',), tag='param')
+                for _, element in parser:
+                    param = element.get('name') or ''
+                    value = element.text
+                    if param in params and params[param] not in links:
+                        links[params[param]] = value
+                    option, _, last = param.rpartition('/')
+                    if param == BRUSH_DEFINITION_PARAM:
+                        if value:
+                            for filename in brush_definition_files(value):
+                                found.append(('brushes', filename, None))
+                    elif last == ENABLED_PARAM and option:
+                        enabled[option] = (value or '').strip().lower() not in ('false', '0')
+                    else:
+                        mtype = param_reference_type(param, value)
+                        if mtype is not None and value:
+                            found.append((mtype, value, option))
+                    # values may be large, i.e. embedded patterns
+                    element.clear()
+        except etree.XMLSyntaxError as e:
+            self.log("{} has invalid XML in preset info:\n{}".format(self.filename, e))
+            return None
+
+        references = []
+        seen = set()
+        for mtype, value, option in found:
+            if enabled.get(option, True) and (mtype, basename(value)) not in seen:
+                seen.add((mtype, basename(value)))
+                references.append([mtype, value])
+
+        return dict(name=parser.root.get('name'), links=links, references=references)
+
+    def get_cached_info(self):
+        if self._info is None:
+            self._info = get_cache().get(self.cache_key())
+        return self._info
+
+    def set_parsed_info(self, info, messages):
+        """
+        Store results of parse_info() done elsewhere (i.e. in worker process).
+        Messages will be printed by the next get_info() call.
+        """
+        self._messages = messages
+        profiling.count('presets parsed')
+        if info is None:
+            self._info = BROKEN_PRESET_INFO
+        else:
+            self._info = info
+            get_cache().put(self.cache_key(), info)
+
+    def get_info(self):
+        """
+        Return dictionary with preset name and links to other resources.
+        Results are stored in persistent cache, if it is enabled.
+        """
+        for message in self._messages:
+            self.log(message)
+        self._messages = []
+
+        info = self.get_cached_info()
+        if info is not None:
+            return info
+
+        info = self.parse_info()
+        profiling.count('presets parsed')
+        if info is None:
+            # do not cache broken presets, so that errors are reported each time
+            return BROKEN_PRESET_INFO
+
+        self._info = info
+        get_cache().put(self.cache_key(), info)
+        return info
+
+    def get_name(self):
+        return self.get_info()['name']
+
+    def get_links(self):
+        return dict(self.get_info()['links'])
+
+    def get_references(self):
+        """
+        Return list of (resource type, file name) of all resources the
+        preset refers to: brush files (requiredBrushFile and files of the
+        embedded brush definition), patterns and gradients. References from
+        disabled options (i.e. pattern of disabled texture) are skipped.
+        Each resource is listed once.
+        """
+        return [tuple(reference) for reference in self.get_info()['references']]
+
+    def with_links(self, renames):
+        """
+        Return data of preset file with references to other resources
+        changed. renames maps (resource type, old file name) to new file
+        name. All references returned by get_references() are changed,
+        including files of the embedded brush definition, which Krita
+        actually loads brushes from. Returns None if the preset is broken
+        or does not refer to any of renamed resources.
+        """
+        preset = self.check()
+        if preset is None:
+            return None
+        changed = False
+        for item in preset.iter('param'):
+            param = item.get('name') or ''
+            value = item.text
+            if not value:
+                continue
+            if param == BRUSH_DEFINITION_PARAM:
+                try:
+                    definition = etree.fromstring(value)
+                except (etree.XMLSyntaxError, ValueError):
+                    continue
+                renamed = False
+                for brush in definition.iter('Brush'):
+                    name = renames.get(('brushes', basename(brush.get('filename') or '')))
+                    if name is not None:
+                        brush.set('filename', name)
+                        renamed = True
+                if renamed:
+                    item.text = etree.CDATA(etree.tostring(definition, encoding='unicode'))
+                    changed = True
+            else:
+                mtype = param_reference_type(param, value)
+                name = renames.get((mtype, basename(value))) if mtype is not None else None
+                if name is not None:
+                    item.text = etree.CDATA(name)
+                    changed = True
+        if not changed:
+            return None
+        text = etree.tostring(preset, encoding='unicode')
+        data = self.data
+        if data is None:
+            with open(self.filename, 'rb') as f:
+                data = f.read()
+        return replace_png_text(data, 'preset', text)
+
+def picklable(data):
+    """
+    Return preset data which can be sent to worker processes: memory views
+    of mapped bundles are copied into bytes.
+    """
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    return data
 
-        def get_links(self):
-            result = dict()
+def _parse_info(item):
+    filename, data = item
+    messages = []
+    kpp = KPP(filename, data, log=messages.append)
+    return kpp.parse_info(), messages
 
-            preset = self.check()
-            if preset is None:
-                return result
+def prefetch_info(kpps, jobs=1):
+    """
+    Parse given presets, which are not in cache yet, in `jobs` worker processes.
+    Only extracted info and error messages are sent back; messages are printed
+    by get_info() of corresponding preset, so output order does not change.
+    jobs=0 means the number of CPUs.
+    """
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    if jobs <= 1:
+        return
+    todo = [kpp for kpp in kpps if kpp.get_cached_info() is None]
+    if len(todo) < 2:
+        return
+    jobs = min(jobs, len(todo))
+    chunksize = max(1, min(64, len(todo) // (jobs * 4)))
+    with profiling.span('parse presets in workers'), ProcessPoolExecutor(jobs) as pool:
+        items = [(kpp.filename, picklable(kpp.data)) for kpp in todo]
+        for kpp, (info, messages) in zip(todo, pool.map(_parse_info, items, chunksize=chunksize)):
+            kpp.set_parsed_info(info, messages)
 
-            item = preset.find('param[@name="Texture/Pattern/PatternFileName"]')
-            if item is not None:
-                result['PatternFileName'] = item.text
+# Number of presets sent to a worker process at once by iter_info()
+INFO_BATCH_SIZE = 64
 
-            item = preset.find('param[@name="requiredBrushFile"]')
-            if item is not None:
-                result['requiredBrushFile'] = item.text
+def _parse_info_batch(items):
+    return [_parse_info(item) for item in items]
 
-            return result
+def iter_info(kpps, jobs=1):
+    """
+    Yield (kpp, info) for each preset of iterable kpps, in the same order,
+    where info is the result of kpp.get_info(). Unlike prefetch_info(), kpps
+    are consumed lazily: with jobs > 1 presets are sent to worker processes
+    in batches, and at most 2*jobs batches are in flight, so only data of
+    these presets is held in memory at a time. jobs=0 means the number of CPUs.
+    """
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    if jobs <= 1:
+        for kpp in kpps:
+            yield kpp, kpp.get_info()
+        return
 
-else:
+    with ProcessPoolExecutor(jobs) as pool:
+        pending = deque()
 
-    class KPP(object):
-        def __init__(self, filename):
-            pass
+        def submit(batch):
+            todo = [kpp for kpp in batch if kpp.get_cached_info() is None]
+            future = None
+            if todo:
+                future = pool.submit(_parse_info_batch, [(kpp.filename, picklable(kpp.data)) for kpp in todo])
+            pending.append((batch, todo, future))
 
-        def check(self):
-            return dict()
+        def finish():
+            batch, todo, future = pending.popleft()
+            if future is not None:
+                for kpp, (info, messages) in zip(todo, future.result()):
+                    kpp.set_parsed_info(info, messages)
+            for kpp in batch:
+                yield kpp, kpp.get_info()
 
+        batch = []
+        for kpp in kpps:
+            batch.append(kpp)
+            if len(batch) >= INFO_BATCH_SIZE:
+                submit(batch)
+                batch = []
+                while len(pending) > 2 * jobs:
+                    for item in finish():
+                        yield item
+        if batch:
+            submit(batch)
+        while pending:
+            for item in finish():
+                yield item
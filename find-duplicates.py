@@ -0,0 +1,302 @@
+#!/usr/bin/python3
+# -*- encoding: utf-8 -*-
+
+import os
+import argparse
+import shutil
+import tempfile
+from collections import namedtuple, defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, basename, dirname, isdir, isfile, splitext
+from zipfile import ZipFile
+
+from extractor import KPP, PngError, REFERENCE_PARAMS, iter_info
+from bundle import Bundle, Manifest, MappedZip, md5, DEFAULT_MEMORY_BUDGET
+import cache
+import profiling
+
+RESOURCE_TYPES = ['brushes', 'patterns', 'paintoppresets']
+EXTENSIONS = {'.gbr': 'brushes', '.gih': 'brushes', '.abr': 'brushes', '.pat': 'patterns', '.kpp': 'paintoppresets'}
+
+Resource = namedtuple('Resource', ['source', 'path', 'mtype', 'size', 'is_bundle'])
+
+def resource_type(path):
+    mtype = EXTENSIONS.get(splitext(path)[1].lower())
+    if mtype is None and basename(dirname(path)) in RESOURCE_TYPES:
+        mtype = basename(dirname(path))
+    return mtype
+
+def scan_directory(directory, types):
+    result = []
+    for (d, _, files) in os.walk(directory):
+        for f in files:
+            if f.startswith('.'):
+                continue
+            path = join(d, f)
+            mtype = resource_type(path)
+            if mtype not in types:
+                continue
+            try:
+                size = os.stat(path).st_size
+            except OSError as e:
+                print("Warning: can't stat {}: {}".format(path, e))
+                continue
+            result.append((Resource(directory, path, mtype, size, False), None))
+    return result
+
+def scan_bundle(bundle, types):
+    """
+    Only the central directory and the manifest of the bundle are read.
+    """
+    result = []
+    with ZipFile(bundle, 'r') as zf:
+        try:
+            manifest = Manifest.parse(zf.read("META-INF/manifest.xml"))
+        except KeyError:
+            manifest = None
+        for item in zf.infolist():
+            if item.is_dir() or '/' not in item.filename:
+                continue
+            mtype = item.filename.split('/', 1)[0]
+            if mtype not in types:
+                continue
+            md5sum = manifest.get_md5(item.filename) if manifest is not None else None
+            if md5sum:
+                # manifests may have md5 sums in upper case
+                md5sum = md5sum.lower()
+            result.append((Resource(bundle, item.filename, mtype, item.file_size, True), md5sum))
+    return result
+
+def hash_resources(source, is_bundle, resources):
+    """
+    Calculate md5 sums of resources from one bundle (or of loose files),
+    reading them in chunks.
+    """
+    if is_bundle:
+        with MappedZip(source) as zf:
+            return [zf.md5(resource.path) for resource in resources]
+    else:
+        return [md5(resource.path) for resource in resources]
+
+def find_duplicates(sources, types, jobs=1, min_size=1):
+    """
+    Return list of (md5, [Resource...]) for groups of resources with equal
+    content, and list of all resources found. Resources are first grouped
+    by size, then by md5 sums from bundle manifests; files are read only
+    if their size matches size of some other resource and their md5 is not
+    known from a manifest or the cache.
+    """
+    resources = []
+    digests = dict()
+    with profiling.span('scan sources'):
+        for src in sources:
+            if isfile(src) and src.endswith(".bundle"):
+                found = scan_bundle(src, types)
+            elif isdir(src):
+                found = scan_directory(src, types)
+            else:
+                print("Error: {} is not a directory and is not a bundle file".format(src))
+                continue
+            for resource, md5sum in found:
+                resources.append(resource)
+                digests[resource] = md5sum
+
+    by_size = defaultdict(list)
+    for resource in resources:
+        if resource.size >= min_size:
+            by_size[resource.size].append(resource)
+
+    preset_cache = cache.get_cache()
+    todo = defaultdict(list)
+    for group in by_size.values():
+        if len(group) < 2:
+            continue
+        for resource in group:
+            if digests[resource] is not None:
+                continue
+            if not resource.is_bundle:
+                digests[resource] = preset_cache.get(preset_cache.digest_key(resource.path))
+                if digests[resource] is not None:
+                    continue
+            # members of one bundle are read by one thread, loose files are read separately
+            todo[(resource.source if resource.is_bundle else resource.path, resource.is_bundle)].append(resource)
+
+    with profiling.span('hash'):
+        if jobs == 0:
+            jobs = os.cpu_count() or 1
+        with ThreadPoolExecutor(max(1, jobs)) as pool:
+            futures = [(items, pool.submit(hash_resources, source, is_bundle, items))
+                       for (source, is_bundle), items in todo.items()]
+            for items, future in futures:
+                for resource, md5sum in zip(items, future.result()):
+                    digests[resource] = md5sum
+                    profiling.count('resources hashed')
+                    if not resource.is_bundle:
+                        preset_cache.put(preset_cache.digest_key(resource.path), md5sum)
+
+    by_digest = defaultdict(list)
+    for size, group in by_size.items():
+        if len(group) < 2:
+            continue
+        for resource in group:
+            by_digest[(size, digests[resource])].append(resource)
+
+    result = [(md5sum, group) for (size, md5sum), group in by_digest.items() if len(group) > 1]
+    result.sort(key=lambda item: -item[1][0].size * (len(item[1]) - 1))
+    return result, resources
+
+def plan_renames(groups, resources):
+    """
+    Return dictionary mapping (mtype, name) to name of canonical copy (first
+    one found in the order of sources). A name is renamed only if every
+    resource with this name, and every resource with the canonical name,
+    belongs to the same group of duplicates; otherwise links by name would
+    become ambiguous.
+    """
+    name_counts = Counter((r.mtype, basename(r.path)) for r in resources)
+    renames = dict()
+    for md5sum, group in groups:
+        canonical = group[0]
+        if canonical.mtype not in REFERENCE_PARAMS.values():
+            continue
+        group_counts = Counter((r.mtype, basename(r.path)) for r in group if r.mtype == canonical.mtype)
+        canonical_key = (canonical.mtype, basename(canonical.path))
+        if name_counts[canonical_key] != group_counts[canonical_key]:
+            continue
+        for key, count in group_counts.items():
+            if key != canonical_key and name_counts[key] == count:
+                renames[key] = canonical_key[1]
+    return renames
+
+def rewrite_presets(sources, renames, resources, jobs=1, dry_run=False):
+    """
+    Change links in presets found in sources according to renames.
+    Loose preset files are replaced, bundles are rewritten (and saved with
+    .bak suffix first). Links are changed only if the canonical copy is in
+    the same bundle or directory as the preset. Sources are processed one
+    by one, and presets of each are parsed in batches, so only a part of
+    them is held in memory at a time.
+    """
+    # directory => (mtype, name) of resources found in it
+    available = defaultdict(set)
+    for resource in resources:
+        if not resource.is_bundle:
+            available[resource.source].add((resource.mtype, basename(resource.path)))
+
+    def new_names(kpp, where, has_resource):
+        """
+        Return renames which apply to references of the preset.
+        """
+        result = dict()
+        for mtype, value in kpp.get_references():
+            key = (mtype, basename(value))
+            name = renames.get(key)
+            if name is None:
+                continue
+            if not has_resource(mtype, name):
+                print("Warning: {}: {} {} is not changed to {}, which is not found in the same source".format(where, mtype, key[1], name))
+                continue
+            result[key] = name
+        return result
+
+    def report(names, where):
+        for (mtype, old), new in sorted(names.items()):
+            print("{}: {} {} -> {}".format(where, mtype, old, new))
+
+    for src in sources:
+        if isfile(src) and src.endswith(".bundle"):
+            rewrite_bundle(src, new_names, report, jobs, dry_run)
+        elif isdir(src):
+            has_resource = lambda mtype, name: (mtype, name) in available[src]
+            kpps = (KPP(r.path) for r, _ in scan_directory(src, ['paintoppresets']))
+            for kpp, _ in iter_info(kpps, jobs):
+                names = new_names(kpp, kpp.filename, has_resource)
+                if not names:
+                    continue
+                report(names, kpp.filename)
+                if dry_run:
+                    continue
+                try:
+                    data = kpp.with_links(names)
+                except PngError as e:
+                    print("Error: can't rewrite {}: {}".format(kpp.filename, e))
+                    continue
+                if data is None:
+                    continue
+                tmpname = kpp.filename + '.tmp'
+                with open(tmpname, 'wb') as f:
+                    f.write(data)
+                shutil.copymode(kpp.filename, tmpname)
+                os.replace(tmpname, kpp.filename)
+
+def rewrite_bundle(src, new_names, report, jobs=1, dry_run=False):
+    """
+    Change links in presets of one bundle; see rewrite_presets().
+    """
+    with Bundle.open(src, lazy=True, memory_budget=DEFAULT_MEMORY_BUDGET) as bundle:
+        has_resource = lambda mtype, name: bundle.find_resource(mtype, name) is not None
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = []
+            for kpp, _ in iter_info(bundle.presets_data, jobs):
+                where = "{}:{}".format(src, kpp.filename)
+                names = new_names(kpp, where, has_resource)
+                if not names:
+                    continue
+                report(names, where)
+                if dry_run:
+                    continue
+                try:
+                    data = kpp.with_links(names)
+                except PngError as e:
+                    print("Error: can't rewrite {} in {}: {}".format(kpp.filename, src, e))
+                    continue
+                if data is None:
+                    continue
+                path = join(tmpdir, basename(kpp.filename))
+                with open(path, 'wb') as f:
+                    f.write(data)
+                paths.append(path)
+            if paths:
+                shutil.copy(src, src+'.bak')
+                bundle.add_presets(src, paths)
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description="Find duplicate resource files in bundles and directories")
+    parser.add_argument('sources', metavar='SOURCE', nargs='+', help="Bundle file or directory with resource files")
+    parser.add_argument('-t', '--type', action='append', choices=RESOURCE_TYPES, dest='types',
+                        help="Type of resources to check: brushes, patterns or paintoppresets; may be specified several times. Default is brushes and patterns.")
+    parser.add_argument('--min-size', type=int, default=1, metavar='BYTES', help="Ignore files smaller than this")
+    parser.add_argument('--rewrite', action='store_true', help="Change links in presets found in sources to refer to the first copy of duplicate brush tips and patterns")
+    parser.add_argument('-n', '--dry-run', action='store_true', help="With --rewrite, only print which links would be changed")
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N', help='Number of threads used to hash files; 0 means number of CPUs')
+    cache.add_cmdline_options(parser)
+    profiling.add_cmdline_options(parser)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+
+    args = parse_cmdline()
+    cache.configure(enabled=not args.no_cache)
+    profiling.configure_from_args(args)
+    types = args.types or ['brushes', 'patterns']
+
+    groups, resources = find_duplicates(args.sources, types, args.jobs, args.min_size)
+
+    wasted = 0
+    copies = 0
+    for md5sum, group in groups:
+        size = group[0].size
+        print("{} copies of {} bytes, md5 {}:".format(len(group), size, md5sum))
+        for resource in group:
+            if resource.is_bundle:
+                print("    {} in {}".format(resource.path, resource.source))
+            else:
+                print("    {}".format(resource.path))
+        wasted += size * (len(group) - 1)
+        copies += len(group) - 1
+    print("Scanned {} resources; found {} groups of duplicates, {} redundant copies, {} bytes wasted.".format(len(resources), len(groups), copies, wasted))
+
+    if args.rewrite:
+        renames = plan_renames(groups, resources)
+        if renames:
+            rewrite_presets(args.sources, renames, resources, args.jobs, args.dry_run)
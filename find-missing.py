@@ -5,48 +5,44 @@ import os
 import sys
 import argparse
 import shutil
+import tempfile
 from glob import glob
 from os.path import join, basename, exists
 
 from extractor import KPP
-from bundle import Bundle
+from bundle import Bundle, ResourceResolver, DEFAULT_MEMORY_BUDGET
+import cache
+import profiling
 
 def parse_cmdline():
     parser = argparse.ArgumentParser(description="Find resources that are used by the bundle, but not included into it")
-    parser.add_argument('-b', '--brushes', nargs=1, metavar='DIRECTORY', help='Directory with brush files')
+    parser.add_argument('-b', '--brushes', action='append', metavar='DIRECTORY', help='Directory or bundle file with brush files; may be specified several times')
     parser.add_argument('--embed', action='store_true', help='Automatically embed found resources to the bundle')
     parser.add_argument('-d', '--delete', action='store_true', help='Automatically remove found resource from bundle\'s manifest')
     parser.add_argument('bundle', metavar='FILE.BUNDLE', help="Path to bundle file to inspect")
+    cache.add_cmdline_options(parser)
+    profiling.add_cmdline_options(parser)
     return parser.parse_args()
 
 def find_used(bundle_path):
 
     def process_kpp(kpp):
-        links = kpp.get_links()
-        requiredBrushFile = links.get('requiredBrushFile', None)
-        if requiredBrushFile:
-            return [requiredBrushFile]
-        else:
-            return []
+        return [name for mtype, name in kpp.get_references() if mtype == 'brushes']
 
-    bundle = Bundle.open(bundle_path)
+    bundle = Bundle.open(bundle_path, lazy=True, memory_budget=DEFAULT_MEMORY_BUDGET)
     presets = bundle.presets_data
     used = []
     for kpp in presets:
         used.extend(process_kpp(kpp))
     result = [brush for brush in used if not bundle.find_brush(brush)]
+    bundle.close()
     return set(result)
 
-def find_brush(paths, name):
-    for path in paths:
-        b = join(path, name)
-        if exists(b):
-            return b
-    return None
-
 if __name__ == '__main__':
 
     args = parse_cmdline()
+    cache.configure(enabled=not args.no_cache)
+    profiling.configure_from_args(args)
     if not args.bundle:
         print("Error: path to bundle must be specified")
         sys.exit(1)
@@ -60,22 +56,28 @@ if __name__ == '__main__':
             print("Error: if --embed mode is on, --brushes must be specified")
             sys.exit(1)
 
-        bundle = Bundle.open(args.bundle)
+        bundle = Bundle.open(args.bundle, lazy=True)
         shutil.copy(args.bundle, args.bundle+'.bak')
         
-        found = []
-        for brush in used:
-            path = find_brush(args.brushes, brush)
-            if path:
+        with ResourceResolver(args.brushes) as resolver, tempfile.TemporaryDirectory() as tmpdir:
+            found = []
+            for brush in used:
+                resource = resolver.find('brushes', brush)
+                if resource is None:
+                    print("Warning: can't find "+brush)
+                    continue
+                if resource.is_bundle:
+                    path = join(tmpdir, basename(brush))
+                    resolver.extract('brushes', brush, path)
+                else:
+                    path = resource.path
                 found.append(path)
                 print("Added " + brush)
-            else:
-                print("Warning: can't find "+brush)
 
-        bundle.add_brushes(args.bundle, found)
+            bundle.add_brushes(args.bundle, found)
 
     elif args.delete and len(used):
-        bundle = Bundle.open(args.bundle)
+        bundle = Bundle.open(args.bundle, lazy=True)
         shutil.copy(args.bundle, args.bundle+'.bak')
         bundle.remove_brushes_from_manifest(args.bundle, used)
 
@@ -1,89 +1,103 @@
 #!/usr/bin/python3
-# -*- encoding: utf-8 -*- 
+# -*- encoding: utf-8 -*-
 
 import os
 import sys
 import argparse
-from glob import glob
+from glob import iglob
+from itertools import chain
 from os.path import join, basename
 
-from extractor import KPP
+from extractor import KPP, iter_info
 from bundle import Bundle
+import cache
+import profiling
 
-def find_used(filenames):
+# types of resources presets may refer to
+RESOURCE_TYPES = ['brushes', 'patterns', 'gradients']
 
-    def process_kpp(kpp):
-        links = kpp.get_links()
-        requiredBrushFile = links.get('requiredBrushFile', None)
-        if requiredBrushFile:
-            return [requiredBrushFile]
-        else:
-            return []
-
-    def process(filename):
+def iter_presets(filenames):
+    """
+    Yield presets from *.kpp files and bundles. Bundles are opened one at
+    a time, and their members are not kept in memory after they are read.
+    """
+    for filename in filenames:
         if filename.endswith(".bundle"):
-            bundle = Bundle.open(filename)
-            presets = bundle.presets_data
+            with Bundle.open(filename, lazy=True, memory_budget=0) as bundle:
+                for kpp in bundle.presets_data:
+                    yield kpp
         else:
-            presets = [KPP(filename)]
-        result = []
-        for kpp in presets:
-            result.extend(process_kpp(kpp))
-        return result
+            yield KPP(filename)
 
-    result = []
-    for filename in filenames:
-        result.extend(process(filename))
+def iter_links(filenames, jobs=1):
+    """
+    Yield (preset, mtype, name) for each link from presets to other resources.
+    """
+    for kpp, info in iter_info(iter_presets(filenames), jobs):
+        for mtype, name in info['references']:
+            yield kpp.filename, mtype, basename(name)
+
+def find_used(filenames, jobs=1):
+    """
+    Return dictionary mapping resource type to set of names of resources
+    used by presets from filenames.
+    """
+    result = dict((mtype, set()) for mtype in RESOURCE_TYPES)
+    for _, mtype, name in iter_links(filenames, jobs):
+        result[mtype].add(name)
     return result
 
 def parse_cmdline():
-    parser = argparse.ArgumentParser(description="Find unused brush files")
-    parser.add_argument('-b', '--brushes', nargs=1, metavar='DIRECTORY', help='Directory with brush files')
-    parser.add_argument('-p', '--presets', nargs=1, metavar='DIRECTORY', help='Directory with preset files (*.kpp)', required=True)
-    parser.add_argument('-B', '--bundles', nargs=1, metavar='DIRECTORY', help='Directory with bundle files (*.bundle)')
-    parser.add_argument('-i', '--invert', action='store_true', help='Find used brushes instead of unused')
-    parser.add_argument('--remove', action='store_true', help='Remove unused brush files')
+    parser = argparse.ArgumentParser(description="Find unused brush, pattern and gradient files")
+    parser.add_argument('-b', '--brushes', action='append', metavar='DIRECTORY', help='Directory with brush files')
+    parser.add_argument('-P', '--patterns', action='append', metavar='DIRECTORY', help='Directory with pattern files')
+    parser.add_argument('-g', '--gradients', action='append', metavar='DIRECTORY', help='Directory with gradient files')
+    parser.add_argument('-p', '--presets', action='append', metavar='DIRECTORY', help='Directory with preset files (*.kpp)', required=True)
+    parser.add_argument('-B', '--bundles', action='append', metavar='DIRECTORY', help='Directory with bundle files (*.bundle)')
+    parser.add_argument('-i', '--invert', action='store_true', help='Find used resources instead of unused')
+    parser.add_argument('--remove', action='store_true', help='Remove unused resource files')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N', help='Number of parallel processes used to read presets; 0 means number of CPUs')
+    cache.add_cmdline_options(parser)
+    profiling.add_cmdline_options(parser)
     return parser.parse_args()
 
 if __name__ == '__main__':
 
     args = parse_cmdline()
+    cache.configure(enabled=not args.no_cache)
+    profiling.configure_from_args(args)
     #print(args)
-    if not args.invert and not args.brushes:
-        print("Error: brush files directory must be specified if -i/--invert is not used")
+    if not args.invert and not args.brushes and not args.patterns and not args.gradients:
+        print("Error: brush, pattern or gradient files directory must be specified if -i/--invert is not used")
         sys.exit(1)
 
-    presets = []
-    for p in args.presets:
-        presets.extend(glob(join(p, '*')))
-    if args.bundles:
-        for p in args.bundles:
-            presets.extend(glob(join(p, '*')))
+    directories = args.presets + (args.bundles or [])
+    presets = chain.from_iterable(iglob(join(p, '*')) for p in directories)
 
-    used = set()
-    used.update( find_used(presets) )
+    used = find_used(presets, args.jobs)
 
     if args.invert:
-        for b in used:
-            print(b)
+        for mtype in sorted(used):
+            for name in sorted(used[mtype]):
+                print(name)
     else:
 
-        brushes = set()
-        brushmap = dict()
-        for p in args.brushes:
-            for b in glob(join(p, '*')):
-                brushes.add(basename(b))
-                brushmap[basename(b)] = b
-        result = brushes.difference(used)
-        if args.remove:
-            for b in result:
-                try:
-                    os.remove(brushmap[b])
-                except Exception as e:
-                    print("Can't remove {}: {}".format(b, e))
-                else:
-                    print("Removed " + brushmap[b])
-        else:
-            for b in result:
-                print(b)
-
+        for mtype, dirs in (('brushes', args.brushes), ('patterns', args.patterns), ('gradients', args.gradients)):
+            if not dirs:
+                continue
+            filemap = dict()
+            for p in dirs:
+                for f in iglob(join(p, '*')):
+                    filemap[basename(f)] = f
+            result = set(filemap).difference(used[mtype])
+            if args.remove:
+                for name in sorted(result):
+                    try:
+                        os.remove(filemap[name])
+                    except Exception as e:
+                        print("Can't remove {}: {}".format(name, e))
+                    else:
+                        print("Removed " + filemap[name])
+            else:
+                for name in sorted(result):
+                    print(name)
@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+# -*- encoding: utf-8 -*-
+
+import sys
+import hashlib
+import argparse
+from collections import namedtuple, OrderedDict
+from os.path import basename, splitext
+
+from lxml import etree
+
+from extractor import KPP, PngError
+from bundle import Bundle, Meta, Manifest, MappedZip, BundleWriter, MIMETYPE
+import cache
+import profiling
+
+POLICIES = ['first', 'last', 'fail', 'rename']
+
+# one member of the merged bundle: where it comes from and under which name it
+# goes; data is set for presets whose links were changed
+Member = namedtuple('Member', ['path', 'mtype', 'md5', 'source', 'zinfo', 'data'])
+
+class Input(object):
+    """
+    Input bundle: the archive, its manifest and meta.xml. Members are not read.
+    """
+
+    def __init__(self, zipname):
+        self.zipname = zipname
+        self.zipfile = MappedZip(zipname)
+        names = self.zipfile.NameToInfo
+        self.manifest = Manifest.parse(self.zipfile.read("META-INF/manifest.xml"))
+        self.meta = None
+        if "meta.xml" in names:
+            try:
+                self.meta = Meta.parse(self.zipfile.read("meta.xml"))
+            except etree.XMLSyntaxError as e:
+                print("Warning: {}: can not parse meta.xml: {}".format(zipname, e))
+        # (mtype, old name) => new name, for resources renamed on conflicts
+        self.renames = dict()
+        # keys of renames which some preset of this bundle was relinked to
+        self.relinked = set()
+
+    def members(self):
+        """
+        Yield Member for each resource present in the archive, in manifest order.
+        md5 sums missing from the manifest are calculated from member data.
+        """
+        names = self.zipfile.NameToInfo
+        for path, mtype, md5sum in self.manifest.entries():
+            if mtype == MIMETYPE:
+                continue
+            zinfo = names.get(path)
+            if zinfo is None:
+                print("Warning: bundle {} does not contain resource {}, which is referred in its manifest.".format(self.zipname, path))
+                continue
+            if not md5sum:
+                md5sum = self.zipfile.md5(path)
+            yield Member(path, mtype, md5sum.lower(), self, zinfo, None)
+
+    def close(self):
+        self.zipfile.close()
+
+def free_name(path, taken, index):
+    """
+    Return path with input number added to its name, which is not in taken.
+    """
+    stem, ext = splitext(path)
+    candidate = "{}_{}{}".format(stem, index, ext)
+    n = 2
+    while candidate in taken:
+        candidate = "{}_{}_{}{}".format(stem, index, n, ext)
+        n += 1
+    return candidate
+
+@profiling.timed('plan merge')
+def plan_merge(inputs, policy='first'):
+    """
+    Return (OrderedDict of output path => Member, number of duplicates
+    skipped, list of conflicts as (path, kept Member, other Member)), where
+    other Member is the one dropped or renamed.
+    Resources with the same path and the same md5 sum are stored once.
+    Resources with the same path and different content are resolved by
+    policy: keep the first or the last one, or keep both, renaming the
+    later one (links from presets of its bundle are changed accordingly).
+    Presets of each bundle are taken after its other resources, so that
+    they are compared by content with links already changed.
+    """
+    merged = OrderedDict()
+    duplicates = 0
+    conflicts = []
+    for index, source in enumerate(inputs, 1):
+        members = list(source.members())
+        presets = [member for member in members if member.mtype == 'paintoppresets']
+        others = [member for member in members if member.mtype != 'paintoppresets']
+        for member in others + presets:
+            if member.mtype == 'paintoppresets':
+                relinked = relinked_preset(member)
+                if relinked is not None:
+                    data, md5sum = relinked
+                    member = member._replace(md5=md5sum, data=data)
+            existing = merged.get(member.path)
+            if existing is None:
+                merged[member.path] = member
+            elif existing.md5 == member.md5:
+                duplicates += 1
+            elif policy == 'last':
+                conflicts.append((member.path, member, existing))
+                merged[member.path] = member
+            elif policy == 'rename':
+                new_path = free_name(member.path, merged, index)
+                renamed = member._replace(path=new_path)
+                conflicts.append((member.path, existing, renamed))
+                source.renames[(member.mtype, basename(member.path))] = basename(new_path)
+                merged[new_path] = renamed
+            else:
+                conflicts.append((member.path, existing, member))
+    for source in inputs:
+        for key, new_name in source.renames.items():
+            mtype, old_name = key
+            if mtype != 'paintoppresets' and key not in source.relinked:
+                print("Warning: {} {} from {} is renamed to {}, but no preset refers to it".format(
+                        mtype, old_name, source.zipname, new_name))
+    return merged, duplicates, conflicts
+
+def relinked_preset(member):
+    """
+    Return (data, md5) of preset with links changed to resources renamed
+    in its bundle, or None if the preset does not need to be changed.
+    """
+    renames = member.source.renames
+    if not renames:
+        return None
+    kpp = KPP(member.path, member.source.zipfile.read(member.zinfo.filename), member.md5)
+    names = dict()
+    for mtype, value in kpp.get_references():
+        key = (mtype, basename(value))
+        if key in renames:
+            names[key] = renames[key]
+    if not names:
+        return None
+    member.source.relinked.update(names)
+    try:
+        data = kpp.with_links(names)
+    except PngError as e:
+        print("Error: can not change links in {} from {}: {}".format(member.path, member.source.zipname, e))
+        return None
+    if data is None:
+        return None
+    return data, hashlib.md5(data).hexdigest()
+
+def merge_meta(inputs):
+    """
+    meta.xml of the first bundle, with authors and creators of all bundles.
+    """
+    metas = [source.meta for source in inputs if source.meta is not None]
+    meta = Meta()
+    if metas:
+        meta = metas[0]
+        authors = []
+        for m in metas:
+            if m.author not in authors:
+                authors.append(m.author)
+        meta.author = meta.creator = ", ".join(authors)
+    return meta
+
+@profiling.timed('write merged bundle')
+def write_merged(output, inputs, merged, meta, preview=None):
+    """
+    Write merged bundle to a temporary file, then move it to output.
+    Members are copied from input archives as is, except presets whose
+    links were changed by plan_merge(). preview is a path of preview file; by default
+    preview.png of the first bundle which has it is copied.
+    """
+    def write(tmpname):
+        with BundleWriter(tmpname) as writer:
+            writer.writestr("meta.xml", meta.tostring())
+            if preview is not None:
+                writer.write(preview, "preview.png")
+            else:
+                for source in inputs:
+                    zinfo = source.zipfile.NameToInfo.get("preview.png")
+                    if zinfo is not None:
+                        writer.copy_raw(source.zipfile, zinfo)
+                        break
+            for path, member in merged.items():
+                if member.data is not None:
+                    writer.writestr(path, member.data)
+                    writer.manifest.manifest_entry(member.mtype, path, md5sum=member.md5)
+                    continue
+                writer.copy_raw(member.source.zipfile, member.zinfo, path)
+                writer.manifest.manifest_entry(member.mtype, path, md5sum=member.md5)
+
+    Bundle.replace_zip(output, write)
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description="Merge several bundle files into one, without extracting them")
+    parser.add_argument('output', metavar='OUTPUT.BUNDLE', help="Bundle file to create")
+    parser.add_argument('inputs', metavar='INPUT.BUNDLE', nargs='+', help="Bundle files to merge")
+    parser.add_argument('-c', '--on-conflict', choices=POLICIES, default='first',
+                        help="What to do with resources which have the same name but different content: keep the first or the last one, fail, or keep all of them, renaming later ones. Default is first.")
+    parser.add_argument('--preview', metavar='FILE.PNG', help="Preview image; by default it is taken from the first bundle")
+    parser.add_argument('--author', help="Author of the merged bundle; by default authors of all bundles are listed")
+    parser.add_argument('--description', help="Description of the merged bundle; by default it is taken from the first bundle")
+    parser.add_argument('--license', help="License of the merged bundle")
+    parser.add_argument('--website', help="Website of the merged bundle")
+    parser.add_argument('--email', help="Email of the author of the merged bundle")
+    cache.add_cmdline_options(parser)
+    profiling.add_cmdline_options(parser)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+
+    args = parse_cmdline()
+    cache.configure(enabled=not args.no_cache)
+    profiling.configure_from_args(args)
+
+    inputs = []
+    for zipname in args.inputs:
+        try:
+            inputs.append(Input(zipname))
+        except Exception as e:
+            print("Error: can not read bundle {}: {}".format(zipname, e))
+            sys.exit(1)
+
+    merged, duplicates, conflicts = plan_merge(inputs, args.on_conflict)
+    for path, kept, other in conflicts:
+        if args.on_conflict == 'fail':
+            print("Conflict: {} differs in {} and {}".format(path, kept.source.zipname, other.source.zipname))
+        elif args.on_conflict == 'rename':
+            print("Conflict: {} differs in {} and {}; the latter is renamed to {}".format(path, kept.source.zipname, other.source.zipname, other.path))
+        else:
+            print("Conflict: {} differs in {} and {}; using the one from {}".format(path, kept.source.zipname, other.source.zipname, kept.source.zipname))
+    if conflicts and args.on_conflict == 'fail':
+        sys.exit(1)
+
+    meta = merge_meta(inputs)
+    for field in ('author', 'description', 'license', 'website', 'email'):
+        value = getattr(args, field)
+        if value is not None:
+            setattr(meta, field, value)
+    if args.author is not None:
+        meta.creator = args.author
+
+    write_merged(args.output, inputs, merged, meta, args.preview)
+    for source in inputs:
+        source.close()
+    print("Merged {} bundles into {}: {} resources, {} duplicates skipped, {} conflicts.".format(
+            len(inputs), args.output, len(merged), duplicates, len(conflicts)))
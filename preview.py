@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Generation of bundle preview: a contact sheet composed of icons of presets
+(the images of *.kpp files themselves).
+
+Icons are rendered in worker processes. Thumbnails are stored in the
+persistent cache (see cache.py) by md5 sum of the preset file and their size,
+so when the bundle is built again only icons of changed presets are rendered.
+Requires PIL or Pillow; without it a blank preview is made.
+"""
+
+import io
+import os
+import math
+import struct
+import zlib
+import base64
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+from extractor import PNG_SIGNATURE, load_pillow, picklable
+from cache import get_cache
+import profiling
+
+# Size of preview.png, in pixels
+PREVIEW_SIZE = 256
+# Maximum number of preset icons on the preview
+PREVIEW_PRESETS = 16
+BACKGROUND = (255, 255, 255, 255)
+
+def preset_md5(kpp):
+    """
+    Return md5 sum of preset file. md5 sums of loose files are taken from
+    the cache, if they are known; otherwise they are stored in it, so that
+    the file need not be read again when it is written into the bundle.
+    """
+    if kpp.md5 is not None:
+        return kpp.md5
+    if kpp.data is not None:
+        return hashlib.md5(kpp.data).hexdigest()
+    cache = get_cache()
+    key = cache.digest_key(kpp.filename)
+    md5sum = cache.get(key)
+    if md5sum is None:
+        m = hashlib.md5()
+        with open(kpp.filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                m.update(chunk)
+        md5sum = m.hexdigest()
+        cache.put(key, md5sum)
+    return md5sum
+
+def render_thumbnail(source, size):
+    """
+    Return PNG data of preset icon from source (file name or bytes-like
+    object) scaled down to fit into size x size square. The image is first
+    reduced by an integer factor, which is much cheaper than resampling the
+    whole image.
+    """
+    Image = load_pillow()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    with Image.open(source) as image:
+        if image.mode != 'RGBA':
+            image = image.convert('RGBA')
+        image.thumbnail((size, size), Image.LANCZOS, reducing_gap=2.0)
+        result = io.BytesIO()
+        image.save(result, 'PNG')
+    return result.getvalue()
+
+def _render(item):
+    filename, data, size = item
+    try:
+        return render_thumbnail(data if data is not None else filename, size), None
+    except Exception as e:
+        return None, "Warning: can not make thumbnail of {}: {}".format(filename, e)
+
+@profiling.timed('thumbnails')
+def render_thumbnails(kpps, size, jobs=1):
+    """
+    Return list of PNG data of thumbnails of given presets (None for
+    presets which can not be read), taking them from the cache where
+    possible. Other thumbnails are rendered in `jobs` worker processes;
+    jobs=0 means the number of CPUs.
+    """
+    cache = get_cache()
+    keys = []
+    broken = set()
+    for i, kpp in enumerate(kpps):
+        try:
+            keys.append(cache.thumbnail_key(preset_md5(kpp), size))
+        except OSError as e:
+            print("Warning: can not make thumbnail of {}: {}".format(kpp.filename, e))
+            keys.append(None)
+            broken.add(i)
+    result = []
+    todo = []
+    for i, (kpp, key) in enumerate(zip(kpps, keys)):
+        if i in broken:
+            result.append(None)
+            continue
+        cached = cache.get(key)
+        if cached is not None:
+            result.append(base64.b64decode(cached))
+        else:
+            result.append(None)
+            # loose files are read by workers themselves
+            todo.append((i, (kpp.filename, picklable(kpp.data), size)))
+
+    if jobs == 0:
+        jobs = os.cpu_count() or 1
+    items = [item for _, item in todo]
+    if jobs > 1 and len(todo) > 1:
+        with ProcessPoolExecutor(min(jobs, len(todo))) as pool:
+            rendered = list(pool.map(_render, items))
+    else:
+        rendered = [_render(item) for item in items]
+
+    for (i, _), (data, message) in zip(todo, rendered):
+        profiling.count('thumbnails rendered')
+        if message is not None:
+            print(message)
+        if data is not None:
+            result[i] = data
+            cache.put(keys[i], base64.b64encode(data).decode('ascii'))
+    return result
+
+def contact_sheet(thumbnails, size=PREVIEW_SIZE):
+    """
+    Return PNG data of size x size image with thumbnails (PNG data, each
+    no larger than grid_cell(len(thumbnails), size)) placed on a square
+    grid, centered in their cells.
+    """
+    Image = load_pillow()
+    columns = grid_columns(len(thumbnails))
+    cell = size // columns
+    offset = (size - cell * columns) // 2
+    sheet = Image.new('RGBA', (size, size), BACKGROUND)
+    for i, data in enumerate(thumbnails):
+        with Image.open(io.BytesIO(data)) as thumbnail:
+            thumbnail = thumbnail.convert('RGBA')
+            row, column = divmod(i, columns)
+            x = offset + column * cell + (cell - thumbnail.width) // 2
+            y = offset + row * cell + (cell - thumbnail.height) // 2
+            sheet.alpha_composite(thumbnail, (x, y))
+    result = io.BytesIO()
+    sheet.convert('RGB').save(result, 'PNG')
+    return result.getvalue()
+
+def grid_columns(count):
+    return max(1, int(math.ceil(math.sqrt(count))))
+
+def grid_cell(count, size=PREVIEW_SIZE):
+    return size // grid_columns(count)
+
+def _png_chunk(ctype, data):
+    return struct.pack('>I4s', len(data), ctype) + data + struct.pack('>I', zlib.crc32(data, zlib.crc32(ctype)))
+
+def blank_preview(size=PREVIEW_SIZE):
+    """
+    Return PNG data of size x size image filled with background color.
+    Does not need Pillow.
+    """
+    row = b'\0' + bytes(BACKGROUND[:3]) * size
+    header = struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)
+    return (PNG_SIGNATURE + _png_chunk(b'IHDR', header) +
+            _png_chunk(b'IDAT', zlib.compress(row * size)) + _png_chunk(b'IEND', b''))
+
+@profiling.timed('make preview')
+def make_preview(kpps, size=PREVIEW_SIZE, count=PREVIEW_PRESETS, jobs=1):
+    """
+    Return PNG data of preview composed of icons of the first `count`
+    presets that can be read. If Pillow is not available or no preset
+    icon can be read, the preview is blank.
+    """
+    if not load_pillow():
+        print("Warning: PIL or Pillow is required to make preview from preset icons")
+        return blank_preview(size)
+    kpps = list(kpps)[:count]
+    thumbnails = render_thumbnails(kpps, grid_cell(len(kpps), size), jobs)
+    # icons of broken presets are skipped; the rest still fit into their cells
+    thumbnails = [data for data in thumbnails if data is not None]
+    if not thumbnails:
+        return blank_preview(size)
+    return contact_sheet(thumbnails, size)
@@ -0,0 +1,199 @@
+# encoding: utf-8
+"""
+Lightweight instrumentation: named timing spans and counters.
+
+    with profiling.span("check"):
+        ...
+    profiling.count("bytes read", len(data))
+
+Spans may be nested; time is accumulated per path of nested span names, so
+the report shows where time of each phase goes. Profiling is disabled by
+default: span() then returns a shared no-op context manager and count()
+returns immediately, so instrumented code pays about one function call.
+Command line tools enable it with --profile; the report is printed when the
+process exits. Worker processes (see extractor.prefetch_info) are not
+profiled, their time is seen as time of the span which waits for them.
+"""
+
+import sys
+import json
+import time
+import atexit
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class Span(object):
+    __slots__ = ('profiler', 'name', 'path', 'started')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        stack = self.profiler._stack()
+        self.path = stack[-1] + (self.name,) if stack else (self.name,)
+        stack.append(self.path)
+        self.profiler._register(self.path)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        elapsed = time.perf_counter() - self.started
+        self.profiler._stack().pop()
+        self.profiler._record(self.path, elapsed)
+        return False
+
+class Profiler(object):
+    """
+    Collects timings of spans and values of counters.
+    Spans opened in other threads start a new tree.
+    """
+
+    def __init__(self, cprofile_path=None):
+        self.spans = OrderedDict()  # path => [calls, seconds]
+        self.counters = OrderedDict()
+        self.started = time.perf_counter()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.cprofile_path = cprofile_path
+        self._cprofile = None
+        if cprofile_path is not None:
+            import cProfile
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _register(self, path):
+        # register on enter, so that parents are listed before their children
+        if path not in self.spans:
+            with self._lock:
+                self.spans.setdefault(path, [0, 0.0])
+
+    def _record(self, path, seconds):
+        with self._lock:
+            entry = self.spans[path]
+            entry[0] += 1
+            entry[1] += seconds
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def stop(self):
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(self.cprofile_path)
+            self._cprofile = None
+        return time.perf_counter() - self.started
+
+    def to_dict(self, wall_time):
+        spans = [dict(name="/".join(path), calls=calls, seconds=seconds)
+                 for path, (calls, seconds) in self.spans.items()]
+        return dict(wall_time=wall_time, spans=spans, counters=dict(self.counters))
+
+    def report(self, wall_time):
+        lines = ["Profile: total wall time {:.3f} s".format(wall_time)]
+        for path, (calls, seconds) in self.spans.items():
+            label = "  " * len(path) + path[-1]
+            share = 100.0 * seconds / wall_time if wall_time else 0.0
+            lines.append("{:<40} {:9.3f} s {:5.1f}% {:8} calls".format(label, seconds, share, calls))
+        if self.counters:
+            lines.append("Counters:")
+            for name, value in self.counters.items():
+                lines.append("  {:<38} {:>12}".format(name, value))
+        if self.cprofile_path is not None:
+            lines.append("cProfile stats written to {}".format(self.cprofile_path))
+        return "\n".join(lines)
+
+_profiler = None
+_format = None
+_output = None
+
+def configure(mode=None, output=None, cprofile_path=None):
+    """
+    Enable profiling. mode is 'text' or 'json' (None disables profiling),
+    output is file name for the report (stderr by default), cprofile_path
+    is file name for cProfile stats, which are collected only if it is set.
+    """
+    global _profiler, _format, _output
+    _format = mode
+    _output = output
+    if mode is None and cprofile_path is None:
+        _profiler = None
+    else:
+        _profiler = Profiler(cprofile_path)
+    return _profiler
+
+def is_enabled():
+    return _profiler is not None
+
+def span(name):
+    if _profiler is None:
+        return _NULL_SPAN
+    return Span(_profiler, name)
+
+def count(name, value=1):
+    if _profiler is None:
+        return
+    _profiler.count(name, value)
+
+def timed(name):
+    """
+    Decorator: run function within span of given name.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if _profiler is None:
+                return function(*args, **kwargs)
+            with Span(_profiler, name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def report():
+    """
+    Stop profiling and print or write the report.
+    """
+    global _profiler
+    if _profiler is None:
+        return
+    profiler, _profiler = _profiler, None
+    wall_time = profiler.stop()
+    if _format == 'json':
+        text = json.dumps(profiler.to_dict(wall_time), indent=2)
+    elif _format is not None:
+        text = profiler.report(wall_time)
+    else:
+        return
+    if _output is None:
+        print(text, file=sys.stderr)
+    else:
+        with open(_output, 'w') as f:
+            f.write(text + "\n")
+
+atexit.register(report)
+
+def add_cmdline_options(parser):
+    parser.add_argument('--profile', nargs='?', const='text', choices=['text', 'json'],
+                        help="Print time spent in each phase and counters of work done on exit, as text (default) or JSON")
+    parser.add_argument('--profile-output', metavar='FILE', help="Write profile report to FILE instead of stderr")
+    parser.add_argument('--cprofile', metavar='FILE.PROF', help="Collect cProfile statistics and dump them to FILE.PROF")
+
+def configure_from_args(args):
+    return configure(args.profile, output=args.profile_output, cprofile_path=args.cprofile)
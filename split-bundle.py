@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+# -*- encoding: utf-8 -*-
+
+import os
+import sys
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from os.path import join, basename, dirname, splitext
+
+from extractor import iter_info
+from zipfile import ZIP64_LIMIT
+
+from bundle import Bundle, Manifest, MappedZip, BundleWriter, MIMETYPE, LOCAL_HEADER_SIZE
+import cache
+import profiling
+
+SIZE_SUFFIXES = dict(K=1024, M=1024**2, G=1024**3)
+
+# Sizes of fixed parts of zip central directory record and end of central
+# directory record
+CENTRAL_HEADER_SIZE = 46
+END_RECORD_SIZE = 22
+# zip64 end of central directory record and its locator; they are counted
+# always, so that estimated sizes of shards are upper bounds
+ZIP64_END_SIZE = 56 + 20
+MANIFEST_NAME = "META-INF/manifest.xml"
+# md5 sums missing from the manifest are calculated; they have the same length
+MD5_PLACEHOLDER = "0" * 32
+
+def member_size(zinfo, zip64_offsets=False):
+    """
+    Return number of bytes taken by member copied by BundleWriter.copy_raw():
+    local header, data and central directory record. zip64_offsets tells
+    that the member may be placed beyond 4 GB.
+    """
+    name = len(zinfo.filename.encode('utf-8'))
+    big = zinfo.file_size > ZIP64_LIMIT or zinfo.compress_size > ZIP64_LIMIT
+    local = LOCAL_HEADER_SIZE + name + (20 if big else 0)
+    extra = (16 if big else 0) + (8 if zip64_offsets else 0)
+    central = CENTRAL_HEADER_SIZE + name + len(zinfo.comment) + (4 + extra if extra else 0)
+    return local + zinfo.compress_size + central
+
+def manifest_entry_size(mtype, path, md5sum):
+    """
+    Return size of manifest entry of the resource, as written by Manifest.
+    """
+    manifest = Manifest.new()
+    base = len(manifest.to_string())
+    manifest.manifest_entry(mtype, path, md5sum=md5sum or MD5_PLACEHOLDER)
+    return len(manifest.to_string()) - base
+
+def base_shard_size(names, zip64_offsets=False):
+    """
+    Return size of a shard without resources: mimetype, meta.xml and
+    preview.png copied from the bundle, the manifest without entries and
+    the end of central directory.
+    """
+    size = LOCAL_HEADER_SIZE + CENTRAL_HEADER_SIZE + 2 * len("mimetype") + len(MIMETYPE)
+    for name in ("meta.xml", "preview.png"):
+        if name in names:
+            size += member_size(names[name], zip64_offsets)
+    size += LOCAL_HEADER_SIZE + CENTRAL_HEADER_SIZE + 2 * len(MANIFEST_NAME) + len(Manifest.new().to_string())
+    return size + END_RECORD_SIZE + ZIP64_END_SIZE
+
+def parse_size(text):
+    """
+    Parse size in bytes, with optional K, M or G suffix.
+    """
+    text = text.strip().upper()
+    if text.endswith('B'):
+        text = text[:-1]
+    factor = 1
+    if text and text[-1] in SIZE_SUFFIXES:
+        factor = SIZE_SUFFIXES[text[-1]]
+        text = text[:-1]
+    try:
+        return int(float(text) * factor)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: {}".format(text))
+
+class Shard(object):
+    def __init__(self, base_size):
+        self.members = OrderedDict()  # full path => size
+        self.size = base_size
+        self.presets = 0
+
+    def add(self, unit, sizes):
+        for path in unit:
+            if path not in self.members:
+                self.members[path] = sizes[path]
+                self.size += sizes[path]
+        self.presets += 1 if unit[0].startswith('paintoppresets/') else 0
+
+def find_units(bundle, manifest, names, jobs=1):
+    """
+    Return list of units: lists of full paths of members which must go to
+    the same shard. Each preset makes a unit together with brush tips,
+    patterns and gradients it refers to; other manifest entries (resources
+    not referred by any preset, palettes, workspaces and so on) make units
+    by themselves. Presets referring to the same resources come together.
+    """
+    units = []
+    used = set()
+    for kpp, info in iter_info(bundle.presets_data, jobs):
+        unit = [kpp.filename]
+        for mtype, name in info['references']:
+            path = bundle.find_resource(mtype, name)
+            if path is not None and path not in unit:
+                unit.append(path)
+        used.update(unit)
+        units.append(unit)
+    units.sort(key=lambda unit: (sorted(unit[1:]), unit[0]))
+    for path, mtype, _ in manifest.entries():
+        if mtype == MIMETYPE or path in used:
+            continue
+        if path not in names:
+            print("Warning: {} is listed in manifest, but is missing from the bundle; it is not put into any shard".format(path))
+            continue
+        units.append([path])
+    return units
+
+def plan_shards(units, sizes, max_size=None, max_members=None, base_size=0):
+    """
+    Distribute units between shards, so that size of each shard (base_size
+    plus sizes of members) does not exceed max_size and number of members
+    does not exceed max_members. Resources referred by presets from several
+    shards are put into each of them. A unit which does not fit even into
+    an empty shard gets a shard of its own.
+    """
+    shards = []
+    for unit in units:
+        best = None
+        best_cost = None
+        for shard in shards:
+            extra = [path for path in unit if path not in shard.members]
+            cost = sum(sizes[path] for path in extra)
+            if max_size is not None and shard.size + cost > max_size:
+                continue
+            if max_members is not None and len(shard.members) + len(extra) > max_members:
+                continue
+            if best is None or cost < best_cost:
+                best = shard
+                best_cost = cost
+                if cost == 0:
+                    break
+        if best is None:
+            best = Shard(base_size)
+            shards.append(best)
+            unit_size = base_size + sum(sizes[path] for path in unit)
+            if (max_size is not None and unit_size > max_size) or (max_members is not None and len(unit) > max_members):
+                print("Warning: {} with resources it refers to does not fit into one shard".format(unit[0]))
+        best.add(unit, sizes)
+    return shards
+
+def shard_names(zipname, count, output_dir=None):
+    stem = splitext(basename(zipname))[0]
+    directory = output_dir if output_dir is not None else dirname(zipname)
+    width = len(str(count))
+    return [join(directory, "{}-{:0{}}.bundle".format(stem, i, width)) for i in range(1, count + 1)]
+
+def write_shard(bundle, manifest, shard, zipname):
+    """
+    Write shard to zipname, copying members from bundle file as is. The
+    bundle is opened by each call, so that shards can be written by
+    parallel threads: if the bundle can not be mapped into memory, members
+    are read through file object of its own zipfile.
+    """
+    def write(tmpname):
+        with MappedZip(bundle) as source, BundleWriter(tmpname) as writer:
+            names = source.NameToInfo
+            for name in ("meta.xml", "preview.png"):
+                if name in names:
+                    writer.copy_raw(source, names[name])
+            for path in shard.members:
+                writer.copy_raw(source, names[path])
+                md5sum = manifest.get_md5(path) or source.md5(path)
+                writer.manifest.manifest_entry(path.split('/', 1)[0], path, md5sum=md5sum)
+
+    Bundle.replace_zip(zipname, write)
+    return os.stat(zipname).st_size
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description="Split bundle file into several smaller self-contained bundles")
+    parser.add_argument('bundle', metavar='FILE.BUNDLE', help="Bundle file to split")
+    parser.add_argument('-s', '--max-size', type=parse_size, metavar='SIZE', help="Maximum size of each shard, in bytes; K, M and G suffixes may be used")
+    parser.add_argument('-m', '--max-members', type=int, metavar='N', help="Maximum number of resources in each shard")
+    parser.add_argument('-o', '--output-dir', metavar='DIRECTORY', help="Where to write shards; by default next to the bundle")
+    parser.add_argument('-n', '--dry-run', action='store_true', help="Only print how the bundle would be split")
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N', help="Number of processes used to read presets and threads used to write shards; 0 means number of CPUs")
+    cache.add_cmdline_options(parser)
+    profiling.add_cmdline_options(parser)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+
+    args = parse_cmdline()
+    cache.configure(enabled=not args.no_cache)
+    profiling.configure_from_args(args)
+    if args.max_size is None and args.max_members is None:
+        print("Error: --max-size or --max-members must be specified")
+        sys.exit(1)
+
+    with Bundle.open(args.bundle, lazy=True, memory_budget=0) as bundle, MappedZip(args.bundle) as source:
+        names = source.NameToInfo
+        manifest = Manifest.parse(source.read("META-INF/manifest.xml"))
+        # sizes of resources in a shard, with headers and manifest entries
+        zip64_offsets = args.max_size is None or args.max_size > ZIP64_LIMIT
+        sizes = dict()
+        for path, mtype, md5sum in manifest.entries():
+            if path in names and mtype != MIMETYPE:
+                sizes[path] = member_size(names[path], zip64_offsets) + manifest_entry_size(path.split('/', 1)[0], path, md5sum)
+        base_size = base_shard_size(names, zip64_offsets)
+
+        with profiling.span('plan shards'):
+            units = find_units(bundle, manifest, names, args.jobs)
+            shards = plan_shards(units, sizes, args.max_size, args.max_members, base_size)
+        zipnames = shard_names(args.bundle, len(shards), args.output_dir)
+        if args.output_dir is not None and not args.dry_run:
+            os.makedirs(args.output_dir, exist_ok=True)
+
+        if args.dry_run:
+            results = [None] * len(shards)
+        else:
+            jobs = args.jobs or os.cpu_count() or 1
+            with profiling.span('write shards'), ThreadPoolExecutor(max(1, jobs)) as pool:
+                futures = [pool.submit(write_shard, args.bundle, manifest, shard, zipname)
+                           for shard, zipname in zip(shards, zipnames)]
+                results = [future.result() for future in futures]
+
+    total = 0
+    for shard, zipname, size in zip(shards, zipnames, results):
+        if size is None:
+            size = shard.size
+        total += size
+        print("{}: {} resources ({} presets), {} bytes".format(zipname, len(shard.members), shard.presets, size))
+    print("{} shards, {} bytes in total; the bundle has {} bytes.".format(len(shards), total, os.stat(args.bundle).st_size))
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+# -*- encoding: utf-8 -*-
+
+import sys
+import json
+import argparse
+from glob import glob
+from os.path import join, isdir, isfile
+
+from bundle import verify_bundles
+import profiling
+
+def find_bundles(paths):
+    """
+    Return list of bundle files given directly or found in given directories,
+    and list of paths which are neither.
+    """
+    result = []
+    bad = []
+    for path in paths:
+        if isdir(path):
+            result.extend(sorted(glob(join(path, '*.bundle'))))
+        elif isfile(path):
+            result.append(path)
+        else:
+            bad.append(path)
+    return result, bad
+
+def format_problem(zipname, problem):
+    if problem.member is None:
+        return "{}: {}: {}".format(zipname, problem.kind, problem.message)
+    return "{}: {}: {}: {}".format(zipname, problem.member, problem.kind, problem.message)
+
+def parse_cmdline():
+    parser = argparse.ArgumentParser(description="Verify integrity of bundle files")
+    parser.add_argument('paths', metavar='PATH', nargs='+', help="Bundle file or directory with bundle files (*.bundle)")
+    parser.add_argument('-j', '--jobs', type=int, default=0, metavar='N', help='Number of parallel processes (or threads, for a single bundle); 0 means number of CPUs (default)')
+    parser.add_argument('--fail-fast', action='store_true', help="Stop at the first problem found")
+    parser.add_argument('--no-presets', action='store_true', help="Do not check that presets contain valid preset XML")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Print bundles without problems as well")
+    parser.add_argument('--json', action='store_true', help="Print report as JSON")
+    profiling.add_cmdline_options(parser)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+
+    args = parse_cmdline()
+    profiling.configure_from_args(args)
+
+    zipnames, bad = find_bundles(args.paths)
+    for path in bad:
+        print("Error: {} is not a bundle file or directory".format(path), file=sys.stderr)
+
+    checked = 0
+    failed = 0
+    report = []
+    for result in verify_bundles(zipnames, args.jobs, args.fail_fast, not args.no_presets):
+        checked += 1
+        if not result.ok:
+            failed += 1
+        if args.json:
+            report.append(result.to_dict())
+            continue
+        for problem in result.problems:
+            print(format_problem(result.zipname, problem))
+        if result.ok and args.verbose:
+            print("{}: OK, {} members, {} bytes".format(result.zipname, result.members, result.bytes))
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print("Verified {} bundles: {} OK, {} with problems.".format(checked, checked - failed, failed))
+
+    if failed or bad:
+        sys.exit(1)
@@ -0,0 +1,326 @@
+# encoding: utf-8
+"""
+Rebuilding bundles when resource files change.
+
+Directories are watched with inotify through inotify_simple module, if it
+is installed (Linux only); otherwise they are polled: walked and stat()ed
+every few seconds. Changes are debounced: a rebuild starts only when no new
+changes arrived for a while, so saving many files at once causes one rebuild.
+
+WatchedBuild keeps its state between rebuilds: signatures (size, mtime and
+inode) of resource files as of the last build, and parsed presets. Only
+presets which changed are parsed again, and only changed resource files are
+read; other members are copied from the previous version of the bundle.
+"""
+
+import os
+import time
+from fnmatch import fnmatch
+from collections import OrderedDict
+from os.path import join, basename, dirname, abspath, isdir, isfile
+
+try:
+    import inotify_simple
+except ImportError:
+    inotify_simple = None
+
+from bundle import Bundle
+from cache import get_cache
+import profiling
+
+DEFAULT_DEBOUNCE = 0.5
+DEFAULT_POLL_INTERVAL = 2.0
+
+def signature(path):
+    """
+    Return (size, mtime, inode) of file, or None if it does not exist.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+def matches(name, mask):
+    """
+    Check name against mask as used in bundle config ("*.gbr;*.gih").
+    """
+    return any(fnmatch(name, m) for m in mask.split(";"))
+
+def walk_files(directory):
+    """
+    Yield (path, signature) of files in directory and its subdirectories,
+    in the same order as Bundle.get_files() does.
+    """
+    for (d, _, files) in os.walk(directory):
+        for f in files:
+            path = join(d, f)
+            sig = signature(path)
+            if sig is not None:
+                yield path, sig
+
+class PollingWatcher(object):
+    """
+    Detects changes by walking directories every `interval` seconds.
+    """
+
+    def __init__(self, directories, interval=DEFAULT_POLL_INTERVAL):
+        self.directories = directories
+        self.interval = interval
+        self._state = self._scan()
+
+    def _scan(self):
+        state = dict()
+        for directory in self.directories:
+            state.update(walk_files(directory))
+        return state
+
+    def wait(self, timeout=None):
+        """
+        Return set of paths changed since the previous call, waiting for
+        at least one change up to timeout seconds (None means forever).
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            delay = self.interval
+            if deadline is not None:
+                delay = min(delay, max(0.0, deadline - time.monotonic()))
+            time.sleep(delay)
+            state = self._scan()
+            changed = set(path for path, sig in state.items() if self._state.get(path) != sig)
+            changed.update(path for path in self._state if path not in state)
+            self._state = state
+            if changed or (deadline is not None and time.monotonic() >= deadline):
+                return changed
+
+    def close(self):
+        pass
+
+class InotifyWatcher(object):
+    """
+    Detects changes with inotify. Subdirectories are watched as well;
+    when a directory appears, it is reported as changed, so that its
+    contents are scanned.
+    """
+
+    def __init__(self, directories):
+        flags = inotify_simple.flags
+        self._mask = (flags.CLOSE_WRITE | flags.ATTRIB | flags.CREATE | flags.DELETE |
+                      flags.MOVED_FROM | flags.MOVED_TO | flags.DELETE_SELF)
+        self._inotify = inotify_simple.INotify()
+        self._paths = dict()  # watch descriptor => directory
+        self.directories = directories
+        for directory in directories:
+            self._add_tree(directory)
+
+    def _add_tree(self, directory):
+        for (d, _, _) in os.walk(directory):
+            try:
+                self._paths[self._inotify.add_watch(d, self._mask)] = d
+            except OSError as e:
+                print("Warning: can not watch {}: {}".format(d, e))
+
+    def wait(self, timeout=None):
+        flags = inotify_simple.flags
+        events = self._inotify.read(timeout=None if timeout is None else int(timeout * 1000))
+        changed = set()
+        for event in events:
+            if event.mask & flags.Q_OVERFLOW:
+                # events were lost, everything has to be scanned again
+                changed.update(self.directories)
+                continue
+            directory = self._paths.get(event.wd)
+            if directory is None:
+                continue
+            if event.mask & flags.IGNORED:
+                del self._paths[event.wd]
+                continue
+            if event.mask & flags.DELETE_SELF:
+                changed.add(directory)
+                continue
+            path = join(directory, event.name)
+            if event.mask & flags.ISDIR:
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    self._add_tree(path)
+            elif event.mask & flags.CREATE:
+                # the file is reported again when it is closed after writing
+                continue
+            changed.add(path)
+        return changed
+
+    def close(self):
+        self._inotify.close()
+
+def create_watcher(directories, poll_interval=None):
+    """
+    Return InotifyWatcher if inotify is available and poll_interval is not
+    given, PollingWatcher otherwise.
+    """
+    # nested directories are watched (and walked) as part of their parents
+    roots = []
+    for directory in sorted(set(abspath(d) for d in directories if isdir(d))):
+        if not roots or not directory.startswith(join(roots[-1], '')):
+            roots.append(directory)
+    directories = roots
+    if poll_interval is None and inotify_simple is not None:
+        try:
+            return InotifyWatcher(directories)
+        except OSError as e:
+            print("Warning: can not use inotify, falling back to polling: {}".format(e))
+    return PollingWatcher(directories, poll_interval or DEFAULT_POLL_INTERVAL)
+
+def wait_for_changes(watcher, debounce=DEFAULT_DEBOUNCE):
+    """
+    Wait for changes, then keep collecting them until there are none for
+    `debounce` seconds. Return set of changed paths.
+    """
+    changed = set()
+    while not changed:
+        changed = watcher.wait()
+    while True:
+        more = watcher.wait(debounce)
+        if not more:
+            return changed
+        changed.update(more)
+
+class WatchedBuild(object):
+    """
+    Bundle which is rebuilt when its resource files change.
+    sources is a list of (mtype, directory, mask) as in Bundle.prepare();
+    check_options are passed to Bundle.check().
+    """
+
+    def __init__(self, zipname, meta, preview, sources, check_options=None, jobs=1):
+        self.zipname = zipname
+        self.meta = meta
+        self.preview = abspath(preview) if preview else preview
+        # paths are kept absolute, so that paths reported by watchers of
+        # parent directories match them
+        self.sources = [(mtype, abspath(directory), mask) for mtype, directory, mask in sources if directory]
+        self.check_options = check_options or dict()
+        self.jobs = jobs
+        # mtype => OrderedDict of path => signature
+        self.files = OrderedDict((mtype, OrderedDict()) for mtype, _, _ in self.sources)
+        # signatures of files as they were put into the bundle
+        self.built = dict()
+        self.bundle_signature = None
+        self.kpps = dict()
+        for mtype, directory, mask in self.sources:
+            for path, sig in walk_files(directory):
+                if self._accepts(path, directory, mask):
+                    self.files[mtype][path] = sig
+
+    def directories(self):
+        result = [directory for _, directory, _ in self.sources]
+        if self.preview:
+            result.append(dirname(self.preview))
+        return result
+
+    def _accepts(self, path, directory, mask):
+        name = basename(path)
+        if name.startswith('.'):
+            return False
+        return matches(name, mask) and path.startswith(join(directory, ''))
+
+    def _update_file(self, path, sig):
+        for mtype, directory, mask in self.sources:
+            if not self._accepts(path, directory, mask):
+                continue
+            files = self.files[mtype]
+            if sig is None:
+                files.pop(path, None)
+            else:
+                files[path] = sig
+            if mtype == 'paintoppresets':
+                # parse it again on next build
+                self.kpps.pop(path, None)
+
+    def update(self, changed):
+        """
+        Update state from changed paths (files or directories, which are
+        scanned again). Return True if the bundle has to be rebuilt.
+        """
+        for path in changed:
+            known = any(path in files for files in self.files.values())
+            if isdir(path) or not known and not isfile(path):
+                # directory appeared, disappeared or has to be scanned again
+                prefix = join(path, '')
+                present = dict(walk_files(path)) if isdir(path) else dict()
+                for files in list(self.files.values()):
+                    for old in [p for p in files if p.startswith(prefix) and p not in present]:
+                        self._update_file(old, None)
+                for p, sig in present.items():
+                    self._update_file(p, sig)
+            else:
+                self._update_file(path, signature(path))
+        return self.is_dirty()
+
+    def _current(self):
+        current = dict()
+        for files in self.files.values():
+            current.update(files)
+        if self.preview:
+            current[self.preview] = signature(self.preview)
+        return current
+
+    def is_dirty(self):
+        return self._current() != self.built or signature(self.zipname) != self.bundle_signature
+
+    @profiling.timed('rebuild')
+    def build(self):
+        """
+        Check and write the bundle. Returns (result of Bundle.check(), BuildStats).
+        """
+        current = self._current()
+        bundle = Bundle()
+        for mtype, directory, _ in self.sources:
+            if mtype == 'brushes':
+                bundle.brushdir = directory
+            elif mtype == 'patterns':
+                bundle.patdir = directory
+            elif mtype == 'gradients':
+                bundle.gradientdir = directory
+            for path in self.files[mtype]:
+                bundle.add_resource_path(mtype, path)
+        ok = bundle.check(jobs=self.jobs, kpps=self.kpps, **self.check_options)
+        for kpp in list(self.kpps):
+            if kpp not in self.files.get('paintoppresets', ()):
+                del self.kpps[kpp]
+
+        unchanged = None
+        if isfile(self.zipname) and signature(self.zipname) == self.bundle_signature:
+            unchanged = set(path for path, sig in current.items() if sig is not None and self.built.get(path) == sig)
+        stats = bundle.create(self.zipname, self.meta, self.preview, jobs=self.jobs, incremental=True, unchanged=unchanged)
+        get_cache().flush()
+
+        # resources added by check() (auto add) were not seen by the watcher yet
+        for mtype, names in bundle.get_resource_lists():
+            for path in names:
+                if mtype in self.files and path not in current:
+                    sig = signature(path)
+                    self.files[mtype][path] = sig
+                    current[path] = sig
+        self.built = current
+        self.bundle_signature = signature(self.zipname)
+        return ok, stats
+
+    def watch(self, debounce=DEFAULT_DEBOUNCE, poll_interval=None, on_build=None):
+        """
+        Build the bundle, then rebuild it on each change until interrupted.
+        on_build(ok, stats) is called after each build.
+        """
+        watcher = create_watcher(self.directories(), poll_interval)
+        print("Watching {} ({}); press Ctrl+C to stop.".format(", ".join(watcher.directories), type(watcher).__name__))
+        try:
+            while True:
+                if self.is_dirty():
+                    result = self.build()
+                    if on_build is not None:
+                        on_build(*result)
+                changed = wait_for_changes(watcher, debounce)
+                if self.update(changed):
+                    print("Changed: {}".format(", ".join(sorted(basename(p) for p in changed))))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            watcher.close()